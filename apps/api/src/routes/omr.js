@@ -1,9 +1,14 @@
 const express = require("express");
 const multer = require("multer");
+const os = require("os");
+const path = require("path");
+const crypto = require("crypto");
+const fs = require("fs").promises;
 const prisma = require("../db");
 const auth = require("../middleware/auth");
 const rbac = require("../middleware/rbac");
 const asyncHandler = require("../utils/asyncHandler");
+const mapConcurrent = require("../utils/mapConcurrent");
 const omrService = require("../services/omrService");
 
 const router = express.Router();
@@ -25,6 +30,176 @@ const upload = multer({
     }
 });
 
+// Batch uploads may also be multi-page scanner stacks (PDF/TIFF)
+const DOCUMENT_TYPES = {
+    "application/pdf": ".pdf",
+    "image/tiff": ".tiff",
+    "image/tif": ".tiff"
+};
+// Batch files go to disk (up to 50 x 50MB per request) and the worker reads them in place
+const IMAGE_EXTENSIONS = { "image/jpeg": ".jpg", "image/jpg": ".jpg", "image/png": ".png", "image/webp": ".webp" };
+const batchStorage = multer.diskStorage({
+    destination: os.tmpdir(),
+    filename: (req, file, cb) => {
+        const extension = DOCUMENT_TYPES[file.mimetype] || IMAGE_EXTENSIONS[file.mimetype] || path.extname(file.originalname).toLowerCase() || ".jpg";
+        cb(null, `omr-batch-${crypto.randomUUID()}${extension}`);
+    }
+});
+const batchUpload = multer({
+    storage: batchStorage,
+    limits: {
+        fileSize: 50 * 1024 * 1024, // 50MB limit (whole class stacks)
+    },
+    fileFilter: (req, file, cb) => {
+        const allowedTypes = ["image/jpeg", "image/jpg", "image/png", "image/webp", "application/octet-stream", ...Object.keys(DOCUMENT_TYPES)];
+        if (allowedTypes.includes(file.mimetype)) {
+            cb(null, true);
+        } else {
+            cb(new Error("Invalid file type. Only JPEG, PNG, WebP, PDF and TIFF are allowed."));
+        }
+    }
+});
+
+// Uploaded batch files are deleted once the response is over (finished, failed or abandoned)
+function removeBatchUploads(req, res, next) {
+    res.on("close", () => {
+        for (const file of req.files || []) {
+            fs.unlink(file.path).catch(() => {});
+        }
+    });
+    next();
+}
+
+// Files of one /omr/batch request processed at once; the worker pool (OMR_POOL_SIZE) queues beyond its size
+const BATCH_CONCURRENCY = Math.max(1, parseInt(process.env.OMR_BATCH_CONCURRENCY || "", 10) || os.cpus().length);
+
+function batchStreamMode(req) {
+    const requested = String(req.query.stream || req.body?.stream || "").toLowerCase();
+    if (requested === "ndjson" || requested === "sse") return requested;
+    const accept = req.get("accept") || "";
+    if (accept.includes("application/x-ndjson")) return "ndjson";
+    if (accept.includes("text/event-stream")) return "sse";
+    return null;
+}
+
+// Leading bytes of the stacks the worker can page through
+const DOCUMENT_SIGNATURES = [
+    [Buffer.from("%PDF"), ".pdf"],
+    [Buffer.from("II*\0", "binary"), ".tiff"],
+    [Buffer.from("MM\0*", "binary"), ".tiff"]
+];
+
+/**
+ * Extension of a PDF/TIFF upload, or null for an image. Generic uploads (application/octet-stream)
+ * are recognised by their leading bytes, and the stored file is renamed so the worker picks the
+ * document reader by its extension.
+ */
+async function documentExtension(file) {
+    if (DOCUMENT_TYPES[file.mimetype]) return DOCUMENT_TYPES[file.mimetype];
+    if (file.mimetype !== "application/octet-stream") return null;
+    const handle = await fs.open(file.path, "r");
+    let head;
+    try {
+        const { buffer, bytesRead } = await handle.read(Buffer.alloc(4), 0, 4, 0);
+        head = buffer.subarray(0, bytesRead);
+    } finally {
+        await handle.close();
+    }
+    const match = DOCUMENT_SIGNATURES.find(([signature]) => head.equals(signature));
+    if (!match) return null;
+    const extension = match[1];
+    if (path.extname(file.path).toLowerCase() !== extension) {
+        const renamed = `${file.path}${extension}`;
+        await fs.rename(file.path, renamed);
+        file.path = renamed;
+    }
+    return extension;
+}
+
+/**
+ * Process one uploaded file (image or PDF/TIFF stack) into sheet results; errors become a failed
+ * record for that file. With `onResult` every sheet is handed over as soon as it is ready instead
+ * of being collected.
+ */
+async function processBatchFile(file, options, onResult = null) {
+    const results = [];
+    const emit = onResult || (async (result) => { results.push(result); });
+    try {
+        const extension = await documentExtension(file);
+        if (extension) {
+            // One result per page of the stack
+            await omrService.processDocument(file.path, {
+                ...options,
+                extension,
+                onPage: (result) => {
+                    result.filename = `${file.originalname}#${result.page}`;
+                    return emit(result);
+                }
+            });
+        } else {
+            const result = await omrService.processImage(file.path, options);
+            result.filename = file.originalname;
+            await emit(result);
+        }
+    } catch (error) {
+        await emit({
+            filename: file.originalname,
+            success: false,
+            error: error.message
+        });
+    }
+    return results;
+}
+
+/**
+ * Label each answer against the key and attach the sheet score. Only key questions are graded, as in the
+ * worker's grading pass: questions outside the key are "ungraded", key questions the sheet lacks count as
+ * empty. `score` (the worker's per-student record) replaces the local count when given.
+ */
+function applyAnswerKey(result, answerKey, score = null) {
+    const total = Object.keys(answerKey).length;
+    let correct = 0, wrong = 0;
+    result.answers = result.answers.map(ans => {
+        const correctAnswer = answerKey[String(ans.question)];
+        if (correctAnswer === undefined) {
+            return { ...ans, status: "ungraded", correctAnswer: null };
+        } else if (!ans.answer) {
+            return { ...ans, status: "empty", correctAnswer };
+        } else if (ans.answer === correctAnswer) {
+            correct++;
+            return { ...ans, status: "correct", correctAnswer };
+        } else {
+            wrong++;
+            return { ...ans, status: "wrong", correctAnswer };
+        }
+    });
+    result.score = score ? {
+        correct: score.correct, wrong: score.wrong, empty: score.empty,
+        total: score.total,
+        percentage: score.percentage
+    } : {
+        correct, wrong,
+        empty: total - correct - wrong,
+        total,
+        percentage: total ? Math.round((correct / total) * 100) : 0
+    };
+    return result;
+}
+
+async function gradeBatch(results, answerKey) {
+    const graded = results.filter(r => r.success && Array.isArray(r.answers));
+    const responses = graded.map(r => Object.fromEntries(r.answers.map(a => [String(a.question), a.answer || null])));
+    try {
+        const grading = await omrService.gradeResponses(responses, answerKey);
+        graded.forEach((r, i) => applyAnswerKey(r, answerKey, grading.students[i]));
+        return { items: grading.items, summary: grading.summary };
+    } catch (error) {
+        console.warn("OMR batch grading failed, scoring per sheet:", error.message);
+        graded.forEach(r => applyAnswerKey(r, answerKey));
+        return null;
+    }
+}
+
 /**
  * POST /omr/detect
  * Quick detection endpoint - NO AUTH REQUIRED for mobile live scanning
@@ -215,18 +390,27 @@ router.get(
 /**
  * POST /omr/batch
  * Process multiple OMR images (batch mode)
+ *
+ * Files run through a bounded pool (OMR_BATCH_CONCURRENCY, default CPU count); one failing
+ * sheet only fails its own record. Images are omitted unless `images=1` is sent.
+ * `Accept: application/x-ndjson` (or `stream=ndjson`) streams one `{type: "result"}` line per
+ * sheet as it completes plus a final `{type: "done"}` summary; `text/event-stream` (or
+ * `stream=sse`) sends the same records as `result` / `done` events. Otherwise the whole batch
+ * is returned as one JSON response in upload order.
  */
 router.post(
     "/batch",
     rbac("super_admin", "admin", "instructor", "assistant"),
-    upload.array("images", 50),
+    batchUpload.array("images", 50),
+    removeBatchUploads,
     asyncHandler(async (req, res) => {
         if (!req.files || req.files.length === 0) {
             return res.status(400).json({ error: "No image files provided" });
         }
 
         const { examId } = req.body;
-        const results = [];
+        const includeImages = ["1", "true"].includes(String(req.body.images ?? req.query.images ?? "").toLowerCase());
+        const stream = batchStreamMode(req);
 
         let answerKey = null;
         if (examId) {
@@ -236,52 +420,79 @@ router.post(
             }
         }
 
-        for (const file of req.files) {
-            try {
-                const result = await omrService.processImage(file.buffer);
-                result.filename = file.originalname;
-
-                // Apply answer key if available
-                if (answerKey) {
-                    let correct = 0, wrong = 0, empty = 0;
-                    result.answers = result.answers.map(ans => {
-                        const correctAnswer = answerKey[String(ans.question)];
-                        if (!ans.answer) {
-                            empty++;
-                            return { ...ans, status: "empty", correctAnswer };
-                        } else if (ans.answer === correctAnswer) {
-                            correct++;
-                            return { ...ans, status: "correct", correctAnswer };
-                        } else {
-                            wrong++;
-                            return { ...ans, status: "wrong", correctAnswer };
-                        }
-                    });
-                    result.score = {
-                        correct, wrong, empty,
-                        total: Object.keys(answerKey).length,
-                        percentage: Math.round((correct / Object.keys(answerKey).length) * 100)
-                    };
-                }
+        const startTime = Date.now();
+        const options = includeImages ? {} : { artifacts: "none" };
 
-                results.push(result);
-            } catch (error) {
-                results.push({
-                    filename: file.originalname,
-                    success: false,
-                    error: error.message
-                });
-            }
+        if (!stream) {
+            const byFile = await mapConcurrent(req.files, BATCH_CONCURRENCY, file => processBatchFile(file, options));
+            const results = byFile.flat();
+
+            // Grade every sheet in one worker pass; also yields item analysis for the exam
+            const itemAnalysis = answerKey ? await gradeBatch(results, answerKey) : null;
+
+            return res.json({
+                data: {
+                    total: results.length,
+                    successful: results.filter(r => r.success).length,
+                    failed: results.filter(r => !r.success).length,
+                    results,
+                    itemAnalysis,
+                    elapsedMs: Date.now() - startTime
+                }
+            });
         }
 
-        res.json({
-            data: {
-                total: req.files.length,
-                successful: results.filter(r => r.success).length,
-                failed: results.filter(r => !r.success).length,
-                results
-            }
+        res.status(200);
+        res.set({
+            "Content-Type": stream === "sse" ? "text/event-stream" : "application/x-ndjson",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
         });
+        res.flushHeaders();
+        let closed = false;
+        res.on("close", () => { closed = true; });
+        const send = (type, record) => {
+            if (closed) return Promise.resolve();
+            const body = JSON.stringify({ type, ...record });
+            const ok = res.write(stream === "sse" ? `event: ${type}\ndata: ${body}\n\n` : `${body}\n`);
+            // Respect backpressure so a slow client does not buffer the whole batch in memory
+            return ok ? Promise.resolve() : new Promise(resolve => {
+                const done = () => { res.off("drain", done); res.off("close", done); resolve(); };
+                res.on("drain", done);
+                res.on("close", done);
+            });
+        };
+
+        // Only answers are kept for the closing item analysis; each record is released once written
+        const graded = [];
+        let total = 0, successful = 0;
+        try {
+            await mapConcurrent(req.files, BATCH_CONCURRENCY, (file, index) => processBatchFile(file, options, async (result) => {
+                total++;
+                if (result.success) {
+                    successful++;
+                    if (answerKey) {
+                        // Scored here; the worker only sees the batch once, for the closing item analysis
+                        applyAnswerKey(result, answerKey);
+                        graded.push({ success: true, answers: result.answers.map(({ question, answer }) => ({ question, answer })) });
+                    }
+                }
+                await send("result", { index, ...result });
+            }), () => closed);
+
+            const itemAnalysis = answerKey && graded.length ? await gradeBatch(graded, answerKey) : null;
+            await send("done", {
+                total,
+                successful,
+                failed: total - successful,
+                itemAnalysis,
+                elapsedMs: Date.now() - startTime
+            });
+        } catch (error) {
+            console.error("OMR batch stream error:", error);
+            await send("error", { error: error.message || "Batch processing failed" });
+        }
+        res.end();
     })
 );
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OMR benchmark: synthetic sheets with known answers + throughput/accuracy runner (offline)
+Usage: python bench.py generate <output_dir> [-n N] [--template T] [--seed S] [degradation options]
+       python bench.py run <sheet_dir> [--template T] [--workers N] [--env KEY=VALUE ...] [--json report.json]
+
+generate renders sheets for a template (page size, choices, questionColumns, rowsPerBlock,
+expectedQuestionCount, ROI) and writes sheet_XXXX.jpg + sheet_XXXX.json ground truth.
+run reads them with worker.py and reports sheets/s, stage latency percentiles (meta.timings),
+peak RSS and accuracy per question / answer kind / camera resolution.
+"""
+
+import sys, os, json, time, argparse, resource, glob, tempfile, contextlib
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+HERE = Path(__file__).resolve().parent
+DEFAULT_TEMPLATE = str(HERE / 'templates' / 'standard_156.json')
+
+# Bubble layout inside the template answer ROI (fractions of ROI width/height): first bubble of
+# block k at x0 + k*block_dx, choices choice_dx apart, rows evenly spread over the ROI height.
+LAYOUT = {'x0':0.201, 'block_dx':0.289, 'choice_dx':0.0506, 'y0':0.0147, 'row_dy':0.01915, 'r':12}
+CORNER_MARK = (0.03, 0.03, 20)
+CAMERA_MP = {2:(1200,1600), 5:(1944,2592), 8:(2448,3264), 12:(3024,4032)}
+
+def load_config(tmpl):
+    with open(tmpl, 'r', encoding='utf-8') as f: t = json.load(f)
+    return t.get('key', Path(tmpl).stem), t.get('config', t)
+
+def bubble_layout(cfg):
+    """Nominal bubble centres in page pixels: {question: [(x, y) per choice]}."""
+    pw, ph = cfg.get('page',{}).get('width', 1700), cfg.get('page',{}).get('height', 2200)
+    rx, ry, rw, rh = cfg.get('roiX',0)*pw, cfg.get('roiY',0)*ph, cfg.get('roiW',1)*pw, cfg.get('roiH',1)*ph
+    nc, rpb = len(cfg.get('choices', 'ABCDE')), int(cfg.get('rowsPerBlock', 52))
+    exp = int(cfg.get('expectedQuestionCount', rpb*int(cfg.get('questionColumns', 3))))
+    out = {}
+    for q in range(1, exp+1):
+        b, r = divmod(q-1, rpb)
+        x = rx + rw*(LAYOUT['x0'] + b*LAYOUT['block_dx']); y = ry + rh*(LAYOUT['y0'] + r*LAYOUT['row_dy'])
+        out[q] = [(int(round(x + c*rw*LAYOUT['choice_dx'])), int(round(y))) for c in range(nc)]
+    return out
+
+def draw_mark(pg, x, y, r, tone, rng):
+    """Pencil fill: a slightly irregular disc with grain."""
+    m = np.zeros((2*r+5, 2*r+5), np.uint8)
+    cv2.circle(m, (r+2+int(rng.integers(-1,2)), r+2+int(rng.integers(-1,2))), r-2, 255, -1)
+    y1, x1 = y-r-2, x-r-2; roi = pg[y1:y1+m.shape[0], x1:x1+m.shape[1]]
+    if roi.shape != m.shape: return
+    v = np.clip(tone + rng.normal(0, 10, m.shape), 0, 255).astype(np.uint8)
+    roi[m > 0] = np.minimum(roi[m > 0], v[m > 0])
+
+def render_page(cfg, truth, marks, rng):
+    pw, ph = cfg.get('page',{}).get('width', 1700), cfg.get('page',{}).get('height', 2200)
+    choices = cfg.get('choices', ['A','B','C','D','E']); lay = bubble_layout(cfg); r = LAYOUT['r']
+    pg = np.full((ph, pw), 245, np.uint8)
+    fx, fy, hs = CORNER_MARK
+    for cx, cy in [(fx*pw, fy*ph), ((1-fx)*pw, fy*ph), ((1-fx)*pw, (1-fy)*ph), (fx*pw, (1-fy)*ph)]:
+        cv2.rectangle(pg, (int(cx-hs), int(cy-hs)), (int(cx+hs), int(cy+hs)), 0, -1)
+    # Left-half clutter like the printed form: student-number grid and header lines.
+    for i in range(10):
+        for j in range(8): cv2.circle(pg, (int(pw*0.118)+j*50, int(ph*0.227)+i*40), r, 60, 2)
+    for k in range(6): cv2.line(pg, (int(pw*0.07), int(ph*0.114)+k*30), (int(pw*0.47), int(ph*0.114)+k*30), 80, 2)
+    for q, pts in lay.items():
+        for x, y in pts: cv2.circle(pg, (x, y), r, 70, 2)
+        for ch, tone in marks.get(q, []): draw_mark(pg, *pts[choices.index(ch)], r, tone, rng)
+    return pg
+
+def photograph(pg, rng, size, rot, skew, blur, quality):
+    """Place the page on a darker background as a camera would see it, then blur/noise/JPEG."""
+    cw, ch = size; ph, pw = pg.shape[:2]
+    s = min(cw*0.85/pw, ch*0.85/ph); w, h = pw*s, ph*s
+    q = np.array([[-w/2,-h/2],[w/2,-h/2],[w/2,h/2],[-w/2,h/2]], np.float32)
+    q += rng.uniform(-skew, skew, q.shape).astype(np.float32) * np.array([w, h], np.float32)
+    a = np.deg2rad(rng.uniform(-rot, rot)); R = np.array([[np.cos(a),-np.sin(a)],[np.sin(a),np.cos(a)]], np.float32)
+    q = q @ R.T + np.array([cw/2, ch/2], np.float32)
+    M = cv2.getPerspectiveTransform(np.array([[0,0],[pw,0],[pw,ph],[0,ph]], np.float32), q)
+    out = cv2.warpPerspective(pg, M, (cw, ch), dst=np.full((ch, cw), 70, np.uint8), borderMode=cv2.BORDER_TRANSPARENT)
+    if blur > 0: out = cv2.GaussianBlur(out, (0, 0), blur)
+    out = np.clip(out.astype(np.int16) + rng.normal(0, 4, out.shape).astype(np.int16), 0, 255).astype(np.uint8)
+    ok, buf = cv2.imencode('.jpg', cv2.cvtColor(out, cv2.COLOR_GRAY2BGR), [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    return buf.tobytes()
+
+def make_sheet(cfg, rng, a):
+    """Sample answers and degradations; returns (jpeg bytes, ground truth)."""
+    choices = cfg.get('choices', ['A','B','C','D','E']); lay = bubble_layout(cfg)
+    truth, marks, kinds = {}, {}, {}
+    for q in lay:
+        u = rng.random()
+        if u < a.blank: truth[q], kinds[q] = None, 'blank'; continue
+        if u < a.blank + a.multi:
+            pick = [str(c) for c in rng.choice(choices, 2, replace=False)]
+            truth[q], kinds[q] = None, 'multi'; marks[q] = [(c, int(rng.integers(30, 70))) for c in pick]; continue
+        c = choices[int(rng.integers(0, len(choices)))]; truth[q], kinds[q] = c, 'single'
+        faint = rng.random() < a.faint
+        marks[q] = [(c, int(rng.integers(125, 160)) if faint else int(rng.integers(30, 70)))]
+        if faint: kinds[q] = 'faint'
+        if rng.random() < a.erasures:
+            # Erased earlier choice: light grey residue next to the real mark.
+            other = [x for x in choices if x != c]; marks[q].append((other[int(rng.integers(0, len(other)))], int(rng.integers(200, 225))))
+            kinds[q] = 'erased'
+    mp = int(rng.choice(a.resolutions)); size = CAMERA_MP.get(mp) or CAMERA_MP[min(CAMERA_MP, key=lambda k: abs(k-mp))]
+    deg = {'megapixels':mp, 'size':list(size), 'blur':round(float(rng.uniform(0, a.blur)), 2),
+           'jpegQuality':int(rng.integers(a.jpeg_quality[0], a.jpeg_quality[1]+1))}
+    data = photograph(render_page(cfg, truth, marks, rng), rng, size, a.rotate, a.skew, deg['blur'], deg['jpegQuality'])
+    deg.update({'rotateMax':a.rotate, 'skewMax':a.skew})
+    return data, {'answers':{str(q):v for q,v in truth.items()}, 'kinds':{str(q):k for q,k in kinds.items()}, 'degradations':deg}
+
+def generate(a):
+    tk, cfg = load_config(a.template); os.makedirs(a.outdir, exist_ok=True)
+    for i in range(a.n):
+        data, gt = make_sheet(cfg, np.random.default_rng(a.seed + i), a)
+        gt['template'] = tk
+        with open(os.path.join(a.outdir, f'sheet_{i:04d}.jpg'), 'wb') as f: f.write(data)
+        with open(os.path.join(a.outdir, f'sheet_{i:04d}.json'), 'w', encoding='utf-8') as f: json.dump(gt, f)
+    print(json.dumps({'generated':a.n, 'outdir':a.outdir, 'template':tk}))
+
+def pct(v, p): return round(float(np.percentile(v, p)), 2) if len(v) else None
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux; children covers the batch process pool.
+    return round(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)/1024.0, 1)
+
+def run(a):
+    for kv in a.env:
+        k, _, v = kv.partition('='); os.environ[k] = v
+    sys.path.insert(0, str(HERE))
+    # Keep stdout for the report: newer PyMuPDF prints a deprecation notice on import.
+    with contextlib.redirect_stdout(sys.stderr): import worker
+    sheets = sorted(glob.glob(os.path.join(os.path.abspath(a.sheets), 'sheet_*.jpg')))
+    if not sheets: raise SystemExit(f'no sheet_*.jpg in {a.sheets}')
+    outd = a.outdir or tempfile.mkdtemp(prefix='omr-bench-'); recs = {}
+    st = time.perf_counter()
+    if a.workers > 1:
+        man = os.path.join(outd, 'manifest.json')
+        with open(man, 'w') as f: json.dump(sheets, f)
+        def emit(rec):
+            if rec.get('type') == 'sheet': recs[rec['input']] = rec
+        worker.run_batch(man, a.template, outd, a.workers, emit)
+    else:
+        for i, s in enumerate(sheets):
+            sd = os.path.join(outd, f'{i:04d}'); os.makedirs(sd, exist_ok=True)
+            try: recs[s] = worker.process(s, a.template, sd)
+            except Exception as e: recs[s] = {'success':False, 'error':str(e)}
+    el = time.perf_counter() - st
+    stages, totals, failed = {}, [], 0
+    acc = {'question':{}, 'kind':{}, 'megapixels':{}}
+    def tally(grp, key, ok):
+        c = acc[grp].setdefault(str(key), [0, 0]); c[0] += ok; c[1] += 1
+    for s in sheets:
+        rec = recs.get(s) or {}
+        with open(s[:-4] + '.json', 'r', encoding='utf-8') as f: gt = json.load(f)
+        got = {}
+        if rec.get('success') is not False and rec.get('resultPath'):
+            with open(rec['resultPath'], 'r', encoding='utf-8') as f: res = json.load(f)
+            got = {str(r['question']): r.get('answer') for r in worker.expand_answers(res)}
+            tm = res.get('meta', {}).get('timings') or {}
+            if tm.get('wallMs') is not None: totals.append(tm['wallMs'])
+            for k, v in (tm.get('stages') or {}).items(): stages.setdefault(k, []).append(v['wallMs'])
+        else: failed += 1
+        for q, want in gt['answers'].items():
+            ok = int(got.get(q) == want)
+            tally('question', q, ok); tally('kind', gt['kinds'][q], ok); tally('megapixels', gt['degradations']['megapixels'], ok)
+    rate = lambda c: round(c[0]/c[1], 4) if c[1] else None
+    qs = acc['question']; allc = [sum(c[0] for c in qs.values()), sum(c[1] for c in qs.values())]
+    rep = {'sheets':len(sheets), 'failed':failed, 'workers':a.workers, 'elapsedS':round(el, 3), 'sheetsPerSec':round((len(sheets)-failed)/el, 3) if el else None,
+           'peakRssMb':peak_rss_mb(), 'latencyMs':{'p50':pct(totals, 50), 'p95':pct(totals, 95), 'max':pct(totals, 100)},
+           'stagesMs':{k:{'p50':pct(v, 50), 'p95':pct(v, 95)} for k, v in stages.items()},
+           'accuracy':{'overall':rate(allc), 'byKind':{k:rate(c) for k, c in acc['kind'].items()},
+                       'byMegapixels':{k:rate(c) for k, c in acc['megapixels'].items()},
+                       'perQuestion':{q:rate(c) for q, c in sorted(qs.items(), key=lambda t: int(t[0]))}}}
+    if a.json:
+        with open(a.json, 'w', encoding='utf-8') as f: json.dump(rep, f, indent=2)
+    short = {**rep, 'accuracy':{**rep['accuracy'], 'perQuestion':None,
+             'worstQuestions':sorted(((q, r) for q, r in rep['accuracy']['perQuestion'].items() if r is not None and r < 1), key=lambda t: t[1])[:10]}}
+    print(json.dumps(short, indent=2))
+
+def main():
+    ap = argparse.ArgumentParser(description='Synthetic OMR benchmark')
+    sp = ap.add_subparsers(dest='cmd', required=True)
+    g = sp.add_parser('generate'); g.add_argument('outdir'); g.add_argument('-n', type=int, default=20)
+    g.add_argument('--template', default=DEFAULT_TEMPLATE); g.add_argument('--seed', type=int, default=1)
+    g.add_argument('--rotate', type=float, default=3.0, help='max rotation (degrees)')
+    g.add_argument('--skew', type=float, default=0.02, help='max corner jitter (fraction of page size)')
+    g.add_argument('--blur', type=float, default=1.0, help='max Gaussian blur sigma')
+    g.add_argument('--jpeg-quality', type=int, nargs=2, default=[70, 92], metavar=('MIN', 'MAX'))
+    g.add_argument('--faint', type=float, default=0.1, help='share of single marks drawn as faint pencil')
+    g.add_argument('--erasures', type=float, default=0.05, help='share of single marks with an erased second choice')
+    g.add_argument('--multi', type=float, default=0.05, help='share of questions with two marks')
+    g.add_argument('--blank', type=float, default=0.15, help='share of blank questions')
+    g.add_argument('--resolutions', type=int, nargs='+', default=[2, 5, 8, 12], help='camera megapixels to sample from')
+    r = sp.add_parser('run'); r.add_argument('sheets'); r.add_argument('--template', default=DEFAULT_TEMPLATE)
+    r.add_argument('--workers', type=int, default=1); r.add_argument('--outdir'); r.add_argument('--json')
+    # The API reads the first block only; the benchmark scores the whole sheet unless overridden.
+    r.add_argument('--env', action='append', default=['OMR_LIMIT_FIRST_BLOCK=0', 'OMR_MAX_QUESTIONS=0'], help='KEY=VALUE worker setting')
+    a = ap.parse_args()
+    generate(a) if a.cmd == 'generate' else run(a)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure a template's nominal bubble grid (config.bubbleGrid) offline from one clean scan
+Usage: python derive_grid.py <scan> [--template T] [--write]
+
+The scan is warped through its four corner markers exactly as worker.py does, its answer circles
+are found with Hough and each block is fitted to evenly spaced rows of choices (worker.derive_bubble_grid).
+Use a real scan of the printed form: bench.py's synthetic drawing would only reproduce its own layout.
+Without --write the grid is printed; with it the template JSON is rewritten. The worker only reads this grid.
+"""
+
+import sys, os, json, argparse
+from pathlib import Path
+
+os.environ.setdefault('OMR_ARTIFACTS', 'none')
+import cv2
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE))
+import worker
+
+DEFAULT_TEMPLATE = str(HERE / 'templates' / 'standard_156.json')
+
+def measure(src, tp):
+    """Bubble grid of one scan, or SystemExit with the reason it cannot be used."""
+    sg = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY) if src.ndim == 3 else src
+    M, _ = worker.rough_page_homography(sg, tp.pw, tp.ph)
+    F, _, warn, trusted = worker.fine_corner_homography(sg, M, tp.pw, tp.ph)
+    if not trusted: sys.exit(f'corner markers not verified ({warn}); use a flat, sharp scan')
+    gray = cv2.warpPerspective(sg, F @ M, (tp.pw, tp.ph))
+    pg = worker.PageContext(gray, tp, None, tp.qcols)
+    cir = worker.isolate_answer_circles(pg.circles, tp.pw, tp.ph)
+    blks = worker.split_into_blocks(cir, tp.pw, tp.qcols)
+    pg.answer_region(cir)
+    grid, why = worker.derive_bubble_grid(blks, pg.binary, tp)
+    if grid is None: sys.exit(f'no clean grid: {why}')
+    return grid
+
+def dump(o, ind=0):
+    """JSON in the template files' layout: 4-space indent, objects inside arrays on one line."""
+    pad, inner = ' '*ind, ' '*(ind+4)
+    if isinstance(o, dict) and o:
+        return '{\n' + ',\n'.join(f'{inner}{json.dumps(k)}: {dump(v, ind+4)}' for k, v in o.items()) + f'\n{pad}}}'
+    if isinstance(o, list) and o:
+        items = [('{ ' + ', '.join(f'{json.dumps(k)}: {json.dumps(v, ensure_ascii=False)}' for k, v in x.items()) + ' }')
+                 if isinstance(x, dict) else dump(x, ind+4) for x in o]
+        return '[\n' + ',\n'.join(inner + x for x in items) + f'\n{pad}]'
+    return json.dumps(o, ensure_ascii=False)
+
+def main():
+    ap = argparse.ArgumentParser(description='Derive bubbleGrid for an OMR template')
+    ap.add_argument('scan', help='clean scan of the printed form')
+    ap.add_argument('--template', default=DEFAULT_TEMPLATE); ap.add_argument('--write', action='store_true')
+    a = ap.parse_args()
+    with open(a.template, 'r', encoding='utf-8') as f: template = json.load(f)
+    cfg = template.get('config', template); cfg.pop('bubbleGrid', None)
+    tp = worker.CompiledTemplate(template).activate()
+    src = cv2.imread(a.scan)
+    if src is None: sys.exit(f'cannot read {a.scan}')
+    cfg['bubbleGrid'] = grid = measure(src, tp)
+    if not a.write: print(json.dumps(grid, indent=2)); return
+    with open(a.template, 'w', encoding='utf-8') as f: f.write(dump(template) + '\n')
+    print(f'{a.template}: bubbleGrid for {len(grid)} blocks')
+
+if __name__ == '__main__': main()
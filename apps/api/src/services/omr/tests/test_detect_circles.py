@@ -0,0 +1,37 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import bench, worker
+
+def column(x0, dx=42.0, y0=230.0, dy=36.47, rows=52):
+    """Page-pixel bubble centres of one answer column."""
+    return [(x0 + c*dx, y0 + r*dy) for r in range(rows) for c in range(5)]
+
+def test_column_retry_keeps_the_neighbours_circles(monkeypatch):
+    _, cfg = bench.load_config(bench.DEFAULT_TEMPLATE)
+    tp = worker.CompiledTemplate(cfg)
+    gray = np.full((tp.ph, tp.pw), 235, np.uint8)
+    sc = worker.DOWNSCALE_WIDTH / tp.pw
+    first, second, third = column(938.7), column(1180.0), column(1419.8)
+    y1 = max(0, int((tp.roi[1] - worker.HOUGH_ROI_PAD) * sc))
+    calls = []
+
+    def hough(img, *args, param2, **kw):
+        # The full pass misses the middle column. Its low-param2 retry sees the whole padded window, which
+        # also covers the first column's last choice, and places those circles less precisely.
+        x0 = max(0, int((tp.roi[0] - worker.HOUGH_ROI_PAD) * sc)) if not calls else max(0, int((tp.ranges[1]['x1'] - worker.HOUGH_ROI_PAD) * sc))
+        pts = first + third if not calls else [(x+5, y) for x, y in first] + second
+        pts = [p for p in pts if x0 <= p[0]*sc < x0 + img.shape[1]]
+        calls.append(param2)
+        return np.array([[(x*sc - x0, y*sc - y1, 14*sc) for x, y in pts]], np.float32)
+
+    monkeypatch.setattr(worker.cv2, 'HoughCircles', hough)
+    cir = worker.detect_circles(gray, tp=tp, ncols=tp.qcols)
+    assert len(calls) == 2 and calls[1] < calls[0]
+    xs = sorted(round(c[0]) for c in cir)
+    # Every bubble exactly once, and the first column keeps its full-param2 centres.
+    assert len(cir) == len(first) + len(second) + len(third)
+    assert xs.count(round(first[4][0])) == 52
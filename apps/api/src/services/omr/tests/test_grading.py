@@ -0,0 +1,44 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import worker
+
+KEY = {'1': 'A', '2': 'B', '3': 'C'}
+RESPONSES = [{'1': 'A', '2': 'B', '3': 'C'},
+             {'1': 'A', '2': 'B', '3': 'D'},
+             {'1': 'A', '2': 'C', '3': None},
+             {'1': 'B', '2': 'B'},
+             {'1': None, '2': 'A', '3': 'C', '9': 'E'}]
+
+def rest_correlation(responses, q):
+    """Pearson correlation of item q against the score on the other key questions, computed by hand."""
+    item = [float(r.get(q) == KEY[q]) for r in responses]
+    rest = [float(sum(r.get(o) == a for o, a in KEY.items() if o != q)) for r in responses]
+    return float(np.corrcoef(item, rest)[0, 1])
+
+def test_scores_count_only_key_questions():
+    g = worker.grade_responses(RESPONSES, KEY)
+    # Null, missing and off-key answers (question 9) are neither marked nor scored.
+    assert [(s['correct'], s['wrong'], s['empty']) for s in g['students']] == [(3, 0, 0), (2, 1, 0), (1, 1, 1), (1, 1, 1), (1, 1, 1)]
+    assert [s['percentage'] for s in g['students']] == [100, 67, 33, 33, 33]
+    assert all(s['total'] == 3 for s in g['students']) and g['summary']['items'] == 3
+
+def test_point_biserial_leaves_the_item_out_of_the_total():
+    items = {i['question']: i for i in worker.grade_responses(RESPONSES, KEY)['items']}
+    for q in KEY: assert items[int(q)]['pointBiserial'] == pytest.approx(rest_correlation(RESPONSES, q), abs=1e-4)
+    assert items[1]['difficulty'] == 0.6
+
+def test_constant_item_has_no_point_biserial():
+    g = worker.grade_responses([{'1': 'A', '2': 'B'}, {'1': 'A', '2': 'C'}], {'1': 'A', '2': 'B'})
+    assert g['items'][0]['pointBiserial'] is None and g['items'][0]['difficulty'] == 1.0
+
+def test_distractors_list_every_template_choice():
+    items = worker.grade_responses(RESPONSES, KEY, choices=list('ABCDE'))['items']
+    assert items[2]['distractors'] == {'A': 0, 'B': 0, 'C': 2, 'D': 1, 'E': 0, 'blank': 2}
+    # Without the template's choices only options somebody marked (or the key) get a column.
+    assert worker.grade_responses(RESPONSES, KEY)['choices'] == ['A', 'B', 'C', 'D', 'E']
+    assert worker.grade_responses([{'1': 'A'}], {'1': 'A'})['items'][0]['distractors'] == {'A': 1, 'blank': 0}
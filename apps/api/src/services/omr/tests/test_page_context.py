@@ -0,0 +1,33 @@
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import bench, worker
+
+def page():
+    """Template-sized white page with one printed ring left of the answer ROI; returns a pixel on the ring."""
+    _, cfg = bench.load_config(bench.DEFAULT_TEMPLATE)
+    tp = worker.CompiledTemplate(cfg)
+    gray = np.full((tp.ph, tp.pw), 235, np.uint8)
+    x = tp.roi[0] - worker.ANSWER_ROI_PAD - 60
+    cv2.circle(gray, (x, tp.ph // 2), 14, 40, 3)
+    return tp, gray, x + 14
+
+def test_binary_follows_the_answer_region():
+    tp, gray, x = page()
+    pg = worker.PageContext(gray, tp)
+    pg.answer_region([])
+    assert not pg.binary[tp.ph // 2, x]
+    # Circles found left of the ROI (the Hough fallback) widen the region: the binary is rebuilt for it.
+    pg.answer_region([(x, tp.ph // 2, 14)])
+    assert pg.binary[tp.ph // 2, x]
+
+def test_same_region_keeps_the_binary():
+    tp, gray, _ = page()
+    pg = worker.PageContext(gray, tp)
+    pg.answer_region([]); first = pg.binary
+    pg.answer_region([])
+    assert pg.binary is first
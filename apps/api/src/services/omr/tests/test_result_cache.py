@@ -0,0 +1,57 @@
+import json, os, sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import bench, worker
+
+TEMPLATE = bench.DEFAULT_TEMPLATE
+
+@pytest.fixture(scope='module')
+def sheet(tmp_path_factory):
+    """A 2 MP photo of a sheet with one mark per question."""
+    _, cfg = bench.load_config(TEMPLATE); rng = np.random.default_rng(7)
+    marks = {q: [('ABCDE'[q % 5], 40)] for q in bench.bubble_layout(cfg)}
+    p = tmp_path_factory.mktemp('sheet') / 'sheet.jpg'
+    p.write_bytes(bench.photograph(bench.render_page(cfg, {}, marks, rng), rng, bench.CAMERA_MP[2], 2.0, 0.01, 0.5, 90))
+    return str(p)
+
+@pytest.fixture
+def configure(tmp_path):
+    def apply(**env):
+        worker.configure({'OMR_CACHE_DIR': str(tmp_path / 'cache'), 'OMR_LIMIT_FIRST_BLOCK': '0', 'OMR_MAX_QUESTIONS': '0',
+                          'OMR_ARTIFACTS': 'preview', **env})
+    yield apply
+    worker.configure(os.environ)
+
+def read(sheet, outd):
+    os.makedirs(outd)
+    rec = worker.process(sheet, TEMPLATE, str(outd))
+    with open(rec['resultPath'], encoding='utf-8') as f: res = json.load(f)
+    with open(rec['previewPath'], 'rb') as f: res['preview'] = f.read()
+    return res
+
+def test_hit_returns_what_the_miss_computed(sheet, configure, tmp_path):
+    configure()
+    miss, hit = read(sheet, tmp_path / 'a'), read(sheet, tmp_path / 'b')
+    assert miss['meta']['cache']['hit'] is False and hit['meta']['cache']['hit'] is True
+    for k in ('answers', 'summary', 'anchors', 'preview'): assert hit[k] == miss[k]
+    assert hit['meta']['geometry'] == miss['meta']['geometry']
+
+def test_settings_that_change_the_read_miss(sheet, configure, tmp_path):
+    configure(); full = read(sheet, tmp_path / 'a')
+    # Hough instead of the projected grid, and a preview-only request, are separate entries.
+    configure(OMR_GEOMETRY='hough'); hough = read(sheet, tmp_path / 'b')
+    assert hough['meta']['cache']['hit'] is False and hough['meta']['geometry']['path'] == 'hough'
+    configure(OMR_PREVIEW_ONLY='1'); pv = read(sheet, tmp_path / 'c')
+    assert pv['meta']['cache']['hit'] is False and pv['answers'] == []
+    configure(); again = read(sheet, tmp_path / 'd')
+    assert again['meta']['cache']['hit'] is True and again['answers'] == full['answers']
+
+def test_a_changed_worker_misses(sheet, configure, tmp_path, monkeypatch):
+    configure(); read(sheet, tmp_path / 'a')
+    # Any edit to worker.py changes its source digest, whether or not VERSION was bumped.
+    monkeypatch.setattr(worker, 'CODE_DIGEST', '0' * 40)
+    assert read(sheet, tmp_path / 'b')['meta']['cache']['hit'] is False
@@ -3,16 +3,31 @@
 """
 OMR Worker v22 - Bounded CLAHE + Gray-Consensus
 Usage: python worker.py <input_file> <template_json> <output_dir>
+       python worker.py pages <input_pdf_or_tiff> <template_json> <output_dir>
+       python worker.py batch <manifest_or_dir> <template_json> <output_dir> [--workers N] [--key <answer_key_json>]
+       python worker.py grade < {"key": {...}, "responses": [...]}
+       python worker.py serve [--socket <path>]
 """
 
-import sys, os, json, time, traceback
+import sys, os, json, time, traceback, struct, random, hashlib, threading
 from pathlib import Path
+from types import MappingProxyType
 
 if sys.platform == 'win32':
     import io
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
 
+SERVE_MODE = len(sys.argv) > 1 and sys.argv[1] == 'serve'
+# Reported as meta.version. The result cache keys on the source digest too, so any edit to this file
+# invalidates cached reads even when the version string is not bumped.
+VERSION = 'v22'
+with open(__file__, 'rb') as _f: CODE_DIGEST = hashlib.sha1(_f.read()).hexdigest()
+if SERVE_MODE:
+    # Frames own the real stdout; anything else (import notices, C-level logs) goes to stderr.
+    FRAME_OUT = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+
 try:
     import cv2
     import numpy as np
@@ -25,38 +40,322 @@ try:
 except ImportError:
     fitz = None
 
-DEBUG = os.environ.get('OMR_DEBUG', '0') == '1'
-STRICT = os.environ.get('OMR_STRICT', '1') != '0'
-PREVIEW_ONLY = os.environ.get('OMR_PREVIEW_ONLY', '0') == '1'
-USE_GRID = os.environ.get('OMR_USE_GRID', '0') == '1'
+def configure(env):
+    """(Re)load env-driven settings; serve mode calls this per request."""
+    global DEBUG, STRICT, PREVIEW_ONLY, USE_GRID, FAINT_MODE, LIMIT_FIRST_BLOCK, MAX_QUESTIONS, OVERRIDE_CORNERS, ANCHORS, RESCUE
+    global ARTIFACTS, ARTIFACT_FORMAT, ARTIFACT_QUALITY, ARTIFACT_SCALE, COLOR_ARTIFACTS, DEBUG_ON_ISSUE, DEBUG_SAMPLE, PROFILE, GEOMETRY
+    global RESULT_FORMAT, CACHE_DIR, CACHE_MB, BLOCK_THREADS, DECODE, MEMORY_BUDGET_MB
+    DEBUG = env.get('OMR_DEBUG', '0') == '1'
+    STRICT = env.get('OMR_STRICT', '1') != '0'
+    PREVIEW_ONLY = env.get('OMR_PREVIEW_ONLY', '0') == '1'
+    USE_GRID = env.get('OMR_USE_GRID', '0') == '1'
+    FAINT_MODE = env.get('OMR_FAINT', '0') == '1'
+    LIMIT_FIRST_BLOCK = env.get('OMR_LIMIT_FIRST_BLOCK', '1') == '1'
+    MAX_QUESTIONS = int(env.get('OMR_MAX_QUESTIONS', '0') or 0)
+    OVERRIDE_CORNERS = env.get('OMR_CORNERS')
+    ANCHORS = env.get('OMR_ANCHORS')
+    RESCUE = env.get('OMR_RESCUE', '0') == '1'
+    # Artifact policy: all | preview | none; png | jpg | webp; scale <= 1 downsizes before encoding.
+    ARTIFACTS = env.get('OMR_ARTIFACTS', 'all').lower()
+    ARTIFACT_FORMAT = {'jpeg':'jpg'}.get(env.get('OMR_ARTIFACT_FORMAT', 'png').lower(), env.get('OMR_ARTIFACT_FORMAT', 'png').lower())
+    ARTIFACT_QUALITY = int(env.get('OMR_ARTIFACT_QUALITY', '85') or 85)
+    ARTIFACT_SCALE = min(1.0, max(0.05, float(env.get('OMR_ARTIFACT_SCALE', '1') or 1)))
+    # 0 renders warped/preview artifacts from the grayscale page and skips the colour warp.
+    COLOR_ARTIFACTS = env.get('OMR_ARTIFACT_COLOR', '1') != '0'
+    # Debug captures: OMR_DEBUG=1 keeps them for every sheet; OMR_DEBUG_ON_ISSUE / OMR_DEBUG_SAMPLE alone keep them
+    # only for sheets with issues and/or a sampled percentage. Never written under OMR_ARTIFACTS=none.
+    DEBUG_ON_ISSUE = env.get('OMR_DEBUG_ON_ISSUE', '0') == '1'
+    DEBUG_SAMPLE = float(env.get('OMR_DEBUG_SAMPLE', '0') or 0)
+    # cProfile dump per sheet: '1' writes profile.pstats next to result.json, any other value is a directory.
+    PROFILE = env.get('OMR_PROFILE', '')
+    # auto: trusted corners + known bubble grid skip Hough (project_blocks); hough: always detect circles.
+    GEOMETRY = env.get('OMR_GEOMETRY', 'auto').lower()
+    # full: indented result.json with one dict per answer; compact: unindented, answers as columns.
+    RESULT_FORMAT = env.get('OMR_RESULT_FORMAT', 'full').lower()
+    # On-disk result cache keyed by image bytes + template + output-affecting settings; empty disables it.
+    CACHE_DIR = env.get('OMR_CACHE_DIR', '')
+    CACHE_MB = float(env.get('OMR_CACHE_MB', '256') or 256)
+    # Threads scoring a sheet's answer blocks concurrently; 1 = serial. The default shares the CPUs with the
+    # sibling processes reading other sheets (OMR_WORKER_PROCS, set by the API pool; batch mode caps it itself);
+    # a serve process that was not told how many siblings it has stays serial.
+    procs = int(env.get('OMR_WORKER_PROCS', '') or 0) or (0 if SERVE_MODE else 1)
+    BLOCK_THREADS = max(1, int(env.get('OMR_BLOCK_THREADS', '') or (min(4, (os.cpu_count() or 1) // procs) if procs else 1)))
+    # auto: grayscale source when no colour artifact is kept, reduced decode (IMREAD_REDUCED_*, PDF render DPI)
+    # while the page still covers the template; full: always full-size colour.
+    DECODE = env.get('OMR_DECODE', 'auto').lower()
+    # Peak-RSS budget per sheet in MB (0 = none): the source is decoded further reduced until the estimate fits.
+    MEMORY_BUDGET_MB = float(env.get('OMR_MEMORY_BUDGET_MB', '0') or 0)
+
+configure(os.environ)
+
+class StageTimer:
+    """Lap timer for one sheet: wall/CPU ms per stage (summed across blocks) plus hot-path counters."""
+    def __init__(self, cpu=time.process_time):
+        self.cpu = cpu; self.lock = threading.Lock()
+        self.w0 = self.w = time.perf_counter(); self.c0 = self.c = cpu()
+        self.stages, self.counters = {}, {}
+
+    def add(self, name, wall, cpu):
+        s = self.stages.setdefault(name, {'wallMs':0.0,'cpuMs':0.0,'calls':0})
+        s['wallMs'] += wall*1000; s['cpuMs'] += cpu*1000; s['calls'] += 1
+
+    def lap(self, name):
+        w, c = time.perf_counter(), self.cpu()
+        self.add(name, w-self.w, c-self.c); self.w, self.c = w, c
+
+    def skip(self):
+        """Start the next lap now, without booking the time since the last one."""
+        self.w, self.c = time.perf_counter(), self.cpu()
+
+    def merge(self, other):
+        """Fold another timer's stages in (per-block timers from worker threads)."""
+        for k, v in other.stages.items():
+            s = self.stages.setdefault(k, {'wallMs':0.0,'cpuMs':0.0,'calls':0})
+            for f in s: s[f] += v[f]
+
+    def timed(self, name, fn, *args):
+        """Run fn under its own stage name; the enclosing lap does not include it."""
+        w, c = time.perf_counter(), self.cpu()
+        r = fn(*args)
+        dw, dc = time.perf_counter()-w, self.cpu()-c
+        self.add(name, dw, dc); self.w += dw; self.c += dc
+        return r
+
+    def count(self, name, n=1):
+        with self.lock: self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def report(self):
+        # cpuMs is process CPU time, so it includes OpenCV's own threads.
+        return {'wallMs':round((time.perf_counter()-self.w0)*1000, 2), 'cpuMs':round((self.cpu()-self.c0)*1000, 2),
+                'stages':{k:{'wallMs':round(v['wallMs'], 2),'cpuMs':round(v['cpuMs'], 2),'calls':v['calls']} for k,v in self.stages.items()},
+                'counters':dict(self.counters)}
+
+TIMER = StageTimer()
 
 DEFAULT_PAGE_W, DEFAULT_PAGE_H = 1700, 2200
 HOUGH_DP, HOUGH_MIN_DIST, HOUGH_PARAM1, HOUGH_PARAM2 = 1.2, 16, 120, 22
 HOUGH_MIN_RADIUS, HOUGH_MAX_RADIUS, DOWNSCALE_WIDTH = 6, 16, 1200
+HOUGH_ROI_PAD, HOUGH_RETRY_FILL = 48, 0.6
+# Page outline / corner squares are searched on reduced copies, then corners are re-located at full resolution.
+PAGE_DETECT_WIDTH, CORNER_DETECT_SCALE, CORNER_REFINE_WIN = 1000, 0.5, 40
 ROWS_PER_BLOCK, CHOICES_PER_ROW, EXPECTED_QUESTION_COUNT = 52, 5, 156
 ANSWER_X_RATIO_PRIMARY, ANSWER_X_RATIO_FALLBACK = 0.52, 0.45
 MARK_TH_FLOOR, MARGIN_TH_FLOOR, Z_TH_OK, Z_TH_FAINT = 0.03, 0.01, 1.1, 1.6  # Loosen thresholds for faint marks
 MIN_STRONG_MARKS_FOR_FAINT, MIN_STRONG_FOR_EMPTY_BLOCK = 1, 5  # Raise empty-block threshold
-FAINT_MODE = os.environ.get('OMR_FAINT', '0') == '1'
-LIMIT_FIRST_BLOCK = os.environ.get('OMR_LIMIT_FIRST_BLOCK', '1') == '1'
-MAX_QUESTIONS = int(os.environ.get('OMR_MAX_QUESTIONS', '0') or 0)
-OVERRIDE_CORNERS = os.environ.get('OMR_CORNERS')
-ANCHORS = os.environ.get('OMR_ANCHORS')
 TOP_ROWS_COUNT, DY_CANDIDATES, TOP_ROWS_MIN_SUM = 16, [-22,-18,-14,-10,-6,-2,0,2,6,10,14,18,22], 0.3
 RESCUE_DX, RESCUE_DY = [-6,-4,-2,0,2,4,6], [-6,-4,-2,0,2,4,6]
 RESCUE_R_SCALES = [0.92, 1.00, 1.08]
 CELL_MARGIN = 0.18
 
-def load_image(p):
+QUESTION_COLUMNS = 3
+
+class CompiledTemplate:
+    """Template parsed once into the numbers and grid geometry every sheet reuses."""
+
+    def __init__(self, template):
+        self.template = template
+        # Content version of the template: result cache entries of an edited template never match.
+        self.digest = hashlib.sha1(json.dumps(template, sort_keys=True).encode('utf-8')).hexdigest()
+        cfg = self.cfg = template.get('config', template)
+        self.key = template.get('key', 'unknown')
+        self.pw = cfg.get('page',{}).get('width', DEFAULT_PAGE_W); self.ph = cfg.get('page',{}).get('height', DEFAULT_PAGE_H)
+        self.choices = list(cfg.get('choices', ['A','B','C','D','E']))
+        self.qcols = max(1, min(6, int(cfg.get('questionColumns', 3) or 3)))
+        self.rows_per_block = int(cfg.get('rowsPerBlock', 52) or 52)
+        self.expected = int(cfg.get('expectedQuestionCount', self.qcols * self.rows_per_block) or self.qcols * self.rows_per_block)
+        self.threshold = float(cfg.get('threshold', 0.22) or 0.22)
+        self.min_fill_delta = float(cfg.get('minFillDelta', 0.12) or 0.12)
+        self.roi, self.ranges = self.template_ranges()
+        self.cells = grid_cells(self.ranges, self.roi, len(self.choices), self.rows_per_block, self.expected)
+        # Nominal bubble grid per block ({'x': [...], 'y0', 'dy', 'r', optional 'ring' = printed outline radius}),
+        # declared in the template (derive_grid.py measures it from a clean scan). Read-only: every sheet of every
+        # process sees the same geometry.
+        self.bubble_grid = tuple(MappingProxyType({**g, 'x': tuple(g['x'])}) for g in cfg.get('bubbleGrid') or ()) or None
+
+    def requested_blocks(self):
+        """Leading answer columns that can reach the result under OMR_MAX_QUESTIONS / OMR_LIMIT_FIRST_BLOCK."""
+        n = MAX_QUESTIONS if MAX_QUESTIONS > 0 else (self.rows_per_block if LIMIT_FIRST_BLOCK else self.expected)
+        if LIMIT_FIRST_BLOCK: n = min(n, self.rows_per_block)
+        return max(1, min(self.qcols, -(-n // self.rows_per_block)))
+
+    def block_rows(self, i):
+        return max(0, min(self.rows_per_block, self.expected - i * self.rows_per_block))
+
+    def template_ranges(self):
+        """ROI rectangle and per-column ranges in page pixels from roiX/Y/W/H and columnRanges."""
+        cfg, pw, ph, qcols = self.cfg, self.pw, self.ph, self.qcols
+        roi_left = int(round(clamp01(float(cfg.get('roiX', 0.0))) * pw))
+        roi_top = int(round(clamp01(float(cfg.get('roiY', 0.0))) * ph))
+        roi_right = roi_left + int(round(clamp01(float(cfg.get('roiW', 1.0))) * pw))
+        roi_bottom = roi_top + int(round(clamp01(float(cfg.get('roiH', 1.0))) * ph))
+        roi_left = max(0, min(pw - 2, roi_left))
+        roi_top = max(0, min(ph - 2, roi_top))
+        roi_right = max(roi_left + 2, min(pw, roi_right))
+        roi_bottom = max(roi_top + 2, min(ph, roi_bottom))
+
+        col_ranges = cfg.get('columnRanges') or []
+        if not isinstance(col_ranges, list) or len(col_ranges) != qcols:
+            col_ranges = [{'start': i / qcols, 'end': (i + 1) / qcols, 'top': 0, 'bottom': 1} for i in range(qcols)]
+        roi_w = roi_right - roi_left
+        roi_h = roi_bottom - roi_top
+        ranges_px = []
+        for cr in col_ranges:
+            start = clamp01(cr.get('start', 0))
+            end = clamp01(cr.get('end', 1))
+            top = clamp01(cr.get('top', 0))
+            bottom = clamp01(cr.get('bottom', 1))
+            if end <= start:
+                end = min(1.0, start + 0.02)
+            if bottom <= top:
+                bottom = min(1.0, top + 0.02)
+            ranges_px.append({
+                'x1': roi_left + roi_w * start,
+                'x2': roi_left + roi_w * end,
+                'y1': roi_top + roi_h * top,
+                'y2': roi_top + roi_h * bottom,
+            })
+        return (roi_left, roi_top, roi_right, roi_bottom), ranges_px
+
+    def activate(self):
+        """Point the block constants used by the circle path at this template."""
+        global ROWS_PER_BLOCK, CHOICES_PER_ROW, EXPECTED_QUESTION_COUNT, QUESTION_COLUMNS
+        ROWS_PER_BLOCK, CHOICES_PER_ROW = self.rows_per_block, len(self.choices)
+        EXPECTED_QUESTION_COUNT, QUESTION_COLUMNS = self.expected, self.qcols
+        return self
+
+_TEMPLATES = {}
+
+def load_template(tmpl):
+    """Compile a template (inline JSON or file path), cached by path + mtime."""
+    try: key = (tmpl, os.path.getmtime(tmpl))
+    except (OSError, ValueError): key = (tmpl, None)
+    if key in _TEMPLATES: return _TEMPLATES[key]
+    try: template = json.loads(tmpl)
+    except ValueError:
+        with open(tmpl,'r',encoding='utf-8') as f: template = json.load(f)
+    if len(_TEMPLATES) >= 16: _TEMPLATES.clear()
+    _TEMPLATES[key] = tp = CompiledTemplate(template)
+    return tp
+
+TIFF_EXTS = ('.tif', '.tiff')
+
+# Peak-estimate weights: bytes per decoded source pixel (image plus decoder scratch; colour adds the gray copy),
+# bytes per template-page pixel alive after the warp (gray, binary, CLAHE, block fields; the colour page and
+# preview add 6), and the reduction a budget may force at most (past half the template size bubbles blur together).
+SOURCE_BYTES_PER_PX = {True: 2, False: 5}
+PAGE_BYTES_PER_PX = 6
+BUDGET_MIN_PAGE = 0.5
+REDUCED_FLAGS = {(1, False): cv2.IMREAD_COLOR, (2, False): cv2.IMREAD_REDUCED_COLOR_2, (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+                 (8, False): cv2.IMREAD_REDUCED_COLOR_8, (1, True): cv2.IMREAD_GRAYSCALE, (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                 (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4, (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+def rss_mb(field='VmRSS'):
+    """Current (VmRSS) or peak (VmHWM) resident set in MB; ru_maxrss where /proc is unavailable."""
+    try:
+        with open('/proc/self/status') as f:
+            for l in f:
+                if l.startswith(field+':'): return round(int(l.split()[1]) / 1024, 1)
+    except OSError: pass
+    import resource
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 1024), 1)
+
+def reset_peak_rss():
+    """Restart the kernel's peak-RSS mark (VmHWM) so it covers one sheet; False where that is not possible."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f: f.write('5')
+        return True
+    except OSError: return False
+
+def image_size(head):
+    """(w, h) from the first bytes of a PNG or JPEG, None for anything else."""
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and len(head) >= 24: return struct.unpack('>II', head[16:24])
+    if head[:2] != b'\xff\xd8': return None
+    i = 2
+    while i + 9 < len(head):
+        if head[i] != 0xFF: i += 1; continue
+        m = head[i+1]
+        if m == 0xFF or m == 0x01 or 0xD0 <= m <= 0xD8: i += 1 if m == 0xFF else 2; continue
+        if 0xC0 <= m <= 0xCF and m not in (0xC4, 0xC8, 0xCC):
+            h, w = struct.unpack('>HH', head[i+5:i+9]); return w, h
+        i += 2 + struct.unpack('>H', head[i+2:i+4])[0]
+    return None
+
+def wants_color():
+    """Whether a kept artifact (warped page or preview) is drawn from the colour source."""
+    return COLOR_ARTIFACTS and ARTIFACTS in ('all', 'preview')
+
+def decode_plan(size, tp, color=True):
+    """
+    How to decode a w x h source: {'size', 'reduce', 'gray', 'estimateMb'}. Reduction halves the source while
+    both sides still cover the template page; a budget then halves further (down to BUDGET_MIN_PAGE of the page).
+    """
+    auto = DECODE == 'auto'
+    plan = {'size': list(size) if size else None, 'reduce': 1, 'gray': auto and not color}
+    if not (auto and size and tp): return plan
+    (lo, hi), (plo, phi) = sorted(size), sorted((tp.pw, tp.ph))
+    f = 1
+    while f < 8 and lo >= plo*f*2 and hi >= phi*f*2: f *= 2
+    if MEMORY_BUDGET_MB > 0:
+        base, bpp = rss_mb(), SOURCE_BYTES_PER_PX[plan['gray']]
+        est = lambda f: base + ((size[0]//f)*(size[1]//f)*bpp + tp.pw*tp.ph*(PAGE_BYTES_PER_PX + 6*(not plan['gray']))) / 2**20
+        while f < 8 and est(f) > MEMORY_BUDGET_MB and hi >= phi*f*2*BUDGET_MIN_PAGE: f *= 2
+        plan['estimateMb'] = round(est(f), 1)
+    plan['reduce'] = f
+    return plan
+
+def iter_pages(p, tp=None, color=True):
+    """
+    Yield (page_index, image, decode plan) one page at a time; plain images yield a single page. Without a
+    template (or with OMR_DECODE=full) pages are full-size BGR, PDFs rendered at 200 dpi.
+    """
     ext = Path(p).suffix.lower()
     if ext == '.pdf':
         if not fitz: raise RuntimeError("PyMuPDF not installed")
-        doc = fitz.open(p); pix = doc.load_page(0).get_pixmap(dpi=200)
-        img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
-        img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGR if pix.n==4 else cv2.COLOR_RGB2BGR); doc.close(); return img
-    img = cv2.imread(p)
+        doc = fitz.open(p)
+        try:
+            for i in range(doc.page_count):
+                pg = doc.load_page(i); r = pg.rect
+                # The DPI that renders the page at the template's pixel size.
+                dpi = 200 if not tp or DECODE != 'auto' else min(600, max(72, 72*max(max(tp.pw, tp.ph)/max(r.width, r.height), min(tp.pw, tp.ph)/min(r.width, r.height))))
+                plan = decode_plan((round(r.width*dpi/72), round(r.height*dpi/72)), tp, color)
+                pix = pg.get_pixmap(dpi=round(dpi/plan['reduce']), colorspace=fitz.csGRAY if plan['gray'] else fitz.csRGB, alpha=False)
+                img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+                img = img[:, :, 0].copy() if pix.n == 1 else cv2.cvtColor(img, cv2.COLOR_RGB2BGR); del pix
+                yield i, img, plan
+        finally: doc.close()
+        return
+    if ext in TIFF_EXTS:
+        n = cv2.imcount(p)
+        if n <= 0: raise RuntimeError(f"Cannot read: {p}")
+        gray = DECODE == 'auto' and not color
+        for i in range(n):
+            ok, mats = cv2.imreadmulti(p, start=i, count=1, flags=cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR)
+            if not ok or not mats: raise RuntimeError(f"Cannot read page {i+1}: {p}")
+            img = mats[0]; del mats
+            # Multi-page readers have no reduced decode: shrink right after decoding instead.
+            plan = decode_plan(img.shape[1::-1], tp, color)
+            if plan['reduce'] > 1: img = cv2.resize(img, None, fx=1/plan['reduce'], fy=1/plan['reduce'], interpolation=cv2.INTER_AREA)
+            yield i, img, plan
+        return
+    with open(p, 'rb') as f: head = f.read(1 << 16)
+    plan = decode_plan(image_size(head), tp, color)
+    img = cv2.imread(p, REDUCED_FLAGS[plan['reduce'], plan['gray']])
     if img is None: raise RuntimeError(f"Cannot read: {p}")
-    return img
+    yield 0, img, plan
+
+def decode_image(data, tp=None, color=True):
+    """Decode an encoded image (JPEG/PNG/...) received as bytes; returns (image, decode plan)."""
+    plan = decode_plan(image_size(bytes(data[:1 << 16])), tp, color)
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), REDUCED_FLAGS[plan['reduce'], plan['gray']])
+    if img is None: raise RuntimeError("Cannot decode image bytes")
+    return img, plan
+
+def load_image(p, tp=None, color=True):
+    """First page of a file as (image, decode plan)."""
+    pages = iter_pages(p, tp, color)
+    try: return next(pages)[1:]
+    except StopIteration: raise RuntimeError(f"No pages: {p}")
+    finally: pages.close()
 
 def order_points(pts):
     pts = np.array(pts, dtype=np.float32); rect = np.zeros((4,2), dtype=np.float32)
@@ -64,20 +363,21 @@ def order_points(pts):
     d = np.diff(pts, axis=1); rect[1], rect[3] = pts[np.argmin(d)], pts[np.argmax(d)]
     return rect
 
-def rough_page_warp(img, tw, th, dd=None):
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape)==3 else img
+def rough_page_homography(src, tw, th):
+    """
+    Source -> page homography from the largest 4-point contour (whole image if none), searched on a copy
+    scaled to PAGE_DETECT_WIDTH. Returns (homography, scale used).
+    """
+    ps = min(1.0, PAGE_DETECT_WIDTH / src.shape[1])
+    gray = cv2.resize(src, None, fx=ps, fy=ps, interpolation=cv2.INTER_AREA) if ps < 1.0 else src
     bl = cv2.GaussianBlur(gray,(5,5),0); ed = cv2.dilate(cv2.Canny(bl,50,150), cv2.getStructuringElement(cv2.MORPH_RECT,(3,3)), iterations=2)
     cnt,_ = cv2.findContours(ed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if not cnt: return img, False
     pc = None
     for c in sorted(cnt, key=cv2.contourArea, reverse=True)[:5]:
         ap = cv2.approxPolyDP(c, 0.02*cv2.arcLength(c,True), True)
         if len(ap)==4: pc = ap.reshape(4,2); break
     if pc is None: h,w = gray.shape[:2]; pc = np.array([[0,0],[w,0],[w,h],[0,h]], dtype=np.float32)
-    M = cv2.getPerspectiveTransform(order_points(pc), np.array([[0,0],[tw,0],[tw,th],[0,th]], dtype=np.float32))
-    wp = cv2.warpPerspective(img, M, (tw,th))
-    if dd: cv2.imwrite(os.path.join(dd,'02_warped.png'), wp)
-    return wp, True
+    return cv2.getPerspectiveTransform(order_points(pc) / ps, np.array([[0,0],[tw,0],[tw,th],[0,th]], dtype=np.float32)), ps
 
 def find_corner_marker(roi, corner, min_area=500):
     _,th = cv2.threshold(roi, 80, 255, cv2.THRESH_BINARY_INV)
@@ -98,19 +398,19 @@ def find_corner_marker(roi, corner, min_area=500):
     if not cand: return None
     return sorted(cand, key=lambda x:x[2], reverse=True)[0][:2]
 
-def apply_override_corners(img, pw, ph, corners, dd=None):
+def override_homography(img, pw, ph, corners, reduce=1):
     try:
         oc = np.array(corners, dtype=np.float32)
-        # If normalized 0-1, scale by image size
+        # If normalized 0-1, scale by image size; source pixels follow a reduced decode
         h, w = img.shape[:2]
         if oc.max() <= 1.5:
             oc[:, 0] *= w
             oc[:, 1] *= h
+        else:
+            oc /= reduce
         src = order_points(oc)
         dst = np.array([[0,0],[pw,0],[pw,ph],[0,ph]], dtype=np.float32)
-        wf = cv2.warpPerspective(img, cv2.getPerspectiveTransform(src,dst), (pw,ph))
-        if dd: cv2.imwrite(os.path.join(dd,'01_override_warp.png'), wf)
-        return wf, True, None
+        return cv2.getPerspectiveTransform(src,dst), True, None
     except Exception as e:
         return None, False, f"override_failed:{e}"
 
@@ -134,9 +434,38 @@ def normalize_anchor_payload(payload, pw, ph):
         out[key] = [x, y]
     return out or None
 
-def fine_warp_with_corners(wp, tw, th, dd=None):
-    gray = cv2.cvtColor(wp, cv2.COLOR_BGR2GRAY) if len(wp.shape)==3 else wp
-    h,w = gray.shape
+def refine_corner_square(src, M, pt, win=CORNER_REFINE_WIN):
+    """
+    Re-locate a corner square centre (rough page coords) in a full-resolution window warped from the source.
+    Returns (x, y, refined); the coarse point comes back unrefined when no whole square is in the window.
+    """
+    x0, y0 = int(round(pt[0])) - win, int(round(pt[1])) - win
+    T = np.array([[1,0,-x0],[0,1,-y0],[0,0,1]], dtype=np.float64)
+    patch = cv2.warpPerspective(src, T @ M, (2*win, 2*win), borderMode=cv2.BORDER_CONSTANT, borderValue=255)
+    _, thb = cv2.threshold(patch, 0, 255, cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)
+    cnt,_ = cv2.findContours(thb, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    best = None
+    for c in cnt:
+        if cv2.contourArea(c) < 150: continue
+        x,y,bw,bh = cv2.boundingRect(c)
+        # A square cut by the window edge would give a shifted centre; keep the coarse point then.
+        if not (0.7 <= bw/float(bh) <= 1.4) or x == 0 or y == 0 or x+bw >= 2*win or y+bh >= 2*win: continue
+        cx, cy = x + bw/2, y + bh/2
+        d = (cx-win)**2 + (cy-win)**2
+        if best is None or d < best[0]: best = (d, x0+cx, y0+cy)
+    return (best[1], best[2], True) if best else (float(pt[0]), float(pt[1]), False)
+
+def fine_corner_homography(src, M, tw, th, dd=None):
+    """
+    Rough page -> final page homography from the four corner markers, or None if they are not all found.
+    Markers are searched on the rough page warped at CORNER_DETECT_SCALE and refined at full resolution.
+    Returns (homography, found, warning, trusted); trusted means all four were re-found as squares at full resolution.
+    """
+    ds = CORNER_DETECT_SCALE
+    w, h = int(round(tw*ds)), int(round(th*ds))
+    gray = cv2.warpPerspective(src, np.diag([ds, ds, 1.0]) @ M, (w, h))
+    if dd: dd.debug('02_warped', gray)
+    amin = ds*ds
 
     def detect_corner_squares():
         _, thb = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)
@@ -144,7 +473,7 @@ def fine_warp_with_corners(wp, tw, th, dd=None):
         res = {'tl':None,'tr':None,'br':None,'bl':None}
         for c in cnt:
             a = cv2.contourArea(c)
-            if a < 300: continue
+            if a < 300*amin: continue
             x,y,bw,bh = cv2.boundingRect(c)
             ar = bw/float(bh)
             if ar < 0.7 or ar > 1.3: continue
@@ -163,33 +492,61 @@ def fine_warp_with_corners(wp, tw, th, dd=None):
     # Try robust square detection first
     sq = detect_corner_squares()
     if sq:
-        src = order_points(np.array(sq, dtype=np.float32))
+        pts = order_points(np.array(sq, dtype=np.float32))
     else:
         # Fallback to inner corner marker search
         rw,rh = int(w*0.15), int(h*0.12)
         found = []
         for rx,ry,cn in [(0,0,'tl'),(w-rw,0,'tr'),(w-rw,h-rh,'br'),(0,h-rh,'bl')]:
-            res = find_corner_marker(gray[ry:ry+rh,rx:rx+rw], cn)
+            res = find_corner_marker(gray[ry:ry+rh,rx:rx+rw], cn, 500*amin)
             found.append((rx+res[0],ry+res[1]) if res else None)
-        if None in found: return wp, False, "corners missing"
-        src = np.array(found, dtype=np.float32)
+        if None in found: return None, False, "corners missing", False
+        pts = np.array(found, dtype=np.float32)
 
+    ref = [refine_corner_square(src, M, p) for p in pts / ds]
+    pts = np.array([p[:2] for p in ref], dtype=np.float32)
     mx,my = int(tw*0.03), int(th*0.03)
     dst = np.array([[mx,my],[tw-mx,my],[tw-mx,th-my],[mx,th-my]], dtype=np.float32)
-    wf = cv2.warpPerspective(wp, cv2.getPerspectiveTransform(src,dst), (tw,th))
-    if dd: cv2.imwrite(os.path.join(dd,'04_final.png'), wf)
-    return wf, True, None
+    return cv2.getPerspectiveTransform(pts,dst), True, None, all(p[2] for p in ref)
 
-def detect_circles(gray, dd=None):
+def detect_circles(gray, dd=None, tp=None, ncols=None):
+    """
+    Hough circles inside the template's answer ROI (padded by HOUGH_ROI_PAD; whole page without a template),
+    cut after the first ncols answer columns when fewer are needed.
+    Columns that come back with fewer than HOUGH_RETRY_FILL of their bubbles are re-run alone with a lower
+    param2 instead of repeating the whole transform.
+    """
     h,w = gray.shape; sc = DOWNSCALE_WIDTH/w
     sm = cv2.resize(gray, (DOWNSCALE_WIDTH, int(h*sc)), interpolation=cv2.INTER_AREA)
-    def run_hough(p2):
-        return cv2.HoughCircles(cv2.GaussianBlur(sm,(5,5),0), cv2.HOUGH_GRADIENT, dp=HOUGH_DP, minDist=max(int(HOUGH_MIN_DIST*sc),8), param1=HOUGH_PARAM1, param2=p2, minRadius=max(int(HOUGH_MIN_RADIUS*sc),4), maxRadius=max(int(HOUGH_MAX_RADIUS*sc),10))
-    cir = run_hough(HOUGH_PARAM2)
-    if cir is None or len(cir[0]) < 300:
-        cir = run_hough(max(10, int(HOUGH_PARAM2*0.7)))
-    if cir is None: return []
-    return [(cx/sc, cy/sc, r/sc) for cx,cy,r in cir[0]]
+    sh, sw = sm.shape
+    def span(a, b, n): return max(0, int((a-HOUGH_ROI_PAD)*sc)), min(n, int(np.ceil((b+HOUGH_ROI_PAD)*sc)))
+    ncols = min(ncols or tp.qcols, tp.qcols) if tp else None
+    x1, x2 = span(tp.roi[0], tp.roi[2] if ncols == tp.qcols else tp.ranges[ncols-1]['x2'], sw) if tp else (0, sw)
+    y1, y2 = span(tp.roi[1], tp.roi[3], sh) if tp else (0, sh)
+    bl = cv2.GaussianBlur(sm[y1:y2], (5,5), 0)
+    def run_hough(p2, a, b):
+        cir = cv2.HoughCircles(bl[:, a:b], cv2.HOUGH_GRADIENT, dp=HOUGH_DP, minDist=max(int(HOUGH_MIN_DIST*sc),8), param1=HOUGH_PARAM1, param2=p2, minRadius=max(int(HOUGH_MIN_RADIUS*sc),4), maxRadius=max(int(HOUGH_MAX_RADIUS*sc),10))
+        return [] if cir is None else [(cx+a, cy+y1, r) for cx,cy,r in cir[0]]
+    low = max(10, int(HOUGH_PARAM2*0.7))
+    cir = run_hough(HOUGH_PARAM2, x1, x2)
+    if not tp:
+        if len(cir) < 300: TIMER.count('hough_retries'); cir = run_hough(low, x1, x2)
+    else:
+        rs = tp.ranges
+        for i, rng in enumerate(rs[:ncols]):
+            a, b = span(rng['x1'], rng['x2'], sw)
+            # The column's own centres: columnRanges overlap, so neighbours split at the midpoint between
+            # them; only the outer edges take the pad. A retry never drops or adds a neighbour's circles.
+            lo = (rs[i-1]['x2'] + rng['x1'])/2*sc if i else a
+            hi = (rng['x2'] + rs[i+1]['x1'])/2*sc if i+1 < len(rs) else b
+            own = lambda c: lo <= c[0] < hi
+            nrow = max(0, min(tp.rows_per_block, tp.expected - i*tp.rows_per_block))
+            if sum(1 for c in cir if own(c)) >= nrow * len(tp.choices) * HOUGH_RETRY_FILL: continue
+            TIMER.count('hough_retries')
+            cir = [c for c in cir if not own(c)] + [c for c in run_hough(low, a, b) if own(c)]
+        # The pad keeps edge bubbles whole; centres past the last requested column belong to the next one.
+        if ncols < tp.qcols: cir = [c for c in cir if c[0] <= tp.ranges[ncols-1]['x2']*sc]
+    return [(cx/sc, cy/sc, r/sc) for cx,cy,r in cir]
 
 def isolate_answer_circles(cir, pw, ph):
     if not cir: return []
@@ -198,12 +555,17 @@ def isolate_answer_circles(cir, pw, ph):
     return ans
 
 def cluster_1d(vals, tol):
-    if not vals: return []
-    sv = np.sort(vals); cl = [[sv[0]]]
-    for v in sv[1:]:
-        if v - cl[-1][-1] < tol: cl[-1].append(v)
-        else: cl.append([v])
-    return [np.mean(c) for c in cl]
+    """Means of runs in the sorted values, split wherever the gap to the previous value reaches tol."""
+    if len(vals) == 0: return []
+    sv = np.sort(np.asarray(vals))
+    st = np.concatenate(([0], np.flatnonzero(np.diff(sv) >= tol) + 1))
+    # Run means keep the input dtype (float32 Hough centres stay float32).
+    return list(np.add.reduceat(sv, st) / np.diff(np.append(st, len(sv))).astype(sv.dtype))
+
+def count_within(sv, centres, tol):
+    """For each centre, how many of the sorted values sv lie strictly within tol of it."""
+    c = np.asarray(centres, dtype=np.float64)
+    return np.searchsorted(sv, c + tol, 'left') - np.searchsorted(sv, c - tol, 'right')
 
 def build_binary(gray):
     binary = cv2.adaptiveThreshold(
@@ -218,21 +580,170 @@ def build_binary(gray):
     binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
     return binary
 
+ANSWER_ROI_PAD = 200
+
+class PageContext:
+    """
+    The warped gray page and the images derived from it. Each derived image is built on first
+    access and kept for the rest of the sheet, so stages that never ask for one pay nothing.
+    The binary page is only thresholded inside the answer region (see answer_region); outside
+    it reads as empty.
+    """
+    def __init__(self, gray, tp=None, dd=None, ncols=None):
+        # ncols: only the first ncols answer columns are read (see CompiledTemplate.requested_blocks).
+        self.gray, self.tp, self.dd, self.region, self.ncols = gray, tp, dd, None, ncols
+        self._binary = self._clahe = self._circles = None
+
+    def answer_region(self, cir):
+        """
+        Limit the binary page to the template ROI plus the answer circles, padded for anchor/column probes.
+        A binary built for a different region (projected grid first, then the Hough fallback) is dropped.
+        """
+        h, w = self.gray.shape[:2]
+        x1 = min([self.tp.roi[0] if self.tp else 0] + [c[0] for c in cir])
+        x2 = w
+        if self.tp and self.ncols and self.ncols < self.tp.qcols:
+            x2 = min(w, int(max([self.tp.ranges[self.ncols-1]['x2']] + [c[0] for c in cir])) + ANSWER_ROI_PAD)
+        region = (max(0, int(x1) - ANSWER_ROI_PAD), 0, x2, h)
+        if region != self.region: self.region, self._binary = region, None
+
+    @property
+    def circles(self):
+        if self._circles is None: self._circles = detect_circles(self.gray, self.dd, self.tp, self.ncols)
+        return self._circles
+
+    @property
+    def binary(self):
+        if self._binary is None: self._binary = TIMER.timed('binarize', self._build_binary)
+        return self._binary
+
+    @property
+    def clahe(self):
+        # Full page: CLAHE tiles are laid over the whole image, a crop would change every tile.
+        if self._clahe is None: self._clahe = TIMER.timed('clahe', cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8)).apply, self.gray)
+        return self._clahe
+
+    def _build_binary(self):
+        h, w = self.gray.shape[:2]
+        x1, y1, x2, y2 = self.region or (0, 0, w, h)
+        if (x1, y1, x2, y2) == (0, 0, w, h): return build_binary(self.gray)
+        # Threshold window (25) and opening (3) reach 13 px, so a 16 px margin keeps the region exact.
+        mx1, my1, mx2, my2 = max(0, x1-16), max(0, y1-16), min(w, x2+16), min(h, y2+16)
+        part = build_binary(self.gray[my1:my2, mx1:mx2])
+        binary = np.zeros((h, w), np.uint8)
+        binary[y1:y2, x1:x2] = part[y1-my1:y2-my1, x1-mx1:x2-mx1]
+        TIMER.count('binary_px', (x2-x1)*(y2-y1))
+        return binary
+
 def clamp01(v):
     return max(0.0, min(1.0, float(v)))
 
-def read_grid_answers(binary, cfg, pw, ph, choices, blocks=None):
-    qcols = int(cfg.get('questionColumns', 3) or 3)
-    qcols = max(1, min(6, qcols))
-    rows_per_block = int(cfg.get('rowsPerBlock', ROWS_PER_BLOCK) or ROWS_PER_BLOCK)
-    expected = int(cfg.get('expectedQuestionCount', EXPECTED_QUESTION_COUNT) or EXPECTED_QUESTION_COUNT)
+class Row:
+    """
+    One question row. Fixed slots instead of a per-row dict; the decision passes keep dict-style
+    access (r['best'], r.get(...), r.update(...)), and a field never set reads as missing.
+    Scores are held once as scores_list; the choice-keyed dict is derived on output.
+    """
+    __slots__ = ('question', 'row_idx', 'choices', 'scores_list', 'coords', 'best', 'second', 'best_idx', 'best_choice',
+                 'delta', 'row_median', 'row_std', 'z', 'block', 'radius', 'mark_th', 'blank_th', 'margin', 'noise_max',
+                 'noise_gap', 'ink_ratio', 'rescued', 'rescue_params', 'tags', 'veto_reason', 'signal_strong_enough',
+                 'noise_margin', 'answer', 'confidence', 'status', 'flags', 'tier', 'best_gray', 'best_clahe',
+                 'choice_gray', 'choice_clahe', 'clahe_used', 'clahe_enabled')
+
+    def __init__(self, **kw): self.update(kw)
+    def __getitem__(self, k): return getattr(self, k)
+    def __setitem__(self, k, v): setattr(self, k, v)
+    def get(self, k, d=None): return getattr(self, k, d)
+
+    def update(self, kw):
+        for k, v in kw.items(): setattr(self, k, v)
+
+    @property
+    def scores(self): return dict(zip(self.get('choices', ()), self.get('scores_list', ())))
+
+    @classmethod
+    def missing(cls, q):
+        return cls(question=q, answer=None, confidence=0, scores_list=[], flags=['BLANK', 'NOT_DETECTED'], status='NOT_DETECTED',
+                   block='unknown', tier='NOT_DETECTED', tags=[], veto_reason=None, best=0.0, delta=0.0, z=0.0, noise_gap=0.0, ink_ratio=0.0)
+
+# Per-answer fields of result.json, in output order; the compact format emits each as one column.
+ANSWER_FIELDS = ('question', 'answer', 'confidence', 'scores', 'flags', 'block', 'status', 'best', 'delta', 'z', 'noise_gap',
+                 'ink_ratio', 'tier', 'veto_reason', 'tags')
+ANSWER_FLOATS = ('best', 'delta', 'z', 'noise_gap', 'ink_ratio')
+
+def answer_record(r):
+    a = {k: r.get(k) for k in ANSWER_FIELDS}
+    a['confidence'], a['flags'], a['tags'] = r.get('confidence', 0), r.get('flags', []), r.get('tags', [])
+    for k in ANSWER_FLOATS: a[k] = float(a[k] or 0.0)
+    return a
+
+def answer_columns(rows, choices):
+    """Columnar answers: one list per field, scores as one list per choice (null where the row was not detected)."""
+    cols = {k: [] for k in ANSWER_FIELDS if k != 'scores'}
+    for r in rows:
+        a = answer_record(r)
+        for k, c in cols.items(): c.append(a[k])
+    sl = [r.get('scores_list') or () for r in rows]
+    cols['scores'] = {c: [s[i] if i < len(s) else None for s in sl] for i, c in enumerate(choices)}
+    return {'format': 'columns', 'choices': list(choices), **cols}
+
+def expand_answers(res):
+    """result['answers'] as a list of per-question dicts, whichever format the sheet was written in."""
+    a = res.get('answers') or []
+    if isinstance(a, list): return a
+    sc = a.get('scores') or {}
+    return [{**{k: a[k][i] for k in ANSWER_FIELDS if k != 'scores'},
+             'scores': {c: v[i] for c, v in sc.items() if v[i] is not None}} for i in range(len(a.get('question', [])))]
+
+def sheet_result(tk, rows, choices, meta, anchors, counted=None):
+    """result.json body for the final rows; summary counts come from counted (default: rows)."""
+    counted = rows if counted is None else counted
+    ok = sum(1 for r in counted if (r.get('status') or '').startswith('OK'))
+    ans = sum(1 for r in counted if r.get('answer'))
+    answers = answer_columns(rows, choices) if RESULT_FORMAT == 'compact' else [answer_record(r) for r in rows]
+    return {'templateKey': tk, 'answers': answers, 'summary': {'total': len(rows), 'answered': ans, 'ok': ok}, 'meta': meta, 'anchors': anchors}
+
+def grid_cells(ranges_px, roi_rect, cols, rows_per_block, expected):
+    """Per-column cell rectangles (ROI coords) and question numbers for the fixed grid."""
+    roi_left, roi_top, roi_right, roi_bottom = roi_rect
+    roi_w = int(max(2, roi_right - roi_left))
+    roi_h = int(max(2, roi_bottom - roi_top))
+    cx = np.arange(cols)
+    cells = []
+    for block, rng in enumerate(ranges_px):
+        col_left = int(round(float(rng['x1']) - roi_left))
+        col_right = int(round(float(rng['x2']) - roi_left))
+        col_top = int(round(float(rng['y1']) - roi_top))
+        col_bottom = int(round(float(rng['y2']) - roi_top))
+        col_left = max(0, min(roi_w - 2, col_left))
+        col_right = max(col_left + 2, min(roi_w, col_right))
+        col_top = max(0, min(roi_h - 2, col_top))
+        col_bottom = max(col_top + 2, min(roi_h, col_bottom))
+        col_w = max(2, col_right - col_left)
+        col_h = max(2, col_bottom - col_top)
+        cell_w = col_w / max(1, cols)
+        cell_h = col_h / max(1, rows_per_block)
+        nrow = max(0, min(rows_per_block, expected - block * rows_per_block))
+        if nrow == 0 or cols == 0:
+            continue
+
+        margin_x = int(round(cell_w * CELL_MARGIN))
+        margin_y = int(round(cell_h * CELL_MARGIN))
+        # np.rint rounds half to even, like round() in the per-cell version.
+        x = np.clip(np.rint(col_left + cx * cell_w).astype(np.int64) + margin_x, 0, roi_w - 2)[None, :]
+        y = np.clip(np.rint(col_top + np.arange(nrow) * cell_h).astype(np.int64) + margin_y, 0, roi_h - 2)[:, None]
+        w = np.maximum(2, np.minimum(roi_w - x, max(2, int(round(cell_w - margin_x * 2)))))
+        h = np.maximum(2, np.minimum(roi_h - y, max(2, int(round(cell_h - margin_y * 2)))))
+        cells.append((block, x, y, w, h, nrow))
+    return cells
+
+def read_grid_answers(binary, tp, blocks=None):
+    pw, ph, qcols, choices = tp.pw, tp.ph, tp.qcols, tp.choices
+    rows_per_block, expected = tp.rows_per_block, tp.expected
 
     # Prefer using detected answer blocks (from circle clustering) to derive ROI/ranges.
-    ranges_px = []
-    roi_left = roi_top = 0
-    roi_right = pw
-    roi_bottom = ph
     if blocks and isinstance(blocks, list) and len(blocks) >= 1:
+        ranges_px = []
         sorted_blocks = sorted(blocks, key=lambda b: float(b.get('x_min', 0)))
         roi_left = int(max(0, min(pw - 2, min(float(b.get('x_min', 0)) for b in sorted_blocks))))
         roi_right = int(max(2, min(pw, max(float(b.get('x_max', pw)) for b in sorted_blocks))))
@@ -267,154 +778,87 @@ def read_grid_answers(binary, cfg, pw, ph, choices, blocks=None):
             roi_right = int(max(2, min(pw, max(r['x2'] for r in ranges_px))))
             roi_top = int(max(0, min(ph - 2, min(r['y1'] for r in ranges_px))))
             roi_bottom = int(max(2, min(ph, max(r['y2'] for r in ranges_px))))
+        roi_rect = (roi_left, roi_top, roi_right, roi_bottom)
+        cells = grid_cells(ranges_px, roi_rect, len(choices), rows_per_block, expected)
     else:
-        roiX = float(cfg.get('roiX', 0.0))
-        roiY = float(cfg.get('roiY', 0.0))
-        roiW = float(cfg.get('roiW', 1.0))
-        roiH = float(cfg.get('roiH', 1.0))
-        roi_left = int(round(clamp01(roiX) * pw))
-        roi_top = int(round(clamp01(roiY) * ph))
-        roi_right = roi_left + int(round(clamp01(roiW) * pw))
-        roi_bottom = roi_top + int(round(clamp01(roiH) * ph))
-        roi_left = max(0, min(pw - 2, roi_left))
-        roi_top = max(0, min(ph - 2, roi_top))
-        roi_right = max(roi_left + 2, min(pw, roi_right))
-        roi_bottom = max(roi_top + 2, min(ph, roi_bottom))
-
-        col_ranges = cfg.get('columnRanges') or []
-        if not isinstance(col_ranges, list) or len(col_ranges) != qcols:
-            col_ranges = [{'start': i / qcols, 'end': (i + 1) / qcols, 'top': 0, 'bottom': 1} for i in range(qcols)]
-        roi_w = roi_right - roi_left
-        roi_h = roi_bottom - roi_top
-        for block in range(qcols):
-            cr = col_ranges[block] if block < len(col_ranges) else {'start': block / qcols, 'end': (block + 1) / qcols, 'top': 0, 'bottom': 1}
-            start = clamp01(cr.get('start', 0))
-            end = clamp01(cr.get('end', 1))
-            top = clamp01(cr.get('top', 0))
-            bottom = clamp01(cr.get('bottom', 1))
-            if end <= start:
-                end = min(1.0, start + 0.02)
-            if bottom <= top:
-                bottom = min(1.0, top + 0.02)
-            ranges_px.append({
-                'x1': roi_left + roi_w * start,
-                'x2': roi_left + roi_w * end,
-                'y1': roi_top + roi_h * top,
-                'y2': roi_top + roi_h * bottom,
-            })
+        # Template geometry is fixed, so the compiled cells are reused as-is.
+        roi_rect, cells = tp.roi, tp.cells
 
+    roi_left, roi_top, roi_right, roi_bottom = roi_rect
     roi_w = int(max(2, roi_right - roi_left))
     roi_h = int(max(2, roi_bottom - roi_top))
     roi = binary[roi_top:roi_top + roi_h, roi_left:roi_left + roi_w]
 
     cols = len(choices)
-    all_ratios = []
-    row_data = []
+    # Summed-area table: every cell count is four lookups instead of a countNonZero call.
+    ii = cv2.integral((roi != 0).astype(np.uint8))
+    fills, cxs, cys, numbers, bnames = [], [], [], [], []
 
-    for block in range(min(qcols, len(ranges_px))):
-        rng = ranges_px[block]
-        col_left = int(round(float(rng['x1']) - roi_left))
-        col_right = int(round(float(rng['x2']) - roi_left))
-        col_top = int(round(float(rng['y1']) - roi_top))
-        col_bottom = int(round(float(rng['y2']) - roi_top))
-        col_left = max(0, min(roi_w - 2, col_left))
-        col_right = max(col_left + 2, min(roi_w, col_right))
-        col_top = max(0, min(roi_h - 2, col_top))
-        col_bottom = max(col_top + 2, min(roi_h, col_bottom))
-        col_w = max(2, col_right - col_left)
-        col_h = max(2, col_bottom - col_top)
-        cell_w = col_w / max(1, cols)
-        cell_h = col_h / max(1, rows_per_block)
-
-        for row in range(rows_per_block):
-            number = block * rows_per_block + row + 1
-            if number > expected:
-                break
-            ratios = []
-            coords = []
-            for ci in range(cols):
-                base_x = int(round(col_left + ci * cell_w))
-                base_y = int(round(col_top + row * cell_h))
-                margin_x = int(round(cell_w * CELL_MARGIN))
-                margin_y = int(round(cell_h * CELL_MARGIN))
-                x = base_x + margin_x
-                y = base_y + margin_y
-                w = max(2, int(round(cell_w - margin_x * 2)))
-                h = max(2, int(round(cell_h - margin_y * 2)))
-                x = max(0, min(roi_w - 2, x))
-                y = max(0, min(roi_h - 2, y))
-                w = max(2, min(roi_w - x, w))
-                h = max(2, min(roi_h - y, h))
-                cell = roi[y:y + h, x:x + w]
-                filled = int(cv2.countNonZero(cell))
-                ratio = filled / float(w * h)
-                ratios.append(float(ratio))
-                all_ratios.append(float(ratio))
-                coords.append((roi_left + x + w / 2.0, roi_top + y + h / 2.0))
-            row_data.append({'question': number, 'block': f'block{block+1}', 'ratios': ratios, 'coords': coords})
+    for block, x, y, w, h, nrow in cells:
+        if block >= qcols:
+            break
+        filled = ii[y + h, x + w] - ii[y, x + w] - ii[y + h, x] + ii[y, x]
+        fills.append(filled / (w * h).astype(np.float64))
+        cxs.append(np.broadcast_to(roi_left + x + w / 2.0, (nrow, cols)))
+        cys.append(np.broadcast_to(roi_top + y + h / 2.0, (nrow, cols)))
+        numbers.extend(range(block * rows_per_block + 1, block * rows_per_block + nrow + 1))
+        bnames.extend([f'block{block+1}'] * nrow)
 
     # Dynamic thresholding like the reference TS implementation.
-    if not all_ratios:
+    if not fills:
         return [], {}
-    all_sorted = sorted(all_ratios)
+    ratios = np.vstack(fills)
+    all_sorted = np.sort(ratios, axis=None)
     baseline_count = max(5, int(len(all_sorted) * 0.30))
     baseline_slice = all_sorted[:baseline_count]
-    baseline_avg = float(np.mean(baseline_slice)) if baseline_slice else 0.0
-    baseline_std = float(np.std(baseline_slice)) if baseline_slice else 0.0
-    base_th = float(cfg.get('threshold', 0.22) or 0.22)
-    base_delta = float(cfg.get('minFillDelta', 0.12) or 0.12)
-    dynamic_th = max(base_th, baseline_avg + max(0.05, baseline_std * 2))
-    dynamic_delta = max(base_delta, baseline_std * 2, 0.05)
+    baseline_avg = float(np.mean(baseline_slice)) if len(baseline_slice) else 0.0
+    baseline_std = float(np.std(baseline_slice)) if len(baseline_slice) else 0.0
+    dynamic_th = max(tp.threshold, baseline_avg + max(0.05, baseline_std * 2))
+    dynamic_delta = max(tp.min_fill_delta, baseline_std * 2, 0.05)
+
+    # Row statistics and decisions for the whole grid at once.
+    nq = len(numbers)
+    best_idx = np.argmax(ratios, axis=1)
+    best = ratios[np.arange(nq), best_idx]
+    second = -np.sort(-ratios, axis=1)[:, 1] if cols > 1 else np.zeros(nq)
+    row_avg = np.mean(ratios, axis=1)
+    row_std = np.std(ratios, axis=1)
+    row_gate = np.maximum(dynamic_th, row_avg + np.maximum(dynamic_delta, row_std))
+    is_blank = best < row_gate
+    ambiguous = ~is_blank & (best - second < np.maximum(dynamic_delta, row_std))
+    selection_gate = np.maximum(row_gate, row_avg + np.maximum(dynamic_delta, row_std * 1.1))
+    nsel = np.where(is_blank, 0, (ratios >= selection_gate[:, None]).sum(axis=1))
+    first_sel = np.argmax(ratios >= selection_gate[:, None], axis=1)
+    confidence = (np.clip((best - second) / np.maximum(best, 1e-6), 0.0, 1.0) * 100).astype(int)
+    ptx = np.rint(np.vstack(cxs)).astype(int).tolist()
+    pty = np.rint(np.vstack(cys)).astype(int).tolist()
 
     results = []
-    per_block_answered = {'block1': 0, 'block2': 0, 'block3': 0}
-
-    for row in row_data:
-        ratios = row['ratios']
-        sorted_desc = sorted(ratios, reverse=True)
-        best = sorted_desc[0] if sorted_desc else 0.0
-        second = sorted_desc[1] if len(sorted_desc) > 1 else 0.0
-        best_idx = int(ratios.index(best)) if ratios else 0
-        row_avg = float(np.mean(ratios)) if ratios else 0.0
-        row_std = float(np.std(ratios)) if ratios else 0.0
-        row_gate = max(dynamic_th, row_avg + max(dynamic_delta, row_std))
-        is_blank = best < row_gate
-        gap = best - second
-        ambiguous = (not is_blank) and gap < max(dynamic_delta, row_std)
-        selection_gate = max(row_gate, row_avg + max(dynamic_delta, row_std * 1.1))
-        selected = [] if is_blank else [choices[i] for i, v in enumerate(ratios) if v >= selection_gate]
-        selected = sorted(selected, key=lambda c: -ratios[choices.index(c)]) if selected else []
+    per_block_answered = {f'block{i+1}': 0 for i in range(qcols)}
+
+    for qi in range(nq):
+        rr = ratios[qi].tolist()
         answer = None
         status = 'BLANK'
         flags = []
-        if not is_blank and not ambiguous and len(selected) == 1:
-            answer = selected[0]
+        if not is_blank[qi] and not ambiguous[qi] and nsel[qi] == 1:
+            answer = choices[int(first_sel[qi])]
             status = 'OK'
-        elif not is_blank and (ambiguous or len(selected) > 1):
+        elif not is_blank[qi] and (ambiguous[qi] or nsel[qi] > 1):
             status = 'MULTI'
-            flags.append('AMBIGUOUS' if ambiguous else 'MULTI')
+            flags.append('AMBIGUOUS' if ambiguous[qi] else 'MULTI')
         else:
             flags.append('BLANK')
 
         if answer:
-            per_block_answered[row['block']] = per_block_answered.get(row['block'], 0) + 1
-        confidence = int(max(0.0, min(1.0, (best - second) / max(best, 1e-6))) * 100)
-        results.append({
-            'question': row['question'],
-            'answer': answer,
-            'confidence': confidence,
-            'scores': {choices[i]: float(round(ratios[i], 4)) for i in range(len(ratios))},
-            'scores_list': [float(v) for v in ratios],
-            'coords': [(int(round(x)), int(round(y))) for x, y in row['coords']],
-            'best_idx': best_idx,
-            'status': status,
-            'flags': flags,
-            'block': row['block'],
-        })
+            per_block_answered[bnames[qi]] = per_block_answered.get(bnames[qi], 0) + 1
+        results.append(Row(question=numbers[qi], answer=answer, confidence=int(confidence[qi]), choices=choices,
+            scores_list=[float(round(v, 4)) for v in rr], coords=list(zip(ptx[qi], pty[qi])), best_idx=int(best_idx[qi]),
+            status=status, flags=flags, block=bnames[qi]))
 
     # Empty-block guard: if a non-first block has too few answers, mark as empty.
-    for blk in ('block2', 'block3'):
-        if per_block_answered.get(blk, 0) < 5:
+    for blk in list(per_block_answered)[1:]:
+        if per_block_answered[blk] < 5:
             for r in results:
                 if r.get('block') != blk:
                     continue
@@ -428,31 +872,12 @@ def read_grid_answers(binary, cfg, pw, ph, choices, blocks=None):
         if len(coords) >= 2:
             anchors['q1A'] = [float(coords[0][0]), float(coords[0][1])]
             anchors['q1E'] = [float(coords[-1][0]), float(coords[-1][1])]
-    q53 = next((r for r in results if r.get('question') == 53), None)
+    q53 = next((r for r in results if r.get('question') == rows_per_block + 1), None)
     if q53 and q53.get('coords'):
         anchors['q53A'] = [float(q53['coords'][0][0]), float(q53['coords'][0][1])]
 
     return results, {'anchors': anchors, 'dynamic': {'threshold': dynamic_th, 'delta': dynamic_delta}}
 
-def ring_ink_ratio(binary, x, y, r):
-    h, w = binary.shape[:2]
-    x = float(x); y = float(y); r = float(r)
-    r1 = max(2.0, r * 0.95)
-    r2 = max(r1 + 1.0, r * 1.35)
-    mg = int(r2) + 2
-    x1, x2 = max(0, int(x - mg)), min(w, int(x + mg))
-    y1, y2 = max(0, int(y - mg)), min(h, int(y + mg))
-    if x2 <= x1 or y2 <= y1:
-        return 0.0
-    yy, xx = np.ogrid[y1:y2, x1:x2]
-    dsq = (xx - x) ** 2 + (yy - y) ** 2
-    mask = (dsq >= r1 ** 2) & (dsq <= r2 ** 2)
-    roi = binary[y1:y2, x1:x2]
-    vals = roi[mask]
-    if vals.size < 10:
-        return 0.0
-    return float(np.count_nonzero(vals)) / float(vals.size)
-
 def complete_x_centers(xct, binary, yct, r, pw, prefer_side=None):
     xct = sorted([float(x) for x in xct])
     if len(xct) >= CHOICES_PER_ROW:
@@ -482,10 +907,9 @@ def complete_x_centers(xct, binary, yct, r, pw, prefer_side=None):
             if binary is None or not yct:
                 return 0.0
             ys = [float(y) for y in yct[:min(12, len(yct))]]
+            ri = score_bubbles(binary, np.tile(candidate, len(ys)), np.repeat(ys, len(candidate)), r, ('ring',))['ring']
             total = 0.0
-            for y in ys:
-                for x in candidate:
-                    total += ring_ink_ratio(binary, x, y, r)
+            for v in ri.tolist(): total += v
             return total
 
         scored = [(score(c), c) for c in candidates]
@@ -508,13 +932,14 @@ def complete_x_centers(xct, binary, yct, r, pw, prefer_side=None):
             break
     return xct[:CHOICES_PER_ROW]
 
-def split_into_blocks(cir, pw):
+def split_into_blocks(cir, pw, k=None):
     if not cir: return []
     xv = [c[0] for c in cir]; sx = np.sort(xv); n = len(sx)
     if n < 30: return []
-    xc = [np.median(sx[:n//3]), np.median(sx[n//3:2*n//3]), np.median(sx[2*n//3:])]
-    blks = [[],[],[]]
-    for c in cir: blks[np.argmin([abs(c[0]-xc[i]) for i in range(3)])].append(c)
+    k = k or QUESTION_COLUMNS
+    xc = np.array([np.median(sx[i*n//k:(i+1)*n//k]) for i in range(k)])
+    lab = np.argmin(np.abs(np.asarray(xv)[:, None] - xc[None, :]), axis=1)
+    blks = [[cir[j] for j in np.flatnonzero(lab == i)] for i in range(k)]
     res = []
     for i,bc in enumerate(blks):
         if len(bc) < 10: continue
@@ -582,14 +1007,13 @@ def infer_auto_anchors_from_grid(blocks, binary, pw):
         
         # Find the first row (topmost y-cluster that has circles near all 5 x positions)
         first_row_y = None
+        ca = np.asarray(cir, dtype=np.float64); ca = ca[np.argsort(ca[:, 1], kind='stable')]
+        tol = mr * 1.5
         for y_candidate in ycl[:5]:  # Check first 5 rows
-            # Count how many x-clusters have a circle near this y
-            x_hits = 0
-            for xc in xcl[:CHOICES_PER_ROW]:
-                for cx, cy, cr in cir:
-                    if abs(cx - xc) < mr * 1.5 and abs(cy - y_candidate) < mr * 1.5:
-                        x_hits += 1
-                        break
+            # Circles in this row's y band (sorted-array slice), then how many x-clusters they cover
+            lo, hi = np.searchsorted(ca[:, 1], y_candidate - tol, 'right'), np.searchsorted(ca[:, 1], y_candidate + tol, 'left')
+            band = np.sort(ca[lo:hi, 0])
+            x_hits = int(np.count_nonzero(count_within(band, xcl[:CHOICES_PER_ROW], tol)))
             if x_hits >= CHOICES_PER_ROW - 1:  # Allow 1 missing
                 first_row_y = y_candidate
                 break
@@ -643,8 +1067,9 @@ def build_grid_fixed_rows(blk, er=ROWS_PER_BLOCK, dr=10, anchor=None, binary=Non
     if not cir: return None
     rad = [c[2] for c in cir]; mr = np.median(rad) if rad else dr
     xv = [c[0] for c in cir]; xt = mr*1.5; xcl = cluster_1d(xv, xt)
-    cs = [(xc, sum(1 for c in cir if abs(c[0]-xc)<xt)) for xc in xcl]
-    cs.sort(key=lambda x:x[1], reverse=True); xct = sorted([c[0] for c in cs[:CHOICES_PER_ROW]])
+    # Column support: circles within xt of each x-cluster; keep the best supported (ties in cluster order).
+    sup = count_within(np.sort(xv), xcl, xt)
+    xct = sorted(xcl[i] for i in np.argsort(-sup, kind='stable')[:CHOICES_PER_ROW])
     if len(xct) < CHOICES_PER_ROW:
         yv = [c[1] for c in cir]
         ycl = sorted(cluster_1d(yv, mr*1.2))
@@ -662,15 +1087,229 @@ def build_grid_fixed_rows(blk, er=ROWS_PER_BLOCK, dr=10, anchor=None, binary=Non
         yt,yb = blk['y_min'], blk['y_max']; st = (yb-yt)/(er-1) if er>1 else 0; yct = [yt+i*st for i in range(er)]
     return {'x_centers':xct, 'y_centers':yct, 'radius':mr, 'anchor_used': False}
 
-def score_bubble(gray, x, y, r):
-    h,w = gray.shape; r1,r2 = int(0.35*r), int(0.85*r); rb1,rb2 = int(1.05*r), int(1.35*r)
-    mg = rb2+2; x1,x2 = max(0,int(x-mg)), min(w,int(x+mg)); y1,y2 = max(0,int(y-mg)), min(h,int(y+mg))
-    if x2<=x1 or y2<=y1: return 0.0
-    yy,xx = np.ogrid[y1:y2, x1:x2]; dsq = (xx-x)**2 + (yy-y)**2
-    fm = (dsq >= r1**2) & (dsq <= r2**2); bm = (dsq >= rb1**2) & (dsq <= rb2**2)
-    roi = gray[y1:y2, x1:x2]; fp, bp = roi[fm], roi[bm]
-    if len(fp)==0 or len(bp)==0: return 0.0
-    return max(0.0, (np.mean(bp)-np.mean(fp))/255.0)
+GEOMETRY_SEARCH, GEOMETRY_MIN_RING = 16, 0.3
+
+def profile_shift(p, t, S):
+    """Shift d in [-S, S] maximising sum(t[i] * p[i+d]); t is zero within S of both ends."""
+    n = len(t)
+    return max(range(-S, S+1), key=lambda d: float(np.dot(t[S:n-S], p[S+d:n-S+d])))
+
+def derive_bubble_grid(blks, binary, tp):
+    """
+    Nominal bubble grid (the template's bubbleGrid) measured from the Hough blocks of a clean, trusted sheet.
+    Returns (grid, None), or (None, reason) when a block did not resolve into evenly spaced rows of choices.
+    """
+    if len(blks) != tp.qcols: return None, f'blocks:{len(blks)}'
+    grid = []
+    for i, blk in enumerate(blks):
+        cir, nrow = blk.get('circles') or [], tp.block_rows(i)
+        if not cir or nrow < 2: return None, f'block{i+1}:empty'
+        mr = float(np.median([c[2] for c in cir]))
+        xcl = sorted(cluster_1d([c[0] for c in cir], mr*1.5)); ycl = np.sort(cluster_1d([c[1] for c in cir], mr*1.2))
+        if len(xcl) != len(tp.choices) or len(ycl) != nrow: return None, f'block{i+1}:{len(xcl)}x{len(ycl)}'
+        dy, y0 = np.polyfit(np.arange(nrow), ycl, 1)
+        # Rows must be evenly spaced, otherwise a stray circle was clustered in.
+        if np.max(np.abs(y0 + np.arange(nrow)*dy - ycl)) > mr*0.5: return None, f'block{i+1}:uneven_rows'
+        ys = y0 + np.arange(nrow)*dy
+        # Hough radii run large; the outline radius is the one whose ring catches the most ink.
+        rs = [mr*k for k in (0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1.0)]
+        px, py = np.tile(np.rint(xcl), nrow), np.repeat(np.rint(ys), len(xcl))
+        ring = max(rs, key=lambda rr: float(np.median(score_bubbles(binary, px, py, rr, ('ring',))['ring'])))
+        grid.append({'x': [round(float(x), 2) for x in xcl], 'y0': round(float(y0), 2), 'dy': round(float(dy), 4),
+                     'r': round(mr, 2), 'ring': round(ring, 2)})
+    return grid, None
+
+def project_blocks(binary, tp, ncols=None):
+    """
+    Blocks from the template's nominal bubble grid instead of Hough. Each block is shifted by the (dx, dy)
+    that best lines its rings up with the binary page, found by correlating x/y ink profiles over
+    +-GEOMETRY_SEARCH px. Returns (blocks, offsets), or (None, reason) when a block falls off the page or its
+    rings do not line up (median ring ink below GEOMETRY_MIN_RING).
+    """
+    h, w = binary.shape[:2]; S = GEOMETRY_SEARCH; blks, offs = [], []
+    for i, g in enumerate(tp.bubble_grid[:ncols or tp.qcols]):
+        nrow = tp.block_rows(i)
+        if nrow == 0: continue
+        xs, ys, r = np.asarray(g['x'], dtype=np.float64), g['y0'] + np.arange(nrow)*g['dy'], float(g['r'])
+        m = S + int(r*1.5) + 2
+        x1, y1, x2, y2 = int(xs.min())-m, int(ys.min())-m, int(np.ceil(xs.max()))+m, int(np.ceil(ys.max()))+m
+        if x1 < 0 or y1 < 0 or x2 > w or y2 > h: return None, 'off_page'
+        crop = (binary[y1:y2, x1:x2] > 0).astype(np.float64)
+        # Discs rather than rings: the profile peak then does not depend on the exact radius.
+        disc = np.zeros(crop.shape, np.uint8)
+        for y in ys:
+            for x in xs: cv2.circle(disc, (int(round(x-x1)), int(round(y-y1))), int(round(r)), 1, -1)
+        dx = profile_shift(crop.sum(axis=0), disc.sum(axis=0).astype(np.float64), S)
+        dy = profile_shift(crop.sum(axis=1), disc.sum(axis=1).astype(np.float64), S)
+        xs, ys = xs + dx, ys + dy
+        # Whole-pixel centres: one stencil for the block instead of one per sub-pixel phase.
+        ri = score_bubbles(binary, np.tile(np.rint(xs), nrow), np.repeat(np.rint(ys), len(xs)), float(g.get('ring', r)), ('ring',))['ring']
+        if float(np.median(ri)) < GEOMETRY_MIN_RING: return None, 'rings_not_found'
+        q0 = 1 + i*tp.rows_per_block
+        blks.append({'name':f'block{i+1}','q_start':q0,'q_end':q0+nrow-1,'circles':[],
+            'x_min':float(xs.min()),'x_max':float(xs.max()),'y_min':float(ys.min()),'y_max':float(ys.max()),
+            'grid':{'x_centers':xs.tolist(),'y_centers':ys.tolist(),'radius':r,'anchor_used':False}})
+        offs.append([dx, dy])
+    return (blks, offs) if blks else (None, 'no_blocks')
+
+_STENCILS = {}
+
+def ring_stencil(kind, r, fx=0.0, fy=0.0):
+    """
+    Window masks for one bubble, cached by kind, radius and sub-pixel centre offset.
+    Ring radii and window size match the scalar compute_ink_ratio /
+    compute_noise_at_midpoint helpers exactly.
+    """
+    key = (kind, float(r), float(fx), float(fy))
+    st = _STENCILS.get(key)
+    if st is not None: return st
+    if kind == 'fill': a, b, c, d = int(0.35*r), int(0.85*r), int(1.05*r), int(1.35*r); mg = d+2
+    elif kind == 'ink': a, b, c, d = int(0.28*r), int(0.75*r), int(1.05*r), int(1.35*r); mg = d+2
+    elif kind == 'noise': a, b, c, d = 0, int(0.22*r), int(0.95*r), int(1.20*r); mg = d+2
+    elif kind == 'ring': c = max(2.0, float(r)*0.95); d = max(c+1.0, float(r)*1.35); a = b = None; mg = int(d)+2
+    else: raise ValueError(f"unknown stencil: {kind}")
+    j = np.arange(-mg, mg)
+    dsq = (j[None,:]-fx)**2 + (j[:,None]-fy)**2
+    st = {'mg': mg}
+    if kind in ('fill', 'ink'): st['inner'], st['outer'] = (dsq >= a**2) & (dsq <= b**2), (dsq >= c**2) & (dsq <= d**2)
+    elif kind == 'noise': st['inner'], st['ring'], st['outer'] = dsq <= b**2, (dsq >= c**2) & (dsq <= d**2), dsq >= d**2
+    else: st['ring'] = (dsq >= c**2) & (dsq <= d**2)
+    st = {k: (v.ravel() if k != 'mg' else v) for k, v in st.items()}
+    if len(_STENCILS) >= 512: _STENCILS.clear()
+    _STENCILS[key] = st
+    return st
+
+def gather_windows(img, ixs, iys, mg):
+    """Stack the (2mg x 2mg) windows around integer centres; pixels off the image are flagged invalid."""
+    h, w = img.shape[:2]
+    x0, y0 = int(ixs.min())-mg, int(iys.min())-mg; x1, y1 = int(ixs.max())+mg, int(iys.max())+mg
+    canvas = np.zeros((y1-y0, x1-x0), img.dtype); valid = np.zeros(canvas.shape, bool)
+    cx0, cy0, cx1, cy1 = max(0,x0), max(0,y0), min(w,x1), min(h,y1)
+    if cx1 > cx0 and cy1 > cy0:
+        canvas[cy0-y0:cy1-y0, cx0-x0:cx1-x0] = img[cy0:cy1, cx0:cx1]; valid[cy0-y0:cy1-y0, cx0-x0:cx1-x0] = True
+    ry, rx = iys-mg-y0, ixs-mg-x0; n = len(ixs); k = (2*mg)*(2*mg)
+    win = np.lib.stride_tricks.sliding_window_view(canvas, (2*mg, 2*mg))[ry, rx].reshape(n, k)
+    if valid.all(): return win, None
+    return win, np.lib.stride_tricks.sliding_window_view(valid, (2*mg, 2*mg))[ry, rx].reshape(n, k)
+
+def _masked_sum(win, valid, mask):
+    sel = mask[None, :] if valid is None else (valid & mask[None, :])
+    cnt = np.broadcast_to(sel, win.shape).sum(axis=1)
+    return (win * sel).sum(axis=1, dtype=np.int64), cnt, sel
+
+def _masked_mean(win, valid, mask):
+    sm, cnt, sel = _masked_sum(win, valid, mask)
+    return np.where(cnt > 0, sm / np.maximum(cnt, 1), 0.0), cnt, sel
+
+def score_bubbles(img, xs, ys, r, kinds=('fill',)):
+    """
+    Batched bubble statistics for many centres sharing one radius.
+    Returns arrays keyed by 'fill' (background ring minus inner disc, /255) / 'background', 'ink'
+    (compute_ink_ratio), 'noise' (compute_noise_at_midpoint) and 'ring' (ink share of the printed
+    outline on a binary image).
+    """
+    xs = np.asarray(xs, dtype=np.float64).ravel(); ys = np.asarray(ys, dtype=np.float64).ravel(); n = len(xs)
+    out = {}; TIMER.count('bubbles_gathered', n*len(kinds))
+    for kind in kinds:
+        if kind == 'fill': out['fill'], out['background'] = np.zeros(n), np.zeros(n)
+        else: out[kind] = np.zeros(n)
+    if n == 0: return out
+    ixs, iys = np.floor(xs).astype(np.int64), np.floor(ys).astype(np.int64)
+    fxs, fys = xs-ixs, ys-iys
+    groups = {}
+    for i, key in enumerate(zip(fxs.tolist(), fys.tolist())): groups.setdefault(key, []).append(i)
+    for (fx, fy), idx in groups.items():
+        idx = np.array(idx)
+        for kind in kinds:
+            st = ring_stencil(kind, r, fx, fy); mg = st['mg']
+            win, valid = gather_windows(img, ixs[idx], iys[idx], mg)
+            if kind == 'fill':
+                fm, fc, _ = _masked_mean(win, valid, st['inner']); bm, bc, _ = _masked_mean(win, valid, st['outer'])
+                ok = (fc > 0) & (bc > 0)
+                out['fill'][idx] = np.where(ok, np.maximum(0.0, (bm-fm)/255.0), 0.0); out['background'][idx] = np.where(ok, bm, 0.0)
+            elif kind == 'ink':
+                bm, bc, bsel = _masked_mean(win, valid, st['outer'])
+                dev = np.where(bsel, win - bm[:, None], 0.0)
+                bs = np.sqrt((dev*dev).sum(axis=1) / np.maximum(bc, 1)) + 1e-6
+                ith = bm - 1.0*bs
+                fsel = st['inner'][None, :] if valid is None else (valid & st['inner'][None, :])
+                fc = np.broadcast_to(fsel, win.shape).sum(axis=1)
+                below = ((win < ith[:, None]) & fsel).sum(axis=1)
+                out['ink'][idx] = np.where((bc >= 10) & (fc > 0), below / np.maximum(fc, 1), 0.0)
+            elif kind == 'noise':
+                gm, gc, _ = _masked_mean(win, valid, st['outer'])
+                bgmn = np.where(gc >= 10, gm, 200.0)
+                im, ic, _ = _masked_mean(win, valid, st['inner']); rm, rc, _ = _masked_mean(win, valid, st['ring'])
+                isc = np.where(ic > 0, np.maximum(0.0, (bgmn-im)/255.0), 0.0); rsc = np.where(rc > 0, np.maximum(0.0, (bgmn-rm)/255.0), 0.0)
+                out['noise'][idx] = np.maximum(isc, rsc)
+            else:
+                sm, cnt, sel = _masked_sum(win > 0, valid, st['ring'])
+                out['ring'][idx] = np.where(cnt >= 10, sm / np.maximum(cnt, 1), 0.0)
+    return out
+
+class ScoreField:
+    """
+    Dense fill-score map for one ring geometry over a page region. Inner-disc and
+    background-ring sums come from cv2.filter2D (rounded back to exact integers),
+    so dy/dx/radius searches become array lookups at integer centres.
+    """
+    def __init__(self, img, r, roi):
+        a, b, c, d = int(0.35*r), int(0.85*r), int(1.05*r), int(1.35*r)
+        h, w = img.shape[:2]; self.r = r
+        x0, y0, x1, y1 = [int(v) for v in roi]
+        self.roi = (max(0,x0), max(0,y0), min(w,x1), min(h,y1))
+        ox, oy = max(0, self.roi[0]-d), max(0, self.roi[1]-d)
+        crop = img[oy:min(h, self.roi[3]+d+1), ox:min(w, self.roi[2]+d+1)].astype(np.float64)
+        j = np.arange(-d, d+1); dsq = j[None,:]**2 + j[:,None]**2
+        fk, bk = ((dsq >= a*a) & (dsq <= b*b)).astype(np.float64), ((dsq >= c*c) & (dsq <= d*d)).astype(np.float64)
+        conv = lambda src, k: np.rint(cv2.filter2D(src, cv2.CV_64F, k, borderType=cv2.BORDER_CONSTANT))
+        fs, bs = conv(crop, fk), conv(crop, bk)
+        if ox > 0 and oy > 0 and ox+crop.shape[1] < w and oy+crop.shape[0] < h: fc, bc = fk.sum(), bk.sum()
+        else:
+            # Pixels off the page are not counted, exactly like the clipped scalar window.
+            ones = np.ones_like(crop); fc, bc = conv(ones, fk), conv(ones, bk)
+        ok = (fc > 0) & (bc > 0)
+        self.map = np.where(ok, np.maximum(0.0, (bs/np.maximum(bc,1) - fs/np.maximum(fc,1))/255.0), 0.0)
+        self.ox, self.oy = ox, oy; TIMER.count('score_fields')
+
+    def fill(self, img, xs, ys):
+        xs = np.asarray(xs, dtype=np.int64).ravel(); ys = np.asarray(ys, dtype=np.int64).ravel()
+        x0, y0, x1, y1 = self.roi; TIMER.count('field_lookups', len(xs))
+        inside = (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+        out = np.empty(len(xs))
+        out[inside] = self.map[ys[inside]-self.oy, xs[inside]-self.ox]
+        if not inside.all(): out[~inside] = score_bubbles(img, xs[~inside], ys[~inside], self.r)['fill']
+        return out
+
+# One gathered lookup costs about as much as filtering this many ROI pixels.
+FIELD_PX_PER_LOOKUP = 48
+
+class FieldCache:
+    """
+    Per-block ScoreFields keyed by ring geometry. A field is only built once the
+    lookups requested at that radius outweigh filtering the ROI; until then the
+    points go through the batched gather.
+    """
+    def __init__(self, img, roi):
+        self.img, self.roi, self.fields, self.demand = img, roi, {}, {}
+        self.area = max(0, roi[2]-roi[0]) * max(0, roi[3]-roi[1])
+
+    def fill(self, r, xs, ys):
+        key = (int(0.35*r), int(0.85*r), int(1.05*r), int(1.35*r))
+        if key not in self.fields:
+            self.demand[key] = self.demand.get(key, 0) + np.size(xs)
+            if self.demand[key]*FIELD_PX_PER_LOOKUP < self.area: return score_bubbles(self.img, xs, ys, r)['fill']
+            self.fields[key] = ScoreField(self.img, r, self.roi)
+        return self.fields[key].fill(self.img, xs, ys)
+
+def fill_scores(gray, xs, ys, r, fields=None):
+    """Fill scores at integer centres: dense-field lookup when available, batched otherwise."""
+    if fields is not None: return fields.fill(r, xs, ys)
+    return score_bubbles(gray, xs, ys, r)['fill']
+
+def block_roi(grid, pad=32):
+    xc, yc = grid['x_centers'], grid['y_centers']
+    return (int(min(xc))-pad, int(min(yc))-pad, int(max(xc))+pad+1, int(max(yc))+pad+1)
 
 def compute_ink_ratio(gray, x, y, r):
     h,w = gray.shape; r1,r2 = int(0.28*r), int(0.75*r); rb1,rb2 = int(1.05*r), int(1.35*r)
@@ -711,56 +1350,63 @@ def is_strong_override(best, delta, z, mth, margin):
 def is_signal_strong_enough(z, delta, margin):
     return z >= 2.5 or delta >= 3.2*margin
 
-def stability_check_soft(gray, coords, bidx, r, dy0=0):
+def stability_check_soft(gray, coords, bidx, r, dy0=0, fields=None):
     if bidx >= len(coords): return False, []
-    dyo = [dy0, dy0+2, dy0-2]; votes = []
-    for dy in dyo:
-        sc = [score_bubble(gray, cx, cy+dy, r) for cx,cy in coords]
-        if sc: votes.append(int(np.argmax(sc)))
+    dyo = [dy0, dy0+2, dy0-2]; votes = []; TIMER.count('stability_checks')
+    if coords:
+        xs = np.array([cx for cx,cy in coords]); ys = np.array([cy for cx,cy in coords])
+        sc = fill_scores(gray, np.tile(xs, 3), np.concatenate([ys+dy for dy in dyo]), r, fields).reshape(3, len(coords))
+        votes = [int(v) for v in np.argmax(sc, axis=1)]
     if not votes: return False, votes
     from collections import Counter
     vc = Counter(votes); mc, mcnt = vc.most_common(1)[0]
     return mcnt >= 2, votes
 
-def find_best_dy_offset(gray, xc, yc, r, nr=TOP_ROWS_COUNT):
+def find_best_dy_offset(gray, xc, yc, r, nr=TOP_ROWS_COUNT, fields=None):
     bdy, bsum = 0, -1
-    for dy in DY_CANDIDATES:
+    nr = min(nr, len(yc))
+    if nr and len(xc):
+        # All candidate offsets x rows x bubbles in one lookup.
+        xs = np.array([int(x) for x in xc]); yy = (np.array(DY_CANDIDATES, dtype=np.float64)[:,None] + np.array(yc[:nr], dtype=np.float64)[None,:]).astype(np.int64)
+        rmax = fill_scores(gray, np.tile(xs, yy.size), np.repeat(yy.ravel(), len(xs)), r, fields).reshape(len(DY_CANDIDATES), nr, len(xs)).max(axis=2)
+    for di, dy in enumerate(DY_CANDIDATES):
         tot = 0
-        for ri in range(min(nr, len(yc))):
-            y = yc[ri]+dy; sc = [score_bubble(gray, int(x), int(y), r) for x in xc]
-            tot += max(sc) if sc else 0
+        if nr and len(xc):
+            for v in rmax[di].tolist(): tot += v
         if tot > bsum: bsum, bdy = tot, dy
     return (0, bsum) if bsum < TOP_ROWS_MIN_SUM else (bdy, bsum)
 
-def process_block(gray, blk, grid, choices, th, is_block1=False):
+def process_block(gray, blk, grid, choices, is_block1=False, fields=None):
+    """Measure every bubble of a block once; thresholds and decisions are applied to these rows afterwards."""
     if grid is None: return [], {}
     xc, yc, r = grid['x_centers'], grid['y_centers'], grid['radius']
-    qs = blk['q_start']; mth = th.get('mark_th', MARK_TH_FLOOR)
-    bth = th.get('blank_th', 0.05); margin = th.get('margin', MARGIN_TH_FLOOR)
-    rows = []; dyo, dys = (find_best_dy_offset(gray, xc, yc, r, TOP_ROWS_COUNT) if is_block1 else (0, 0))
-    for ri, yb in enumerate(yc):
-        y = yb + dyo if is_block1 and ri < TOP_ROWS_COUNT else yb
-        scores, coords = [], []
-        for ci, x in enumerate(xc):
-            if ci >= len(choices): break
-            scores.append(round(score_bubble(gray, int(x), int(y), r), 4))
-            coords.append((int(x), int(y)))
-        sa = np.array(scores)
-        if len(sa) > 0:
-            bidx = int(np.argmax(sa)); best = sa[bidx]
-            ss = np.sort(sa)[::-1]; sec = ss[1] if len(ss)>1 else 0
-            med = float(np.median(sa)); std = float(np.std(sa))+1e-6
-            z = (best-med)/std; delta = best-sec
-        else:
-            bidx, best, sec, med, std, z, delta = 0, 0, 0, 0, 1e-6, 0, 0
-        nm = compute_noise_max(gray, coords, r); ng = best - nm
-        ink = compute_ink_ratio(gray, coords[bidx][0], coords[bidx][1], r) if bidx < len(coords) else 0.0
-        rows.append({'question':qs+ri, 'row_idx':ri, 'scores':{choices[i]:scores[i] for i in range(len(scores))},
-            'scores_list':scores, 'coords':coords, 'best':float(best), 'second':float(sec), 'best_idx':bidx,
-            'best_choice':choices[bidx] if bidx<len(choices) else None, 'delta':float(delta), 'row_median':med,
-            'row_std':std, 'z':float(z), 'block':blk['name'], 'radius':r, 'mark_th':mth, 'blank_th':bth,
-            'margin':margin, 'noise_max':round(nm,4), 'noise_gap':round(ng,4), 'ink_ratio':round(ink,4),
-            'rescued':False, 'rescue_params':None, 'tags':[], 'veto_reason':None, 'signal_strong_enough':False, 'noise_margin':0})
+    qs = blk['q_start']
+    rows = []; dyo, dys = (find_best_dy_offset(gray, xc, yc, r, TOP_ROWS_COUNT, fields) if is_block1 else (0, 0))
+    xs = [int(x) for x in xc[:len(choices)]]; nc, nr = len(xs), len(yc)
+    ys = [int(yb + dyo if is_block1 and ri < TOP_ROWS_COUNT else yb) for ri, yb in enumerate(yc)]
+    # Whole-grid measurements in three batched calls instead of one call per bubble.
+    sc = np.round(fill_scores(gray, np.tile(xs, nr), np.repeat(ys, nc), r, fields).reshape(nr, nc), 4) if nc and nr else np.zeros((nr, 0))
+    if nc > 0:
+        bidx = np.argmax(sc, axis=1); best = sc[np.arange(nr), bidx]
+        ss = -np.sort(-sc, axis=1); sec = ss[:, 1] if nc > 1 else np.zeros(nr)
+        med = np.median(sc, axis=1); std = np.std(sc, axis=1)+1e-6
+        z = (best-med)/std; delta = best-sec
+    else:
+        bidx = np.zeros(nr, dtype=int); best = sec = med = z = delta = np.zeros(nr); std = np.full(nr, 1e-6)
+    if nc >= 2:
+        mx = (np.array(xs[:-1]) + np.array(xs[1:])) / 2
+        nm = score_bubbles(gray, np.tile(mx, nr), np.repeat(ys, nc-1), r, ('noise',))['noise'].reshape(nr, nc-1).max(axis=1)
+    else: nm = np.zeros(nr)
+    ink = score_bubbles(gray, np.array(xs)[bidx], ys, r, ('ink',))['ink'] if nc else np.zeros(nr)
+    for ri in range(nr):
+        coords = [(x, ys[ri]) for x in xs]; bi = int(bidx[ri])
+        ng = best[ri] - nm[ri]
+        rows.append(Row(question=qs+ri, row_idx=ri, choices=choices, scores_list=sc[ri].tolist(), coords=coords,
+            best=float(best[ri]), second=float(sec[ri]), best_idx=bi, best_choice=choices[bi] if bi<len(choices) else None,
+            delta=float(delta[ri]), row_median=float(med[ri]), row_std=float(std[ri]), z=float(z[ri]), block=blk['name'], radius=r,
+            noise_max=round(float(nm[ri]),4), noise_gap=round(float(ng),4),
+            ink_ratio=round(float(ink[ri]),4), rescued=False, rescue_params=None, tags=[], veto_reason=None,
+            signal_strong_enough=False, noise_margin=0))
     return rows, {'dy_offset':dyo, 'dy_sum':dys}
 
 def compute_thresholds(rows):
@@ -780,7 +1426,7 @@ def calibrate_ink_threshold(rows, mth, margin):
     ss = [r['ink_ratio'] for r in rows if r['best']>=mth+0.03 and r['delta']>=2.5*margin]
     return float(np.median(ss)) if len(ss)>=3 else None
 
-def apply_decisions(gray, rows, th, faint_ok, is_empty, bmi, choices, allow_faint_force=False):
+def apply_decisions(gray, rows, th, faint_ok, is_empty, bmi, choices, allow_faint_force=False, fields=None):
     mth, bth, margin = th['mark_th'], th['blank_th'], th['margin']
     fm = max(1.5*margin, 0.02); nm = max(0.006, 0.25*margin)
     for r in rows:
@@ -799,7 +1445,7 @@ def apply_decisions(gray, rows, th, faint_ok, is_empty, bmi, choices, allow_fain
         so = is_strong_override(best, delta, z, mth, margin); ss = is_signal_strong_enough(z, delta, margin); r['signal_strong_enough'] = ss
         sp, sv = True, []
         if ws:
-            sp, sv = stability_check_soft(gray, coords, bidx, rad)
+            sp, sv = stability_check_soft(gray, coords, bidx, rad, fields=fields)
             if not sp:
                 if so or (best >= mth+2*margin and delta >= 3*margin): sp, tier = True, 'OK_STAB_OVERRIDE' if tier=='OK' else tier
                 else: sp, tier, ws, vr = False, 'STABILITY_FAIL', False, 'STAB_FAIL'
@@ -829,37 +1475,43 @@ def apply_decisions(gray, rows, th, faint_ok, is_empty, bmi, choices, allow_fain
         #         r['flags'] = ['FORCED_FAINT']
     return rows
 
-def targeted_rescue(gray, row, th, bmi, choices):
+def targeted_rescue(gray, row, th, bmi, choices, fields=None):
     coords, rad = row['coords'], row.get('radius',10); br, bo = None, -999
+    if not coords: return br
+    TIMER.count('rescue_searches')
+    offs = [(dx, dy) for dx in RESCUE_DX for dy in RESCUE_DY]
     for rs in RESCUE_R_SCALES:
         rt = rad*rs
-        for dx in RESCUE_DX:
-            for dy in RESCUE_DY:
-                nc = [(int(cx+dx), int(cy+dy)) for cx,cy in coords]
-                ns = [score_bubble(gray, cx, cy, rt) for cx,cy in nc]
-                if not ns: continue
-                sa = np.array(ns); bidx = int(np.argmax(sa)); best = sa[bidx]
-                ss = np.sort(sa)[::-1]; sec = ss[1] if len(ss)>1 else 0; delta = best-sec
-                med, std = float(np.median(sa)), float(np.std(sa))+1e-6; z = (best-med)/std
-                nmx = compute_noise_max(gray, nc, rt); ng = best-nmx
-                obj = delta + 0.25*z + 0.10*ng
-                if obj > bo:
-                    bo = obj; br = {'dx':dx,'dy':dy,'r_scale':rs,'coords':nc,'best_idx':bidx,'best':float(best),'second':float(sec),'delta':float(delta),'z':float(z),'noise_max':float(nmx),'noise_gap':float(ng),'objective':float(obj),'best_choice':choices[bidx] if bidx<len(choices) else None}
+        # Every (dx, dy) shift of this radius scored in one lookup.
+        ncs = [[(int(cx+dx), int(cy+dy)) for cx,cy in coords] for dx,dy in offs]
+        sm = fill_scores(gray, [c[0] for nc in ncs for c in nc], [c[1] for nc in ncs for c in nc], rt, fields).reshape(len(offs), len(coords))
+        if len(coords) >= 2:
+            mx = np.array([(nc[i][0]+nc[i+1][0])/2 for nc in ncs for i in range(len(nc)-1)])
+            nms = score_bubbles(gray, mx, np.repeat([nc[0][1] for nc in ncs], len(coords)-1), rt, ('noise',))['noise'].reshape(len(offs), -1).max(axis=1)
+        else: nms = np.zeros(len(offs))
+        for (dx, dy), nc, sa, nmx in zip(offs, ncs, sm, nms):
+            bidx = int(np.argmax(sa)); best = sa[bidx]
+            ss = np.sort(sa)[::-1]; sec = ss[1] if len(ss)>1 else 0; delta = best-sec
+            med, std = float(np.median(sa)), float(np.std(sa))+1e-6; z = (best-med)/std
+            ng = best-nmx
+            obj = delta + 0.25*z + 0.10*ng
+            if obj > bo:
+                bo = obj; br = {'dx':dx,'dy':dy,'r_scale':rs,'coords':nc,'best_idx':bidx,'best':float(best),'second':float(sec),'delta':float(delta),'z':float(z),'noise_max':float(nmx),'noise_gap':float(ng),'objective':float(obj),'best_choice':choices[bidx] if bidx<len(choices) else None}
     return br
 
-def apply_rescue_pass(gray, rows, th, is_empty, bmi, choices):
+def apply_rescue_pass(gray, rows, th, is_empty, bmi, choices, fields=None):
     if is_empty: return rows
     mth, bth, margin = th['mark_th'], th['blank_th'], th['margin']; nm = max(0.008, 0.24*margin)
     for r in rows:
         if r.get('answer') is not None or r.get('status')=='MULTI': continue
         best, delta, rad = r['best'], r['delta'], r.get('radius',10)
         if not (best >= bth*0.90 or delta >= 1.5*margin): continue
-        rr = targeted_rescue(gray, r, th, bmi, choices)
+        rr = targeted_rescue(gray, r, th, bmi, choices, fields)
         if rr is None: continue
         nb, nd, nz, nc, nbi, nch, nng = rr['best'], rr['delta'], rr['z'], rr['coords'], rr['best_idx'], rr['best_choice'], rr['noise_gap']
         nink = compute_ink_ratio(gray, nc[nbi][0], nc[nbi][1], rad*rr['r_scale']) if nbi<len(nc) else 0
         so = is_strong_override(nb, nd, nz, mth, margin)
-        sta, _ = stability_check_soft(gray, nc, nbi, rad)
+        sta, _ = stability_check_soft(gray, nc, nbi, rad, fields=fields)
         accept = False
         if nb >= bth and nd >= 1.6*margin and nz >= 1.8:
             if nng >= nm or so:
@@ -870,7 +1522,7 @@ def apply_rescue_pass(gray, rows, th, is_empty, bmi, choices):
         r['tags'].append('RESCUE')
     return rows
 
-def apply_near_miss_rescue(gray, gcl, rows, th, is_empty, bmi, choices):
+def apply_near_miss_rescue(gray, gcl, rows, th, is_empty, bmi, choices, fields=None, cfields=None):
     if is_empty: return rows
     mth, bth, margin = th['mark_th'], th['blank_th'], th['margin']; rnm = max(0.015, 0.38*margin)
     for r in rows:
@@ -879,8 +1531,9 @@ def apply_near_miss_rescue(gray, gcl, rows, th, is_empty, bmi, choices):
         if vr not in ('BELOW_THRESH','INK_REL_FAIL','NV',None): continue
         best, delta, z, coords, rad, bidx = r['best'], r['delta'], r['z'], r['coords'], r.get('radius',10), r['best_idx']
         ss = r.get('signal_strong_enough', False)
-        gs = [score_bubble(gray, cx, cy, rad) for cx,cy in coords]
-        cs = [score_bubble(gcl, cx, cy, rad) for cx,cy in coords] if gcl is not None else gs
+        xs, ys = [cx for cx,cy in coords], [cy for cx,cy in coords]
+        gs = fill_scores(gray, xs, ys, rad, fields).tolist() if coords else []
+        cs = fill_scores(gcl, xs, ys, rad, cfields).tolist() if coords and gcl is not None else gs
         cg, cc = choices[int(np.argmax(gs))] if gs else None, choices[int(np.argmax(cs))] if cs else None
         bg, bc = max(gs) if gs else 0, max(cs) if cs else 0
         r['best_gray'], r['best_clahe'], r['choice_gray'], r['choice_clahe'] = round(bg,4), round(bc,4), cg, cc
@@ -891,12 +1544,59 @@ def apply_near_miss_rescue(gray, gcl, rows, th, is_empty, bmi, choices):
         nmx = compute_noise_max(gray, coords, rad); ng = best - nmx
         vs = z >= 3.0 and delta >= 3.5*margin
         if ng < rnm and not vs: r['tags'].append('NV_RESCUE_FAIL'); r['veto_reason'] = 'NV_RESCUE'; continue
-        sta, _ = stability_check_soft(gray, coords, bidx, rad)
+        sta, _ = stability_check_soft(gray, coords, bidx, rad, fields=fields)
         if not sta: r['tags'].append('CAND_FAIL(STAB)'); continue
         r.update({'answer':r['best_choice'],'confidence':min(100,int((delta/max(best,1e-6))*100)),'status':'NEAR_MISS_OK','tier':'NEAR_MISS_OK','flags':['NEAR_MISS_OK'],'veto_reason':None,'clahe_used':False,'clahe_enabled':bg>=mth-0.015})
         r['tags'].append('NEAR_MISS_OK')
     return rows
 
+def read_block(gray, gcl, blk, grid, choices, tm):
+    """Score, threshold and decide one block on its own (safe to run on a worker thread); stage laps go to tm.
+    Returns (rows, thresholds, empty)."""
+    ib1 = blk['name']=='block1'; empty = False
+    tm.skip()  # on a worker thread the CPU clock is that thread's own
+    # Score maps over this block, shared by scoring, stability and rescue.
+    roi = block_roi(grid) if grid and grid.get('x_centers') and grid.get('y_centers') else None
+    fields = FieldCache(gray, roi) if roi else None
+    TIMER.count('blocks')
+    # Measured once; the block's thresholds come from these rows and are attached to them, not re-measured.
+    rows, ri = process_block(gray, blk, grid, choices, ib1, fields)
+    tm.lap('score')
+    th = compute_thresholds(rows); th.update(ri)
+    for r in rows: r['mark_th'], r['blank_th'], r['margin'] = th['mark_th'], th['blank_th'], th['margin']
+    tm.lap('thresholds')
+    sc = sum(1 for r in rows if r['best']>=th['mark_th'] and r['delta']>=th['margin'] and r['z']>=Z_TH_OK)
+    fe = sc >= MIN_STRONG_MARKS_FOR_FAINT; ie = sc < MIN_STRONG_FOR_EMPTY_BLOCK
+    if ie: empty = True
+    bmi = calibrate_ink_threshold(rows, th['mark_th'], th['margin']) if not ie else None
+    th.update({'strong_count':sc,'faint_enabled':fe,'is_empty':ie,'median_ink':bmi})
+    rows = apply_decisions(gray, rows, th, fe, ie, bmi, choices, allow_faint_force=ib1, fields=fields)
+    tm.lap('decisions')
+    # Rescue passes cause too many false positives on real scans: opt-in only (OMR_RESCUE=1).
+    if RESCUE:
+        rows = apply_rescue_pass(gray, rows, th, ie, bmi, choices, fields)
+        rows = apply_near_miss_rescue(gray, gcl, rows, th, ie, bmi, choices, fields, FieldCache(gcl, roi) if roi else None)
+        tm.lap('rescue')
+    # If non-first block and very few answers found, treat entire block as empty to avoid noise-induced marks
+    if not ib1:
+        answered = sum(1 for r in rows if r.get('answer'))
+        if answered < 5:
+            for r in rows:
+                r.update({'answer': None, 'confidence': 0, 'status': 'EMPTY_BLOCK', 'flags': ['EMPTY_BLOCK'], 'tier': 'EMPTY_BLOCK'})
+            empty = True
+    return rows, th, empty
+
+_BLOCK_POOL = None
+
+def block_pool(n):
+    """Shared thread pool for per-block work; numpy/OpenCV kernels release the GIL."""
+    global _BLOCK_POOL
+    if _BLOCK_POOL is None or _BLOCK_POOL._max_workers < n:
+        from concurrent.futures import ThreadPoolExecutor
+        if _BLOCK_POOL: _BLOCK_POOL.shutdown(wait=False)
+        _BLOCK_POOL = ThreadPoolExecutor(max_workers=n, thread_name_prefix='omr-blocks')
+    return _BLOCK_POOL
+
 def create_preview(wp, blks, rows, choices, aths, eblks, dd=None):
     pv = cv2.cvtColor(wp, cv2.COLOR_GRAY2BGR) if len(wp.shape)==2 else wp.copy()
     cols = [(255,0,255),(0,255,255),(255,255,0)]
@@ -913,22 +1613,233 @@ def create_preview(wp, blks, rows, choices, aths, eblks, dd=None):
             elif st in ('NV','INK_REL_FAIL') and i==r.get('best_idx',-1): cl, th = (0,0,255), 2
             else: cl, th = (128,128,128), 1
             cv2.circle(pv, (int(cx),int(cy)), 10, cl, th)
-    if dd: cv2.imwrite(os.path.join(dd,'06_preview.png'), pv)
+    if dd: dd.debug('06_preview', pv)
     return pv
 
-def process(inp, tmpl, outd):
-    st = time.time()
-    try: template = json.loads(tmpl)
-    except: 
-        with open(tmpl,'r',encoding='utf-8') as f: template = json.load(f)
-    cfg = template.get('config', template); tk = template.get('key','unknown')
-    pw = cfg.get('page',{}).get('width', DEFAULT_PAGE_W); ph = cfg.get('page',{}).get('height', DEFAULT_PAGE_H)
-    choices = cfg.get('choices', ['A','B','C','D','E'])
-    dd = os.path.join(outd,'debug') if DEBUG else None
-    if dd: os.makedirs(dd, exist_ok=True)
-    meta = {'templateKey':tk,'expectedQuestionCount':EXPECTED_QUESTION_COUNT,'pageSize':[pw,ph],'strictMode':STRICT,'version':'v22'}
+ARTIFACT_FORMATS = {'png':('.png','image/png',None), 'jpg':('.jpg','image/jpeg',cv2.IMWRITE_JPEG_QUALITY), 'webp':('.webp','image/webp',cv2.IMWRITE_WEBP_QUALITY)}
+_ENCODER = None
+
+def artifact_encoder():
+    global _ENCODER
+    if _ENCODER is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _ENCODER = ThreadPoolExecutor(max_workers=2, thread_name_prefix='omr-artifacts')
+    return _ENCODER
+
+def encode_artifact(img, fmt, quality, scale):
+    """Downscale and encode one image; returns (ext, mime, bytes, wall s, thread CPU s). cv2 releases the GIL here."""
+    w, c = time.perf_counter(), time.thread_time()
+    ext, mime, qflag = ARTIFACT_FORMATS.get(fmt, ARTIFACT_FORMATS['png'])
+    if scale < 1.0: img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ok, buf = cv2.imencode(ext, img, [qflag, quality] if qflag is not None else [])
+    if not ok: raise RuntimeError(f"Cannot encode {ext}")
+    return ext, mime, buf.tobytes(), time.perf_counter()-w, time.thread_time()-c
+
+class SheetOutputs:
+    """
+    Artifact policy for one sheet: which images are kept (OMR_ARTIFACTS), how they are encoded
+    (OMR_ARTIFACT_FORMAT/QUALITY/SCALE) and whether debug captures survive (OMR_DEBUG_ON_ISSUE,
+    OMR_DEBUG_SAMPLE). Encoding runs on a background thread while the sheet is still being read;
+    result() waits for it and hands the bytes to store().
+    """
+    def __init__(self):
+        self.spec = (ARTIFACT_FORMAT, ARTIFACT_QUALITY, ARTIFACT_SCALE)
+        self.jobs, self.held, self.debug_dir = [], [], None
+        self.cache, self.cache_key, self.kept = None, None, []
+        self.peak_scope = 'process'
+
+    def wants(self, name):
+        return ARTIFACTS == 'all' or (ARTIFACTS == 'preview' and name == 'preview')
+
+    def image(self, name, img):
+        if not self.wants(name): return
+        self.jobs.append((name, False, artifact_encoder().submit(encode_artifact, img, *self.spec)))
+
+    def debug(self, name, img):
+        if not self.debug_dir or ARTIFACTS == 'none': return
+        # Kept until the sheet's outcome is known when capture is conditional.
+        if DEBUG_ON_ISSUE or DEBUG_SAMPLE > 0: self.held.append((name, img))
+        else: self.jobs.append((name, True, artifact_encoder().submit(encode_artifact, img, *self.spec)))
+
+    def finish(self, res):
+        if self.held:
+            issue = not res.get('meta', {}).get('cornerMarkersFound') or any(not str(a.get('status') or '').startswith('OK') for a in expand_answers(res))
+            if (DEBUG_ON_ISSUE and issue) or (DEBUG_SAMPLE > 0 and random.random()*100 < DEBUG_SAMPLE):
+                self.jobs += [(n, True, artifact_encoder().submit(encode_artifact, im, *self.spec)) for n, im in self.held]
+            self.held = []
+        for name, dbg, fut in self.jobs:
+            ext, mime, data, ew, ec = fut.result()
+            TIMER.add('encode (background)', ew, ec); TIMER.count('images_encoded')
+            if dbg:
+                os.makedirs(self.debug_dir, exist_ok=True)
+                with open(os.path.join(self.debug_dir, name+ext), 'wb') as f: f.write(data)
+            else:
+                self.store(name, ext, mime, data)
+                if self.cache_key: self.kept.append((name, ext, mime, data))
+        self.jobs = []
+        TIMER.lap('artifacts')
+        if self.cache_key and isinstance(res.get('meta'), dict):
+            res['meta']['cache'] = self.cache.put(self.cache_key, res, self.kept); TIMER.lap('cache_store')
+        if isinstance(res.get('meta'), dict):
+            res['meta']['timings'] = TIMER.report()
+            mem = res['meta'].get('memory')
+            if isinstance(mem, dict):
+                mem.update(peakRssMb=rss_mb('VmHWM'), scope=self.peak_scope)
+                if mem.get('budgetMb'): mem['overBudget'] = mem['peakRssMb'] > mem['budgetMb']
+
+    def replay(self, res, images):
+        """Return a cached result through this sheet's outputs (images stored as if freshly encoded)."""
+        self.cache_key = None
+        for name, ext, mime, data in images: self.store(name, ext, mime, data)
+        if isinstance(res.get('meta'), dict): res['meta']['cache'] = self.cache.stats(hit=True)
+        return self.result(res)
+
+class DirOutputs(SheetOutputs):
+    """Sheet outputs as files: result.json plus images in the output directory."""
+    def __init__(self, outd):
+        super().__init__(); self.outd, self.images = outd, []
+
+    def store(self, name, ext, mime, data):
+        p = os.path.join(self.outd, name+ext)
+        with open(p, 'wb') as f: f.write(data)
+        self.images.append({'name':name,'mime':mime,'path':p})
+
+    def result(self, res):
+        self.finish(res)
+        rp = os.path.join(self.outd,'result.json')
+        with open(rp,'w',encoding='utf-8') as f:
+            if RESULT_FORMAT == 'compact': json.dump(res, f, separators=(',',':'), ensure_ascii=False)
+            else: json.dump(res, f, indent=2, ensure_ascii=False)
+        pvp = next((i['path'] for i in self.images if i['name'] == 'preview'), None)
+        return {'success':True,'resultPath':rp,'previewPath':pvp,'images':self.images}
+
+class MemoryOutputs(SheetOutputs):
+    """Sheet outputs kept in memory (result dict + encoded images) for the framed protocol."""
+    def __init__(self):
+        super().__init__(); self.images = {}
+
+    def store(self, name, ext, mime, data): self.images[name] = (mime, data)
+
+    def result(self, res):
+        self.finish(res)
+        return {'success':True,'result':res,'images':[{'name':n,'mime':m} for n,(m,_) in self.images.items()]}
+
+class ResultCache:
+    """
+    Finished sheets on local disk, one file per key: a result frame plus its encoded images as blobs
+    (the serve framing). Reads refresh the file's mtime; writes evict least recently used files
+    once the directory exceeds the size cap. Hit/miss counters are per worker process.
+    """
+    def __init__(self, root, cap_mb):
+        self.root, self.cap = root, int(cap_mb * 1024 * 1024)
+        self.hits = self.misses = self.evicted = 0
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(inp, img, tp):
+        h = hashlib.sha256()
+        # Everything that changes the result or its images; DEBUG changes the preview-only overlay.
+        opts = (STRICT, FAINT_MODE, USE_GRID, PREVIEW_ONLY, LIMIT_FIRST_BLOCK, MAX_QUESTIONS, OVERRIDE_CORNERS, ANCHORS, RESCUE,
+                GEOMETRY, RESULT_FORMAT, ARTIFACTS, ARTIFACT_FORMAT, ARTIFACT_QUALITY, ARTIFACT_SCALE, COLOR_ARTIFACTS, DEBUG,
+                DECODE, MEMORY_BUDGET_MB)
+        h.update(json.dumps([VERSION, CODE_DIGEST, tp.digest, opts]).encode('utf-8'))
+        if img is None:
+            with open(inp, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''): h.update(chunk)
+        elif isinstance(img, (bytes, bytearray)): h.update(img)
+        else: h.update(repr((img.shape, img.dtype.str)).encode('ascii')); h.update(np.ascontiguousarray(img).data)
+        return h.hexdigest()
+
+    def path(self, k): return os.path.join(self.root, k + '.omr')
+
+    def stats(self, hit):
+        return {'hit':hit, 'hits':self.hits, 'misses':self.misses, 'evicted':self.evicted}
+
+    def get(self, k):
+        p = self.path(k)
+        try:
+            with open(p, 'rb') as f: fr = read_frame(f)
+            os.utime(p)
+        except (OSError, ValueError): fr = None
+        if not fr or 'result' not in fr or len(fr['_blobs']) != len(fr.get('images', [])):
+            self.misses += 1; return None
+        self.hits += 1
+        return fr['result'], [(*im, data) for im, data in zip(fr['images'], fr['_blobs'])]
+
+    def put(self, k, res, images):
+        tmp = self.path(k) + f'.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as f: write_frame(f, {'result':res, 'images':[list(im[:3]) for im in images]}, [im[3] for im in images])
+            os.replace(tmp, self.path(k))
+            self.evict()
+        except OSError:
+            if os.path.exists(tmp): os.unlink(tmp)
+        return self.stats(hit=False)
+
+    def evict(self):
+        ents = []
+        with os.scandir(self.root) as it:
+            for e in it:
+                if not e.name.endswith('.omr'): continue
+                try: st = e.stat(); ents.append((st.st_mtime, st.st_size, e.path))
+                except OSError: pass
+        tot = sum(e[1] for e in ents)
+        for _, sz, p in sorted(ents):
+            if tot <= self.cap: break
+            try: os.unlink(p); tot -= sz; self.evicted += 1
+            except OSError: pass
+
+_CACHES = {}
+
+def result_cache():
+    """The ResultCache for the current OMR_CACHE_DIR / OMR_CACHE_MB, or None when caching is off."""
+    if not CACHE_DIR: return None
+    k = (os.path.abspath(CACHE_DIR), CACHE_MB)
+    if k not in _CACHES: _CACHES[k] = ResultCache(*k)
+    return _CACHES[k]
+
+def process(inp, tmpl, outd, img=None, out=None, plan=None):
+    """Read one sheet (path, decoded image or encoded bytes); OMR_PROFILE wraps it in cProfile."""
+    global TIMER
+    TIMER = StageTimer()
+    out = out or DirOutputs(outd)
+    out.peak_scope = 'sheet' if reset_peak_rss() else 'process'
+    out.cache = result_cache()
+    if out.cache:
+        # An unreadable input is left to the normal path (and its error message).
+        try: out.cache_key = out.cache.key(inp, img, load_template(tmpl))
+        except OSError: out.cache_key = None
+        hit = out.cache.get(out.cache_key) if out.cache_key else None; TIMER.lap('cache')
+        if hit: return out.replay(*hit)
+    if not PROFILE: return _process(inp, tmpl, outd, img, out, plan)
+    import cProfile
+    pr = cProfile.Profile(); pr.enable()
+    try: return _process(inp, tmpl, outd, img, out, plan)
+    finally:
+        pr.disable()
+        # Inline serve requests have no output folder: their profiles go to <tmp>/omr-profile instead.
+        import tempfile
+        pd = PROFILE if PROFILE != '1' else outd or os.path.join(tempfile.gettempdir(), 'omr-profile')
+        pp = os.path.join(pd, 'profile.pstats' if PROFILE == '1' and outd else f'{os.getpid()}_{int(time.time()*1000)}.pstats')
+        os.makedirs(pd, exist_ok=True); pr.dump_stats(pp)
+        if not outd and PROFILE == '1': print(f'[OMR] profile written to {pp}', file=sys.stderr, flush=True)
+
+def _process(inp, tmpl, outd, img=None, out=None, plan=None):
+    tp = load_template(tmpl).activate()
+    tk, pw, ph, choices = tp.key, tp.pw, tp.ph, tp.choices
+    out = out or DirOutputs(outd)
+    if (DEBUG or DEBUG_ON_ISSUE or DEBUG_SAMPLE > 0) and outd and ARTIFACTS != 'none': out.debug_dir = os.path.join(outd,'debug')
+    dd = out if out.debug_dir else None
+    meta = {'templateKey':tk,'expectedQuestionCount':EXPECTED_QUESTION_COUNT,'pageSize':[pw,ph],'strictMode':STRICT,'version':VERSION}
     warnings = []
-    img = load_image(inp)
+    # Colour source only when a stored artifact will show it.
+    color = wants_color()
+    if img is None: img, plan = load_image(inp, tp, color)
+    elif isinstance(img, (bytes, bytearray)): img, plan = decode_image(img, tp, color)
+    plan = plan or {'size': list(img.shape[1::-1]), 'reduce': 1, 'gray': img.ndim == 2}
+    meta['memory'] = {'decode': {k: plan[k] for k in ('size', 'reduce', 'gray')}, 'budgetMb': MEMORY_BUDGET_MB or None}
+    if 'estimateMb' in plan: meta['memory']['estimateMb'] = plan['estimateMb']
+    TIMER.lap('decode')
     override_corners = None
     if OVERRIDE_CORNERS:
         try:
@@ -942,214 +1853,398 @@ def process(inp, tmpl, outd):
         except Exception as e:
             warnings.append(f"anchor_parse_fail:{e}")
 
+    # Corners are searched on a grayscale rough warp; the page itself is one warp of the source
+    # through the composed homography, so it is resampled once.
+    sg = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape)==3 else img
+    H = None
+    trusted = False
     if override_corners:
-        wf, cok, warn = apply_override_corners(img, pw, ph, override_corners, dd)
-        wr = wf
-    else:
-        wr, _ = rough_page_warp(img, pw, ph, dd)
-        wf, cok, warn = fine_warp_with_corners(wr, pw, ph, dd)
+        H, cok, warn = override_homography(sg, pw, ph, override_corners, plan['reduce'])
+        if warn: warnings.append(warn)
+    if H is None:
+        M, ps = rough_page_homography(sg, pw, ph)
+        TIMER.lap('rough_warp')
+        F, cok, warn, trusted = fine_corner_homography(sg, M, pw, ph, dd); TIMER.lap('corners')
+        meta['detectScale'] = {'page': round(ps, 4), 'corners': CORNER_DETECT_SCALE}
+        if warn: warnings.append(warn)
+        H = M if F is None else F @ M
+    gray = cv2.warpPerspective(sg, H, (pw,ph)); TIMER.lap('warp')
+    if dd: dd.debug('04_final', gray)
     meta['cornerMarkersFound'] = cok
-    if warn: warnings.append(warn)
-    gray = cv2.cvtColor(wf, cv2.COLOR_BGR2GRAY) if len(wf.shape)==3 else wf
-    binary = build_binary(gray)
+    wf = cv2.warpPerspective(img, H, (pw,ph)) if color and len(img.shape)==3 else gray
+    # The source is not needed past the page warp.
+    del img, sg
+    # Only the answer columns that can reach the result are detected, gridded and scored (not in grid or
+    # preview mode, which read the whole sheet).
+    nb = tp.qcols if USE_GRID or PREVIEW_ONLY else tp.requested_blocks()
+    if nb < tp.qcols: meta['blocksRequested'] = nb
+    pg = PageContext(gray, tp, dd, nb)
     # Persist warped image for UI preview (no overlays)
     try:
-        cv2.imwrite(os.path.join(outd, 'warped.png'), wf)
+        out.image('warped', wf)
     except Exception:
         pass
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8)); gcl = clahe.apply(gray)
     # Optional grid-based reading (off by default). Circle/anchor model is the primary path.
     use_grid = USE_GRID
-    cir = detect_circles(gray, dd); meta['totalCircles'] = len(cir)
-    acir = isolate_answer_circles(cir, pw, ph); blks = split_into_blocks(acir, pw); meta['blocksDetected'] = len(blks)
+    # Trusted corners put the page in template coordinates: project the known bubble grid, Hough only as fallback.
+    blks = None
+    if GEOMETRY == 'auto' and trusted and len(tp.bubble_grid or ()) >= nb and not (use_grid or PREVIEW_ONLY or anchors):
+        pg.answer_region([])
+        blks, offs = project_blocks(pg.binary, tp, nb); TIMER.lap('project')
+        if blks: meta['geometry'] = {'path':'projected', 'grid':'template', 'blockOffsets':offs}
+        else: meta['geometry'] = {'path':'hough', 'fallback':offs}
+    if blks:
+        meta['blocksDetected'] = len(blks)
+    else:
+        cir = pg.circles; meta['totalCircles'] = len(cir); TIMER.lap('detect_circles')
+        acir = isolate_answer_circles(cir, pw, ph); blks = split_into_blocks(acir, pw, nb); meta['blocksDetected'] = len(blks)
+        pg.answer_region(acir)
+        meta.setdefault('geometry', {'path':'hough'})
+        TIMER.lap('blocks')
     if PREVIEW_ONLY:
         if use_grid:
-            grid_rows, grid_meta = read_grid_answers(binary, cfg, pw, ph, choices, blocks=blks)
+            grid_rows, grid_meta = read_grid_answers(pg.binary, tp, blocks=blks)
             auto_anchors = grid_meta.get('anchors', {})
         else:
-            auto_anchors = infer_auto_anchors_from_grid(blks, binary, pw)
-        res = {
-            'templateKey': tk,
-            'answers': [],
-            'summary': {'total': 0, 'answered': 0, 'ok': 0},
-            'meta': meta,
-            'anchors': anchors or auto_anchors
-        }
-        rp = os.path.join(outd, 'result.json')
-        with open(rp,'w',encoding='utf-8') as f: json.dump(res, f, indent=2, ensure_ascii=False)
+            auto_anchors = infer_auto_anchors_from_grid(blks, pg.binary, pw)
+        TIMER.lap('anchors')
+        res = sheet_result(tk, [], choices, meta, anchors or auto_anchors)
         # Also provide a minimal preview overlay if debug enabled
         if DEBUG:
             pv = create_preview(wf, blks, [], choices, {}, set(), dd)
-            pvp = os.path.join(outd, 'preview.png'); cv2.imwrite(pvp, pv)
+            out.image('preview', pv)
         else:
-            pvp = os.path.join(outd, 'preview.png')
-            cv2.imwrite(pvp, wf)
-        return {'success':True,'resultPath':rp,'previewPath':pvp}
+            out.image('preview', wf)
+        TIMER.lap('preview')
+        return out.result(res)
     if use_grid:
-        rows, grid_meta = read_grid_answers(binary, cfg, pw, ph, choices, blocks=blks)
-        arows = rows
+        rows, grid_meta = read_grid_answers(pg.binary, tp, blocks=blks)
+        arows = rows; TIMER.lap('grid_read')
         aths, eblks = {}, set()
         auto_anchors = grid_meta.get('anchors', {})
         pv = create_preview(wf, blks, arows, choices, aths, eblks, dd)
-        pvp = os.path.join(outd,'preview.png'); cv2.imwrite(pvp, pv)
-        ok = sum(1 for r in arows if r.get('status','').startswith('OK'))
-        ans = sum(1 for r in arows if r.get('answer'))
+        out.image('preview', pv); TIMER.lap('preview')
+        # Summary counts cover every detected row, before padding and the question limit.
+        counted = list(arows)
         # Normalize to existing API schema.
         ex = {r['question'] for r in arows}
-        for q in range(1, EXPECTED_QUESTION_COUNT+1):
-            if q not in ex:
-                arows.append({
-                    'question': q,
-                    'answer': None,
-                    'confidence': 0,
-                    'scores': {},
-                    'flags': ['BLANK', 'NOT_DETECTED'],
-                    'status': 'NOT_DETECTED',
-                    'block': 'unknown',
-                    'tier': 'NOT_DETECTED',
-                    'tags': [],
-                    'veto_reason': None,
-                    'coords': [],
-                    'best_idx': 0,
-                    'scores_list': [],
-                    'best': 0.0,
-                    'delta': 0.0,
-                    'z': 0.0,
-                    'noise_gap': 0.0,
-                    'ink_ratio': 0.0
-                })
+        arows += [Row.missing(q) for q in range(1, EXPECTED_QUESTION_COUNT+1) if q not in ex]
         arows.sort(key=lambda r:r['question'])
         if MAX_QUESTIONS > 0:
             arows = arows[:MAX_QUESTIONS]
         else:
             arows = arows[: (EXPECTED_QUESTION_COUNT if not LIMIT_FIRST_BLOCK else ROWS_PER_BLOCK)]
-        res = {
-            'templateKey': tk,
-            'answers': [{
-                'question': r['question'],
-                'answer': r.get('answer'),
-                'confidence': r.get('confidence', 0),
-                'scores': r.get('scores', {}),
-                'flags': r.get('flags', []),
-                'block': r.get('block'),
-                'status': r.get('status'),
-                'best': float(r.get('best', 0.0) or 0.0),
-                'delta': float(r.get('delta', 0.0) or 0.0),
-                'z': float(r.get('z', 0.0) or 0.0),
-                'noise_gap': float(r.get('noise_gap', 0.0) or 0.0),
-                'ink_ratio': float(r.get('ink_ratio', 0.0) or 0.0),
-                'tier': r.get('tier'),
-                'veto_reason': r.get('veto_reason'),
-                'tags': r.get('tags', [])
-            } for r in arows],
-            'summary': {'total': len(arows), 'answered': ans, 'ok': ok},
-            'meta': meta,
-            'anchors': anchors or auto_anchors
-        }
-        rp = os.path.join(outd,'result.json')
-        with open(rp,'w',encoding='utf-8') as f: json.dump(res, f, indent=2, ensure_ascii=False)
-        return {'success':True,'resultPath':rp,'previewPath':pvp}
+        res = sheet_result(tk, arows, choices, meta, anchors or auto_anchors, counted)
+        return out.result(res)
 
     arows, aths, eblks = [], {}, set()
     auto_anchors = {}
     # Pre-compute auto anchors from detected circles (used as fallback when manual anchors are not provided).
-    auto_anchors = infer_auto_anchors_from_grid(blks, binary, pw)
+    auto_anchors = infer_auto_anchors_from_grid(blks, pg.binary, pw)
+    TIMER.lap('anchors')
+    # Grids are built in block order: a block's grid can lean on the anchors captured from the blocks before it.
+    grids = []
     for blk in blks:
         ib1 = blk['name']=='block1'
         # Pass anchor data to grid builder
         akey = anchors or auto_anchors
-        grid = build_grid_fixed_rows(blk, ROWS_PER_BLOCK, anchor=akey, binary=binary, pw=pw)
-        ith = {'mark_th':MARK_TH_FLOOR,'blank_th':0.05,'margin':MARGIN_TH_FLOOR}
-        rows, ri = process_block(gray, blk, grid, choices, ith, ib1)
-        th = compute_thresholds(rows); th.update(ri)
-        for r in rows: r['mark_th'], r['blank_th'], r['margin'] = th['mark_th'], th['blank_th'], th['margin']
-        rows, ri = process_block(gray, blk, grid, choices, th, ib1)
-        sc = sum(1 for r in rows if r['best']>=th['mark_th'] and r['delta']>=th['margin'] and r['z']>=Z_TH_OK)
-        fe = sc >= MIN_STRONG_MARKS_FOR_FAINT; ie = sc < MIN_STRONG_FOR_EMPTY_BLOCK
-        if ie: eblks.add(blk['name'])
-        bmi = calibrate_ink_threshold(rows, th['mark_th'], th['margin']) if not ie else None
-        th.update({'strong_count':sc,'faint_enabled':fe,'is_empty':ie,'median_ink':bmi}); aths[blk['name']] = th
-        rows = apply_decisions(gray, rows, th, fe, ie, bmi, choices, allow_faint_force=ib1)
-        # DISABLED: Rescue passes cause too many false positives
-        # rows = apply_rescue_pass(gray, rows, th, ie, bmi, choices)
-        # rows = apply_near_miss_rescue(gray, gcl, rows, th, ie, bmi, choices)
-        # If non-first block and very few answers found, treat entire block as empty to avoid noise-induced marks
-        if not ib1:
-            answered = sum(1 for r in rows if r.get('answer'))
-            if answered < 5:
-                for r in rows:
-                    r.update({'answer': None, 'confidence': 0, 'status': 'EMPTY_BLOCK', 'flags': ['EMPTY_BLOCK'], 'tier': 'EMPTY_BLOCK'})
-                eblks.add(blk['name'])
+        grid = blk.get('grid') or build_grid_fixed_rows(blk, ROWS_PER_BLOCK, anchor=akey, binary=pg.binary, pw=pw)
+        grids.append(grid)
         # Capture auto anchors from computed grid for debugging/preview
         if grid and not anchors:
             xct, yct = grid.get('x_centers', []), grid.get('y_centers', [])
-            if len(xct) >= 5 and len(yct) >= ROWS_PER_BLOCK:
+            if len(xct) >= CHOICES_PER_ROW and len(yct) >= ROWS_PER_BLOCK:
                 if ib1:
                     auto_anchors['q1A'] = [float(xct[0]), float(yct[0])]
-                    auto_anchors['q1E'] = [float(xct[4]), float(yct[0])]
+                    auto_anchors['q1E'] = [float(xct[CHOICES_PER_ROW - 1]), float(yct[0])]
                 else:
                     auto_anchors['q53A'] = [float(xct[0]), float(yct[0])]
+    TIMER.lap('grid')
+    # Blocks are independent from here on: scored and decided concurrently unless OMR_BLOCK_THREADS=1.
+    gcl = pg.clahe if RESCUE else None
+    nt = min(BLOCK_THREADS, len(blks))
+    if nt > 1:
+        tms = [StageTimer(cpu=time.thread_time) for _ in blks]
+        futs = [block_pool(nt).submit(read_block, gray, gcl, blk, grid, choices, tm) for blk, grid, tm in zip(blks, grids, tms)]
+        done = [f.result() for f in futs]
+        for tm in tms: TIMER.merge(tm)
+        TIMER.skip(); TIMER.count('parallel_blocks', len(blks))
+    else:
+        done = [read_block(gray, gcl, blk, grid, choices, TIMER) for blk, grid in zip(blks, grids)]
+    for blk, (rows, th, empty) in zip(blks, done):
+        aths[blk['name']] = th
+        if empty: eblks.add(blk['name'])
         arows.extend(rows)
     arows.sort(key=lambda r:r['question'])
     if LIMIT_FIRST_BLOCK:
         arows = [r for r in arows if r.get('block') == 'block1' or r.get('question',0) <= ROWS_PER_BLOCK]
     ex = {r['question'] for r in arows}
-    for q in range(1, EXPECTED_QUESTION_COUNT+1):
-        if q not in ex:
-            arows.append({
-                'question': q,
-                'answer': None,
-                'confidence': 0,
-                'scores': {},
-                'flags': ['BLANK', 'NOT_DETECTED'],
-                'status': 'NOT_DETECTED',
-                'block': 'unknown',
-                'tier': 'NOT_DETECTED',
-                'tags': [],
-                'veto_reason': None,
-                'best': 0.0,
-                'delta': 0.0,
-                'z': 0.0,
-                'noise_gap': 0.0,
-                'ink_ratio': 0.0
-            })
+    arows += [Row.missing(q) for q in range(1, EXPECTED_QUESTION_COUNT+1) if q not in ex]
     arows.sort(key=lambda r:r['question'])
     if MAX_QUESTIONS > 0:
         arows = arows[:MAX_QUESTIONS]
     else:
         arows = arows[: (ROWS_PER_BLOCK if LIMIT_FIRST_BLOCK else EXPECTED_QUESTION_COUNT)]
-    pv = create_preview(wf, blks, arows, choices, aths, eblks, dd)
-    pvp = os.path.join(outd,'preview.png'); cv2.imwrite(pvp, pv)
-    ok = sum(1 for r in arows if r.get('status','').startswith('OK'))
-    ans = sum(1 for r in arows if r.get('answer'))
-    res = {
-        'templateKey': tk,
-        'answers': [{
-            'question': r['question'],
-            'answer': r.get('answer'),
-            'confidence': r.get('confidence', 0),
-            'scores': r.get('scores', {}),
-            'flags': r.get('flags', []),
-            'block': r.get('block'),
-            'status': r.get('status'),
-            'best': float(r.get('best', 0.0) or 0.0),
-            'delta': float(r.get('delta', 0.0) or 0.0),
-            'z': float(r.get('z', 0.0) or 0.0),
-            'noise_gap': float(r.get('noise_gap', 0.0) or 0.0),
-            'ink_ratio': float(r.get('ink_ratio', 0.0) or 0.0),
-            'tier': r.get('tier'),
-            'veto_reason': r.get('veto_reason'),
-            'tags': r.get('tags', [])
-        } for r in arows],
-        'summary': {'total': len(arows), 'answered': ans, 'ok': ok},
-        'meta': meta,
-        'anchors': anchors or auto_anchors
-    }
-    rp = os.path.join(outd,'result.json')
-    with open(rp,'w',encoding='utf-8') as f: json.dump(res, f, indent=2, ensure_ascii=False)
-    return {'success':True,'resultPath':rp,'previewPath':pvp}
+    TIMER.lap('assemble')
+    if out.wants('preview') or dd:
+        out.image('preview', create_preview(wf, blks, arows, choices, aths, eblks, dd)); TIMER.lap('preview')
+    res = sheet_result(tk, arows, choices, meta, anchors or auto_anchors)
+    return out.result(res)
+
+def process_pages(inp, tmpl, outd, emit):
+    """Process every page of a PDF/TIFF stack, emitting one record per page as it finishes."""
+    st = time.time(); n = failed = 0
+    for i, img, plan in iter_pages(inp, load_template(tmpl), wants_color()):
+        pd = os.path.join(outd, f'page_{i+1:04d}'); os.makedirs(pd, exist_ok=True)
+        try: rec = {'type':'page','page':i+1, **process(inp, tmpl, pd, img=img, plan=plan)}
+        except Exception as e: rec = {'type':'page','page':i+1,'success':False,'error':str(e)}; failed += 1
+        del img; n += 1
+        emit(rec)
+    return {'type':'done','pages':n,'failed':failed,'elapsedMs':int((time.time()-st)*1000)}
+
+BATCH_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.pdf') + TIFF_EXTS
+
+def collect_batch_inputs(src):
+    """Directory of scans, JSON manifest (list or {"inputs": [...]}) or one path per line."""
+    if os.path.isdir(src):
+        return [os.path.join(src, f) for f in sorted(os.listdir(src)) if Path(f).suffix.lower() in BATCH_EXTS]
+    with open(src, 'r', encoding='utf-8') as f: raw = f.read()
+    try:
+        items = json.loads(raw)
+        if isinstance(items, dict): items = items.get('inputs', [])
+    except ValueError:
+        items = [l.strip() for l in raw.splitlines() if l.strip() and not l.strip().startswith('#')]
+    base = os.path.dirname(os.path.abspath(src))
+    return [p if os.path.isabs(p) else os.path.join(base, p) for p in items]
+
+_BATCH_Q = None
+
+def _batch_init(threads, q):
+    # N processes x default OpenCV threads (or block threads) would oversubscribe the box.
+    global BLOCK_THREADS, _BATCH_Q
+    cv2.setNumThreads(threads); BLOCK_THREADS = min(BLOCK_THREADS, threads); _BATCH_Q = q
+
+def _batch_sheet(idx, inp, tmpl, outd):
+    """Read one input; every record (each page of a stack) goes to the parent's queue as it finishes, then None."""
+    sd = os.path.join(outd, f'{idx:04d}_{Path(inp).stem}'); os.makedirs(sd, exist_ok=True)
+    def emit(rec):
+        rec.update({'type':'sheet','index':idx,'input':inp}); _BATCH_Q.put(rec)
+    st = time.time()
+    try:
+        if Path(inp).suffix.lower() in ('.pdf',) + TIFF_EXTS:
+            t0 = [time.time()]
+            def page(rec):
+                rec['elapsedMs'] = round((time.time()-t0[0])*1000, 1); t0[0] = time.time(); emit(rec)
+            process_pages(inp, tmpl, sd, page)
+        else:
+            emit({**process(inp, tmpl, sd), 'elapsedMs':round((time.time()-st)*1000, 1)})
+    except Exception as e:
+        emit({'success':False,'error':str(e),'elapsedMs':round((time.time()-st)*1000, 1)})
+    finally:
+        _BATCH_Q.put(None)
+
+def grade_responses(responses, key, choices=None):
+    """
+    Grade every sheet against the answer key as one response matrix. responses: one {question: answer}
+    per student; key: {question: answer}. Only key questions are items; a missing or null answer is empty.
+    Items carry difficulty (share correct), point-biserial against the rest score (total without the
+    item; null when either side is constant) and how often each choice, or nothing, was marked.
+    """
+    key = {str(q):a for q, a in key.items()}; responses = [{str(q):a for q, a in (r or {}).items()} for r in responses]
+    qs = sorted(key, key=lambda q: (len(q), q)); kv = [key[q] for q in qs]
+    choices = list(choices or sorted({a for r in responses for a in r.values() if a} | {k for k in kv if k}))
+    ci = {c:i for i, c in enumerate(choices)}; n, m, nc = len(responses), len(qs), len(choices)
+    R = np.array([[ci.get(r.get(q), -1) for q in qs] for r in responses], dtype=np.int16).reshape(n, m)
+    K = np.array([ci.get(k, -2) for k in kv], dtype=np.int16)
+    answered = R >= 0; correct = R == K[None, :]
+    tot = correct.sum(axis=1); nans = answered.sum(axis=1)
+    pct = np.floor(tot*100.0/max(m, 1) + 0.5).astype(int)
+    cf = correct.astype(np.float64)
+    diff = cf.sum(axis=0) / max(n, 1)
+    # Corrected item-total correlation: the item's own point is taken out of the score it is compared with.
+    rest = tot[:, None] - cf
+    x, y = cf - diff, rest - rest.sum(axis=0) / max(n, 1)
+    den = np.sqrt((x*x).sum(axis=0) * (y*y).sum(axis=0))
+    rpb = np.divide((x*y).sum(axis=0), den, out=np.full(m, np.nan), where=den > 0)
+    # Column 0 counts blanks, 1.. the choices; one bincount over item-offset codes.
+    cnt = np.bincount((R.astype(np.int64) + 1 + (nc+1)*np.arange(m)).ravel(), minlength=m*(nc+1)).reshape(m, nc+1)
+    students = [{'correct':int(c), 'wrong':int(a-c), 'empty':m-int(a), 'total':m, 'percentage':int(p)} for c, a, p in zip(tot, nans, pct)]
+    items = [{'question':int(q) if q.isdigit() else q, 'key':k, 'difficulty':round(float(d), 4),
+              'pointBiserial':None if np.isnan(b) else round(float(b), 4),
+              'distractors':{**{c:int(v) for c, v in zip(choices, cr[1:])}, 'blank':int(cr[0])}}
+             for q, k, d, b, cr in zip(qs, kv, diff, rpb, cnt.tolist())]
+    sp = pct.astype(np.float64)
+    return {'students':students, 'items':items, 'choices':choices,
+            'summary':{'students':n, 'items':m, 'meanPercentage':round(float(sp.mean()), 2) if n else None,
+                       'stdPercentage':round(float(sp.std()), 2) if n else None}}
+
+def grade_args(req):
+    if not isinstance(req.get('key'), dict) or not isinstance(req.get('responses'), list):
+        raise ValueError("grade needs 'key' (object) and 'responses' (list)")
+    return {'responses':req['responses'], 'key':req['key'], 'choices':req.get('choices')}
+
+def run_batch(src, tmpl, outd, workers=None, emit=None, key=None):
+    """Fan sheets out over a process pool; stream per-sheet records (per page for PDF/TIFF stacks) as they
+    finish. With an answer key the summary also carries grade_responses() over every sheet read."""
+    import multiprocessing, queue
+    from concurrent.futures import ProcessPoolExecutor
+    emit = emit or (lambda rec: print(json.dumps(rec), flush=True))
+    inputs = collect_batch_inputs(src)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(inputs) or 1))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    st = time.time(); lat = []; failed = 0; graded = []
+    ctx = multiprocessing.get_context(); q = ctx.Queue(); left = len(inputs)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_batch_init, initargs=(threads, q)) as ex:
+        futs = [ex.submit(_batch_sheet, i, inp, tmpl, outd) for i, inp in enumerate(inputs)]
+        while left:
+            try: rec = q.get(timeout=0.5)
+            except queue.Empty:
+                # A dead pool process never sends its end marker: surface the error as before.
+                for fut in futs:
+                    if fut.done() and fut.exception(): fut.result()
+                continue
+            if rec is None: left -= 1; continue
+            # Throughput and latency describe sheets that were read; a fast failure would flatter both.
+            if rec.get('success'): lat.append(rec.get('elapsedMs', 0.0))
+            else: failed += 1
+            if key and rec.get('success') and rec.get('resultPath'):
+                with open(rec['resultPath'], 'r', encoding='utf-8') as f: res = json.load(f)
+                graded.append(((rec['index'], rec.get('page', 0)), rec['input'], rec.get('page'), {a['question']:a.get('answer') for a in expand_answers(res)}))
+            emit(rec)
+    el = time.time() - st
+    la = np.array(lat) if lat else np.zeros(1)
+    summ = {'type':'summary','inputs':len(inputs),'sheets':len(lat),'failed':failed,'workers':workers,'cvThreads':threads,
+            'elapsedMs':round(el*1000, 1),'sheetsPerSec':round(len(lat)/el, 3) if el > 0 else 0.0,
+            'latencyMs':{'p50':round(float(np.percentile(la,50)),1),'p95':round(float(np.percentile(la,95)),1),'max':round(float(la.max()),1)}}
+    if key:
+        graded.sort(key=lambda g: g[0])
+        gr = grade_responses([g[3] for g in graded], key, load_template(tmpl).choices)
+        for (_, inp, pg, _), stu in zip(graded, gr['students']): stu.update({'input':inp, **({'page':pg} if pg else {})})
+        summ['grading'] = gr
+    return summ
+
+def read_blob(stream):
+    """Read one length-prefixed (uint32 big-endian) frame as raw bytes; None on EOF."""
+    hdr = stream.read(4)
+    if len(hdr) < 4: return None
+    n = struct.unpack('>I', hdr)[0]; buf = bytearray()
+    while len(buf) < n:
+        chunk = stream.read(n - len(buf))
+        if not chunk: return None
+        buf += chunk
+    return bytes(buf)
+
+def read_frame(stream):
+    """Read one JSON frame; None on EOF. A 'blobs': N header pulls the N raw frames after it into '_blobs'."""
+    buf = read_blob(stream)
+    if buf is None: return None
+    obj = json.loads(buf.decode('utf-8')); blobs = []
+    for _ in range(int(obj.get('blobs') or 0)):
+        b = read_blob(stream)
+        if b is None: return None
+        blobs.append(b)
+    obj['_blobs'] = blobs
+    return obj
+
+def write_frame(stream, obj, blobs=()):
+    data = json.dumps({**obj, 'blobs':len(blobs)} if blobs else obj, ensure_ascii=False).encode('utf-8')
+    parts = [struct.pack('>I', len(data)), data]
+    for b in blobs: parts += [struct.pack('>I', len(b)), b]
+    stream.write(b''.join(parts)); stream.flush()
+
+def handle_request(req, state):
+    """Run one request; returns (response, binary frames to send after it)."""
+    rid, op = req.get('id'), req.get('op', 'process')
+    if op == 'ping':
+        return {'id':rid,'ok':True,'op':'pong','pid':os.getpid(),'served':state['served']}, ()
+    if op == 'grade':
+        try: return {'id':rid,'ok':True,'result':grade_responses(**grade_args(req))}, ()
+        except Exception as e: return {'id':rid,'ok':False,'error':str(e),'traceback':traceback.format_exc()}, ()
+        finally: state['served'] += 1
+    if op not in ('process', 'pages'):
+        return {'id':rid,'ok':False,'error':f'unknown op: {op}'}, ()
+    # Per-request env overrides on top of the process env; absent keys fall back to defaults.
+    configure({**os.environ, **{k:str(v) for k,v in (req.get('env') or {}).items() if v is not None}})
+    try:
+        if req.get('outdir'): os.makedirs(req['outdir'], exist_ok=True)
+        if op == 'pages':
+            # Intermediate frames carry more=True; the final frame is the 'done' summary.
+            emit = state.get('emit') or (lambda rec: None)
+            res = process_pages(req['input'], req['template'], req['outdir'], lambda rec: emit({'id':rid,'ok':True,'more':True,'result':rec}))
+        elif req.get('inline'):
+            # In-memory: image bytes arrive as the first blob, result JSON and encoded images go back over the pipe.
+            blobs = req.get('_blobs') or []
+            if not blobs: raise RuntimeError("inline request without image data")
+            out = MemoryOutputs()
+            res = process(None, req['template'], req.get('outdir'), img=blobs[0], out=out)
+            return {'id':rid,'ok':True,'result':res}, [out.images[i['name']][1] for i in res['images']]
+        else:
+            res = process(req['input'], req['template'], req['outdir'])
+        return {'id':rid,'ok':True,'result':res}, ()
+    except Exception as e:
+        return {'id':rid,'ok':False,'error':str(e),'traceback':traceback.format_exc()}, ()
+    finally:
+        state['served'] += 1
+        configure(os.environ)
+
+def serve_stream(rf, wf, state):
+    state['emit'] = lambda obj: write_frame(wf, obj)
+    while True:
+        req = read_frame(rf)
+        if req is None or req.get('op') == 'shutdown': return False if req is None else True
+        res, blobs = handle_request(req, state)
+        write_frame(wf, res, blobs)
+
+def serve(argv):
+    """
+    Long-lived mode: framed JSON requests on stdin (default) or a Unix socket, one at a time.
+    A frame whose JSON has 'blobs': N is followed by N raw binary frames (image bytes in,
+    encoded result images out), so inline requests never touch the filesystem.
+    """
+    state = {'served':0}
+    if '--socket' in argv:
+        import socket
+        path = argv[argv.index('--socket')+1]
+        if os.path.exists(path): os.unlink(path)
+        srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM); srv.bind(path); srv.listen(4)
+        try:
+            while True:
+                conn, _ = srv.accept()
+                with conn, conn.makefile('rb') as rf, conn.makefile('wb') as wf:
+                    if serve_stream(rf, wf, state): return
+        finally:
+            srv.close()
+            if os.path.exists(path): os.unlink(path)
+    serve_stream(sys.stdin.buffer, FRAME_OUT, state)
 
 def main():
+    if SERVE_MODE: return serve(sys.argv[2:])
+    if len(sys.argv)>1 and sys.argv[1]=='batch':
+        args = sys.argv[2:]; workers = None
+        if '--workers' in args:
+            i = args.index('--workers'); workers = int(args[i+1]); args = args[:i] + args[i+2:]
+        key = None
+        if '--key' in args:
+            i = args.index('--key')
+            with open(args[i+1], 'r', encoding='utf-8') as f: key = json.load(f)
+            args = args[:i] + args[i+2:]
+        if len(args)<3: print(json.dumps({'error':'Usage: python worker.py batch <manifest|dir> <template> <output_dir> [--workers N] [--key <answer_key.json>]'})); sys.exit(1)
+        os.makedirs(args[2], exist_ok=True)
+        try: print(json.dumps(run_batch(args[0], args[1], args[2], workers, key=key)), flush=True)
+        except Exception as e: print(json.dumps({'error':str(e),'traceback':traceback.format_exc()})); sys.exit(1)
+        return
+    if len(sys.argv)>1 and sys.argv[1]=='grade':
+        # {"key": {...}, "responses": [{...}, ...]} on stdin, grading JSON on stdout.
+        try: print(json.dumps(grade_responses(**grade_args(json.load(sys.stdin)))))
+        except Exception as e: print(json.dumps({'error':str(e),'traceback':traceback.format_exc()})); sys.exit(1)
+        return
+    if len(sys.argv)>1 and sys.argv[1]=='pages':
+        if len(sys.argv)<5: print(json.dumps({'error':'Usage: python worker.py pages <input> <template> <output_dir>'})); sys.exit(1)
+        os.makedirs(sys.argv[4], exist_ok=True)
+        def emit(rec): print(json.dumps(rec), flush=True)
+        try: emit(process_pages(sys.argv[2], sys.argv[3], sys.argv[4], emit))
+        except Exception as e: print(json.dumps({'error':str(e),'traceback':traceback.format_exc()})); sys.exit(1)
+        return
     if len(sys.argv)<4: print(json.dumps({'error':'Usage: python worker.py <input> <template> <output_dir>'})); sys.exit(1)
     os.makedirs(sys.argv[3], exist_ok=True)
     try: print(json.dumps(process(sys.argv[1], sys.argv[2], sys.argv[3])))
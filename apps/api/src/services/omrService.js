@@ -2,6 +2,7 @@ const { spawn } = require('child_process');
 const path = require('path');
 const fs = require('fs').promises;
 const os = require('os');
+const OMRWorkerPool = require('./omrWorkerPool');
 
 /**
  * OMR Service - Wrapper for Python OpenCV worker
@@ -11,16 +12,52 @@ class OMRService {
     constructor() {
         this.workerPath = path.join(__dirname, 'omr', 'worker.py');
         this.templatePath = path.join(__dirname, 'omr', 'templates', 'standard_156.json');
+        // Warm `worker.py serve` processes; OMR_POOL_SIZE=0 falls back to one process per image
+        this.pool = new OMRWorkerPool(this.workerPath, {
+            size: process.env.OMR_POOL_SIZE !== undefined ? parseInt(process.env.OMR_POOL_SIZE, 10) || 0 : undefined,
+            requestTimeoutMs: parseInt(process.env.OMR_WORKER_TIMEOUT_MS || '60000', 10)
+        });
+        // Pool requests carry the image and result images over the pipe; OMR_INLINE_IO=0 keeps temp files
+        this.inlineIO = process.env.OMR_INLINE_IO !== '0';
+        // Choice set per template path (item analysis lists every option, marked or not)
+        this.choiceSets = new Map();
     }
 
+    /**
+     * Read one sheet. `imageBuffer` may also be the path of an image already on disk (batch uploads);
+     * the worker then reads it in place instead of receiving the bytes over the pipe.
+     */
     async processImage(imageBuffer, options = {}) {
         const startTime = Date.now();
+        if (this.inlineIO && this.pool.enabled && Buffer.isBuffer(imageBuffer)) {
+            const previewOnly = !!options.previewOnly;
+            try {
+                const response = await this.pool.request(
+                    { op: 'process', inline: true, template: options.templatePath || this.templatePath, env: this.buildWorkerEnv(options) },
+                    { blobs: [imageBuffer] }
+                );
+                return this.readInlineOutputs(response, Date.now() - startTime, previewOnly);
+            } catch (error) {
+                if (this.pool.enabled) {
+                    console.error('OMR Python worker error:', error);
+                    return this.fallbackProcess(imageBuffer, Date.now() - startTime, error.message);
+                }
+                console.warn('OMR worker pool unavailable, using temp files:', error.message);
+            }
+        }
+        return this.processImageViaFiles(imageBuffer, options, startTime);
+    }
+
+    async processImageViaFiles(imageBuffer, options = {}, startTime = Date.now()) {
         const tempDir = await fs.mkdtemp(path.join(os.tmpdir(), 'omr-'));
 
         try {
-            // Save image to temp file
-            const inputPath = path.join(tempDir, 'input.jpg');
-            await fs.writeFile(inputPath, imageBuffer);
+            // Save image to temp file (a path is used as is)
+            let inputPath = imageBuffer;
+            if (Buffer.isBuffer(imageBuffer)) {
+                inputPath = path.join(tempDir, 'input.jpg');
+                await fs.writeFile(inputPath, imageBuffer);
+            }
 
             // Get template path
             const templatePath = options.templatePath || this.templatePath;
@@ -29,41 +66,104 @@ class OMRService {
             const previewOnly = !!options.previewOnly;
 
             // Run Python worker
-            const result = await this.runPythonWorker(inputPath, templatePath, tempDir, { corners, anchors, previewOnly });
+            const result = await this.runPythonWorker(inputPath, templatePath, tempDir, { ...options, corners, anchors, previewOnly });
 
             // Parse results
-            const resultPath = path.join(tempDir, 'result.json');
-            const previewPath = path.join(tempDir, 'preview.png');
-            const warpedPath = path.join(tempDir, 'warped.png');
-            const resultData = JSON.parse(await fs.readFile(resultPath, 'utf8'));
+            return await this.readWorkerOutputs(tempDir, Date.now() - startTime, previewOnly, result.images);
 
-            // Embed debug overlay (preview.png) if available
-            let previewImage = null;
+        } catch (error) {
+            console.error('OMR Python worker error:', error);
+            // Fallback to simple processing
+            return this.fallbackProcess(imageBuffer, Date.now() - startTime, error.message);
+        } finally {
+            // Cleanup temp dir
             try {
-                const buf = await fs.readFile(previewPath);
-                previewImage = `data:image/png;base64,${buf.toString('base64')}`;
-            } catch (_) {
-                // no-op if preview missing
+                await fs.rm(tempDir, { recursive: true, force: true });
+            } catch (e) {
+                console.warn('Failed to cleanup temp dir:', e);
             }
+        }
+    }
+
+    async readWorkerOutputs(outputDir, processingMs, previewOnly = false, images = null) {
+        const resultPath = path.join(outputDir, 'result.json');
+        const resultData = JSON.parse(await fs.readFile(resultPath, 'utf8'));
 
-            // Embed warped image (no overlays) if available
-            let warpedImage = null;
+        // Embed preview overlay and warped image (no overlays) if the artifact policy produced them.
+        // Older workers do not list their images; they always write PNGs.
+        const files = images || [
+            { name: 'preview', mime: 'image/png', path: path.join(outputDir, 'preview.png') },
+            { name: 'warped', mime: 'image/png', path: path.join(outputDir, 'warped.png') }
+        ];
+        const assets = { previewImage: null, warpedImage: null, previewOnly };
+        for (const image of files) {
             try {
-                const buf = await fs.readFile(warpedPath);
-                warpedImage = `data:image/png;base64,${buf.toString('base64')}`;
+                const buf = await fs.readFile(image.path);
+                assets[`${image.name}Image`] = `data:${image.mime};base64,${buf.toString('base64')}`;
             } catch (_) {
-                // no-op if warped missing
+                // no-op if missing
             }
+        }
 
-            // Convert to our format
-            return this.convertResult(resultData, Date.now() - startTime, { previewImage, warpedImage, previewOnly });
+        // Convert to our format
+        return this.convertResult(resultData, processingMs, assets);
+    }
 
-        } catch (error) {
-            console.error('OMR Python worker error:', error);
-            // Fallback to simple processing
-            return this.fallbackProcess(imageBuffer, Date.now() - startTime, error.message);
+    readInlineOutputs(response, processingMs, previewOnly = false) {
+        const { result, images = [] } = response.result;
+        const assets = { previewImage: null, warpedImage: null, previewOnly };
+        images.forEach((image, i) => {
+            const buf = response.blobData?.[i];
+            if (buf) assets[`${image.name}Image`] = `data:${image.mime};base64,${buf.toString('base64')}`;
+        });
+        return this.convertResult(result, processingMs, assets);
+    }
+
+    /**
+     * Multi-page PDF/TIFF stack (scanner ADF output).
+     * Pages are rasterised one at a time by the worker; each converted page result
+     * is handed to `onPage` as soon as it is ready (and then not kept), otherwise returned.
+     * `documentBuffer` may also be the path of the document on disk.
+     */
+    async processDocument(documentBuffer, options = {}) {
+        const startTime = Date.now();
+        const tempDir = await fs.mkdtemp(path.join(os.tmpdir(), 'omr-doc-'));
+        const { onPage = null, extension = '.pdf' } = options;
+
+        try {
+            let inputPath = documentBuffer;
+            if (Buffer.isBuffer(documentBuffer)) {
+                inputPath = path.join(tempDir, `input${extension}`);
+                await fs.writeFile(inputPath, documentBuffer);
+            }
+            const templatePath = options.templatePath || this.templatePath;
+
+            const pages = [];
+            let lastTime = startTime;
+            let pending = Promise.resolve();
+            const handlePage = (record) => {
+                const pageMs = Date.now() - lastTime;
+                lastTime = Date.now();
+                // Keep page order while reading outputs asynchronously.
+                pending = pending.then(async () => {
+                    let result;
+                    try {
+                        result = record.success === false
+                            ? this.fallbackProcess(null, pageMs, record.error)
+                            : await this.readWorkerOutputs(path.dirname(record.resultPath), pageMs, false, record.images);
+                    } catch (error) {
+                        result = this.fallbackProcess(null, pageMs, error.message);
+                    }
+                    result.page = record.page;
+                    if (onPage) await onPage(result);
+                    else pages.push(result);
+                });
+            };
+
+            await this.runPythonPages(inputPath, templatePath, tempDir, options, handlePage);
+            await pending;
+            return pages;
         } finally {
-            // Cleanup temp dir
             try {
                 await fs.rm(tempDir, { recursive: true, force: true });
             } catch (e) {
@@ -72,27 +172,121 @@ class OMRService {
         }
     }
 
-    runPythonWorker(inputPath, templatePath, outputDir, options = {}) {
+    async runPythonPages(inputPath, templatePath, outputDir, options, onRecord) {
+        const env = this.buildWorkerEnv(options);
+        if (this.pool.enabled) {
+            try {
+                const response = await this.pool.request(
+                    { op: 'pages', input: inputPath, template: templatePath, outdir: outputDir, env },
+                    { onPartial: onRecord }
+                );
+                return response.result;
+            } catch (error) {
+                if (this.pool.enabled) throw error;
+                console.warn('OMR worker pool unavailable, spawning per request:', error.message);
+            }
+        }
         return new Promise((resolve, reject) => {
             const python = process.platform === 'win32' ? 'python' : 'python3';
-            // Safer defaults: strict mode ON, faint mode OFF; env ile override edilebilir
-            const env = {
-                ...process.env,
-                OMR_DEBUG: process.env.OMR_DEBUG || '1',
-                OMR_FAINT: process.env.OMR_FAINT || '0',
-                OMR_STRICT: process.env.OMR_STRICT || '1',
-                OMR_LIMIT_FIRST_BLOCK: process.env.OMR_LIMIT_FIRST_BLOCK || '1',
-                OMR_MAX_QUESTIONS: process.env.OMR_MAX_QUESTIONS || '52'
-            };
-            if (options.corners) {
-                env.OMR_CORNERS = JSON.stringify(options.corners);
-            }
-            if (options.anchors) {
-                env.OMR_ANCHORS = JSON.stringify(options.anchors);
-            }
-            if (options.previewOnly) {
-                env.OMR_PREVIEW_ONLY = '1';
+            const proc = spawn(python, [this.workerPath, 'pages', inputPath, templatePath, outputDir], {
+                env: { ...process.env, ...env }
+            });
+
+            // NDJSON: one record per page, then a final {type: 'done'} summary.
+            let pendingLine = '';
+            let done = null;
+            let stderr = '';
+            proc.stdout.on('data', (data) => {
+                const lines = (pendingLine + data.toString()).split('\n');
+                pendingLine = lines.pop();
+                for (const line of lines) {
+                    let record;
+                    try {
+                        record = JSON.parse(line);
+                    } catch (_) {
+                        continue;
+                    }
+                    if (record.type === 'page') onRecord(record);
+                    else if (record.type === 'done') done = record;
+                }
+            });
+            proc.stderr.on('data', (data) => {
+                stderr += data.toString();
+                console.log('[OMR Python]', data.toString());
+            });
+
+            proc.on('close', (code) => {
+                if (code === 0 && done) resolve(done);
+                else reject(new Error(`Python worker failed: ${stderr}`));
+            });
+
+            proc.on('error', (err) => {
+                reject(new Error(`Failed to start Python: ${err.message}`));
+            });
+        });
+    }
+
+    buildWorkerEnv(options = {}) {
+        // Safer defaults: strict mode ON, faint mode OFF; env ile override edilebilir
+        const env = {
+            OMR_DEBUG: process.env.OMR_DEBUG || '0',
+            OMR_FAINT: process.env.OMR_FAINT || '0',
+            OMR_STRICT: process.env.OMR_STRICT || '1',
+            OMR_LIMIT_FIRST_BLOCK: process.env.OMR_LIMIT_FIRST_BLOCK || '1',
+            OMR_MAX_QUESTIONS: process.env.OMR_MAX_QUESTIONS || '52',
+            // Re-uploaded scans are answered from the worker's on-disk result cache; OMR_CACHE_DIR='' disables it
+            OMR_CACHE_DIR: process.env.OMR_CACHE_DIR !== undefined ? process.env.OMR_CACHE_DIR : path.join(os.tmpdir(), 'omr-result-cache')
+        };
+        if (options.corners) {
+            env.OMR_CORNERS = JSON.stringify(options.corners);
+        }
+        if (options.anchors) {
+            env.OMR_ANCHORS = JSON.stringify(options.anchors);
+        }
+        if (options.previewOnly) {
+            env.OMR_PREVIEW_ONLY = '1';
+        }
+        // Per-request artifact policy: 'all' | 'preview' | 'none', png/jpg/webp, downscale factor
+        if (options.artifacts) {
+            env.OMR_ARTIFACTS = options.artifacts;
+        }
+        if (options.artifactFormat) {
+            env.OMR_ARTIFACT_FORMAT = options.artifactFormat;
+        }
+        if (options.artifactScale) {
+            env.OMR_ARTIFACT_SCALE = String(options.artifactScale);
+        }
+        // 'compact' = unindented result with columnar answers (see expandAnswers)
+        const resultFormat = options.resultFormat || process.env.OMR_RESULT_FORMAT;
+        if (resultFormat) {
+            env.OMR_RESULT_FORMAT = resultFormat;
+        }
+        // Peak-RSS budget (MB) for one sheet; the worker decodes the scan at reduced size to stay under it
+        if (options.memoryBudgetMb) {
+            env.OMR_MEMORY_BUDGET_MB = String(options.memoryBudgetMb);
+        }
+        return env;
+    }
+
+    async runPythonWorker(inputPath, templatePath, outputDir, options = {}) {
+        const env = this.buildWorkerEnv(options);
+        if (this.pool.enabled) {
+            try {
+                const response = await this.pool.request({ op: 'process', input: inputPath, template: templatePath, outdir: outputDir, env });
+                return response.result;
+            } catch (error) {
+                // Only a pool that cannot start falls through; per-sheet failures are real failures.
+                if (this.pool.enabled) throw error;
+                console.warn('OMR worker pool unavailable, spawning per request:', error.message);
             }
+        }
+        return this.spawnPythonWorker(inputPath, templatePath, outputDir, env);
+    }
+
+    spawnPythonWorker(inputPath, templatePath, outputDir, workerEnv) {
+        return new Promise((resolve, reject) => {
+            const python = process.platform === 'win32' ? 'python' : 'python3';
+            const env = { ...process.env, ...workerEnv };
             const proc = spawn(python, [this.workerPath, inputPath, templatePath, outputDir], { env });
 
             let stdout = '';
@@ -122,9 +316,23 @@ class OMRService {
         });
     }
 
+    expandAnswers(answers) {
+        // Compact results carry one array per field ({ format: 'columns', question: [...], scores: { A: [...] } })
+        if (!answers || Array.isArray(answers)) return answers || [];
+        return (answers.question || []).map((question, i) => ({
+            question,
+            answer: answers.answer[i],
+            confidence: answers.confidence[i],
+            status: answers.status[i],
+            best: answers.best[i],
+            delta: answers.delta[i],
+            z: answers.z[i]
+        }));
+    }
+
     convertResult(data, processingMs, assets = {}) {
         const { previewImage = null, warpedImage = null, previewOnly = false } = assets;
-        const answers = (data.answers || []).map(a => ({
+        const answers = this.expandAnswers(data.answers).map(a => ({
             question: a.question,
             answer: a.answer,
             confidence: a.confidence || 0,
@@ -143,7 +351,9 @@ class OMRService {
                 processingTimeMs: processingMs,
                 perspectiveCorrected: data.meta?.cornerMarkersFound || false,
                 pythonWorker: true,
-                summary: data.summary
+                summary: data.summary,
+                timings: data.meta?.timings || null,
+                geometry: data.meta?.geometry || null
             },
             anchors: data.anchors || null,
             pageSize: data.meta?.pageSize || null,
@@ -154,6 +364,59 @@ class OMRService {
         };
     }
 
+    /**
+     * Grade many sheets against one answer key in the worker (numpy response matrix).
+     * `responses` holds one { question: answer } object per student; the result has
+     * per-student scores (same order) and per-item difficulty / point-biserial / distractors.
+     * Distractor columns cover the template's full choice set, including options nobody marked.
+     */
+    async gradeResponses(responses, answerKey, options = {}) {
+        const choices = options.choices || await this.templateChoices(options.templatePath);
+        const payload = { key: answerKey, responses, choices };
+        if (this.pool.enabled) {
+            try {
+                const response = await this.pool.request({ op: 'grade', ...payload });
+                return response.result;
+            } catch (error) {
+                if (this.pool.enabled) throw error;
+                console.warn('OMR worker pool unavailable, spawning per request:', error.message);
+            }
+        }
+        return new Promise((resolve, reject) => {
+            const python = process.platform === 'win32' ? 'python' : 'python3';
+            const proc = spawn(python, [this.workerPath, 'grade']);
+
+            let stdout = '';
+            let stderr = '';
+            proc.stdout.on('data', (data) => { stdout += data.toString(); });
+            proc.stderr.on('data', (data) => { stderr += data.toString(); });
+
+            proc.on('close', (code) => {
+                // The grading JSON is the last line; import notices may precede it.
+                const line = stdout.trim().split('\n').pop();
+                let result = null;
+                try {
+                    result = JSON.parse(line);
+                } catch (_) {}
+                if (code === 0 && result && !result.error) resolve(result);
+                else reject(new Error(`Python grading failed: ${(result && result.error) || stderr || stdout}`));
+            });
+
+            proc.on('error', (err) => {
+                reject(new Error(`Failed to start Python: ${err.message}`));
+            });
+            proc.stdin.end(JSON.stringify(payload));
+        });
+    }
+
+    async templateChoices(templatePath = this.templatePath) {
+        if (!this.choiceSets.has(templatePath)) {
+            const template = JSON.parse(await fs.readFile(templatePath, 'utf8'));
+            this.choiceSets.set(templatePath, (template.config || template).choices || ['A', 'B', 'C', 'D', 'E']);
+        }
+        return this.choiceSets.get(templatePath);
+    }
+
     fallbackProcess(imageBuffer, processingMs, errorMessage) {
         // If Python fails, return empty result with error
         return {
@@ -163,7 +426,7 @@ class OMRService {
             answers: [],
             errors: [`Python worker failed: ${errorMessage}`],
             metadata: {
-                processingTimeMs,
+                processingTimeMs: processingMs,
                 perspectiveCorrected: false,
                 pythonWorker: false
             },
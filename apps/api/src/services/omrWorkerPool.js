@@ -0,0 +1,231 @@
+const { spawn } = require('child_process');
+const os = require('os');
+
+/**
+ * OMR Worker Pool - keeps a few `worker.py serve` processes warm
+ * Requests/responses are length-prefixed (uint32 BE) JSON frames over stdin/stdout.
+ * A JSON frame with `blobs: N` is followed by N raw binary frames (image bytes).
+ */
+class OMRWorkerPool {
+    constructor(workerPath, options = {}) {
+        this.workerPath = workerPath;
+        this.python = options.python || (process.platform === 'win32' ? 'python' : 'python3');
+        this.size = options.size ?? Math.max(1, Math.min(2, os.cpus().length));
+        this.requestTimeoutMs = options.requestTimeoutMs || 60000;
+        this.healthIntervalMs = options.healthIntervalMs || 30000;
+        this.restartDelayMs = options.restartDelayMs || 500;
+        this.maxRestartDelayMs = options.maxRestartDelayMs || 30000;
+        // Crashes in a row (no answer from any worker in between) before the pool gives up
+        this.maxCrashes = options.maxCrashes ?? 5;
+        this.crashes = 0;
+        this.workers = [];
+        this.queue = [];
+        this.nextId = 1;
+        this.started = false;
+        this.closed = false;
+        this.unavailable = null;
+        this.healthTimer = null;
+    }
+
+    get enabled() {
+        return this.size > 0 && !this.closed && !this.unavailable;
+    }
+
+    start() {
+        if (this.started || !this.enabled) return;
+        this.started = true;
+        for (let i = 0; i < this.size; i++) {
+            this.workers.push(this.spawnWorker(i));
+        }
+        this.healthTimer = setInterval(() => this.healthCheck(), this.healthIntervalMs);
+        this.healthTimer.unref();
+        process.once('exit', () => this.shutdown());
+    }
+
+    spawnWorker(slot) {
+        const proc = spawn(this.python, [this.workerPath, 'serve'], {
+            // Sibling count lets each worker size its block threads to its share of the CPUs
+            env: { ...process.env, OMR_WORKER_PROCS: String(this.size) },
+            stdio: ['pipe', 'pipe', 'pipe']
+        });
+        const worker = { slot, proc, buffer: Buffer.alloc(0), current: null, alive: true, pingPending: false, partial: null };
+
+        proc.stdout.on('data', (chunk) => this.onData(worker, chunk));
+        proc.stderr.on('data', (data) => {
+            console.log(`[OMR Python #${slot}]`, data.toString());
+        });
+        proc.stdin.on('error', () => { /* surfaced through 'exit' */ });
+        proc.on('error', (err) => {
+            console.error(`[OMR Pool] worker #${slot} failed to start:`, err.message);
+            if (err.code === 'ENOENT') {
+                // No Python on this host: stop retrying and let callers fall back.
+                this.unavailable = err;
+                for (const job of this.queue.splice(0)) job.reject(err);
+            }
+            this.onExit(worker, null, null);
+        });
+        proc.on('exit', (code, signal) => this.onExit(worker, code, signal));
+        return worker;
+    }
+
+    onData(worker, chunk) {
+        worker.buffer = Buffer.concat([worker.buffer, chunk]);
+        while (worker.buffer.length >= 4) {
+            const len = worker.buffer.readUInt32BE(0);
+            if (worker.buffer.length < 4 + len) break;
+            const body = worker.buffer.subarray(4, 4 + len);
+            worker.buffer = worker.buffer.subarray(4 + len);
+            if (worker.partial) {
+                // Binary frame belonging to the previous JSON header.
+                const partial = worker.partial;
+                partial.blobData.push(Buffer.from(body));
+                if (partial.blobData.length === partial.blobs) {
+                    worker.partial = null;
+                    this.onMessage(worker, partial);
+                }
+                continue;
+            }
+            let msg;
+            try {
+                msg = JSON.parse(body.toString('utf8'));
+            } catch (e) {
+                console.error('[OMR Pool] invalid frame from worker:', e.message);
+                continue;
+            }
+            if (msg.blobs > 0) {
+                msg.blobData = [];
+                worker.partial = msg;
+                continue;
+            }
+            this.onMessage(worker, msg);
+        }
+    }
+
+    onMessage(worker, msg) {
+        // A worker that answers is healthy: crash backoff starts over
+        this.crashes = 0;
+        if (msg.op === 'pong') {
+            worker.pingPending = false;
+            return;
+        }
+        const job = worker.current;
+        if (!job || job.id !== msg.id) return;
+        if (msg.more) {
+            // Streaming op (e.g. multi-page documents): each partial frame re-arms the timeout.
+            this.armTimer(worker, job);
+            if (job.onPartial) job.onPartial(msg.result);
+            return;
+        }
+        clearTimeout(job.timer);
+        worker.current = null;
+        if (msg.ok) {
+            job.resolve(msg);
+        } else {
+            job.reject(new Error(`Python worker failed: ${msg.error}${msg.traceback ? `\n${msg.traceback}` : ''}`));
+        }
+        this.drain();
+    }
+
+    onExit(worker, code, signal) {
+        if (!worker.alive) return;
+        worker.alive = false;
+        if (worker.current) {
+            clearTimeout(worker.current.timer);
+            worker.current.reject(new Error(`Python worker exited (code=${code}, signal=${signal})`));
+            worker.current = null;
+        }
+        if (this.closed || this.unavailable) return;
+        // A request timeout is our own kill of a healthy worker, not a crash.
+        if (!worker.timedOut && ++this.crashes > this.maxCrashes) {
+            // Workers keep dying (broken install, OOM at startup): stop restarting and let callers fall back.
+            this.unavailable = new Error(`Python worker crashed ${this.crashes} times in a row (code=${code}, signal=${signal})`);
+            console.error('[OMR Pool] giving up:', this.unavailable.message);
+            for (const job of this.queue.splice(0)) job.reject(this.unavailable);
+            return;
+        }
+        // Restart-on-crash: replace the slot, backing off exponentially while crashes repeat.
+        const delay = Math.min(this.restartDelayMs * 2 ** Math.max(0, this.crashes - 1), this.maxRestartDelayMs);
+        setTimeout(() => {
+            if (this.closed || this.unavailable) return;
+            this.workers[worker.slot] = this.spawnWorker(worker.slot);
+            this.drain();
+        }, delay).unref();
+    }
+
+    send(worker, job) {
+        worker.current = job;
+        this.armTimer(worker, job);
+        this.write(worker, job.payload, job.blobs);
+    }
+
+    armTimer(worker, job) {
+        clearTimeout(job.timer);
+        job.timer = setTimeout(() => {
+            console.warn(`[OMR Pool] worker #${worker.slot} timed out, restarting`);
+            worker.timedOut = true;
+            worker.proc.kill('SIGKILL');
+        }, job.timeoutMs);
+    }
+
+    write(worker, payload, blobs = []) {
+        const frames = [Buffer.from(JSON.stringify(blobs.length ? { ...payload, blobs: blobs.length } : payload), 'utf8'), ...blobs];
+        const parts = [];
+        for (const frame of frames) {
+            const header = Buffer.alloc(4);
+            header.writeUInt32BE(frame.length, 0);
+            parts.push(header, frame);
+        }
+        worker.proc.stdin.write(Buffer.concat(parts));
+    }
+
+    drain() {
+        while (this.queue.length > 0) {
+            const worker = this.workers.find(w => w.alive && !w.current);
+            if (!worker) return;
+            this.send(worker, this.queue.shift());
+        }
+    }
+
+    /**
+     * Queue a request for the next idle worker; resolves with the final response frame.
+     * `onPartial` receives the result of every intermediate (`more: true`) frame.
+     * `blobs` are sent as binary frames after the JSON; response blobs arrive as `response.blobData`.
+     */
+    request(payload, { timeoutMs = this.requestTimeoutMs, onPartial = null, blobs = [] } = {}) {
+        if (!this.enabled) {
+            return Promise.reject(new Error('OMR worker pool disabled'));
+        }
+        this.start();
+        return new Promise((resolve, reject) => {
+            const id = this.nextId++;
+            this.queue.push({ id, payload: { ...payload, id }, blobs, resolve, reject, timeoutMs, onPartial });
+            this.drain();
+        });
+    }
+
+    healthCheck() {
+        for (const worker of this.workers) {
+            if (!worker.alive || worker.current) continue;
+            if (worker.pingPending) {
+                // Previous ping never answered: the process is wedged.
+                console.warn(`[OMR Pool] worker #${worker.slot} failed health check, restarting`);
+                worker.proc.kill('SIGKILL');
+                continue;
+            }
+            worker.pingPending = true;
+            this.write(worker, { id: 0, op: 'ping' });
+        }
+    }
+
+    shutdown() {
+        this.closed = true;
+        if (this.healthTimer) clearInterval(this.healthTimer);
+        for (const job of this.queue) job.reject(new Error('OMR worker pool shut down'));
+        this.queue = [];
+        for (const worker of this.workers) {
+            if (worker.alive) worker.proc.kill();
+        }
+    }
+}
+
+module.exports = OMRWorkerPool;
@@ -0,0 +1,16 @@
+/**
+ * Run `fn(item, index)` over `items` with at most `limit` calls in flight; results keep input order.
+ * `isCancelled` stops scheduling further items (e.g. when the client went away).
+ */
+module.exports = async function mapConcurrent(items, limit, fn, isCancelled = () => false) {
+  const results = new Array(items.length);
+  let next = 0;
+  const runners = Array.from({ length: Math.min(limit, items.length) }, async () => {
+    while (next < items.length && !isCancelled()) {
+      const index = next++;
+      results[index] = await fn(items[index], index);
+    }
+  });
+  await Promise.all(runners);
+  return results;
+};
@@ -0,0 +1,154 @@
+const fs = require("fs");
+const express = require("express");
+const request = require("supertest");
+const mapConcurrent = require("../src/utils/mapConcurrent");
+
+jest.mock("../src/middleware/auth", () => (req, res, next) => {
+  req.user = { id: "u1", roles: ["instructor"] };
+  next();
+});
+jest.mock("../src/db", () => ({ exam: { findUnique: jest.fn() } }));
+jest.mock("../src/services/omrService", () => ({
+  processImage: jest.fn(),
+  processDocument: jest.fn(),
+  gradeResponses: jest.fn()
+}));
+
+// Let every upload of a test run at once regardless of the host's CPU count
+process.env.OMR_BATCH_CONCURRENCY = "4";
+
+const prisma = require("../src/db");
+const omrService = require("../src/services/omrService");
+const omrRoutes = require("../src/routes/omr");
+
+const app = express();
+app.use("/omr", omrRoutes);
+
+const delay = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+function sheet(answer) {
+  return { success: true, answers: [{ question: 1, answer }, { question: 2, answer: "C" }] };
+}
+
+function batch(accept, files = ["a", "b", "c"]) {
+  const req = request(app).post("/omr/batch").set("Accept", accept).field("examId", "exam-1");
+  files.forEach((name) => req.attach("images", Buffer.from(name), { filename: `${name}.jpg`, contentType: "image/jpeg" }));
+  return req.buffer(true).parse((res, cb) => {
+    let text = "";
+    res.setEncoding("utf8");
+    res.on("data", (chunk) => { text += chunk; });
+    res.on("end", () => cb(null, text));
+  });
+}
+
+beforeEach(() => {
+  jest.clearAllMocks();
+  prisma.exam.findUnique.mockResolvedValue({ answerKey: { 1: "A" } });
+  omrService.processImage.mockImplementation(async (input) => {
+    const name = String(Buffer.isBuffer(input) ? input : fs.readFileSync(input));
+    await delay(name === "b" ? 5 : 50);
+    return sheet(name === "b" ? "B" : "A");
+  });
+  omrService.gradeResponses.mockImplementation(async (responses) => ({
+    students: responses.map(() => ({ correct: 0, wrong: 0, empty: 1, total: 1, percentage: 0 })),
+    items: [{ question: 1, key: "A" }],
+    summary: { students: responses.length, items: 1 }
+  }));
+});
+
+describe("mapConcurrent", () => {
+  test("keeps input order and never exceeds the limit", async () => {
+    let inFlight = 0, peak = 0;
+    const results = await mapConcurrent([30, 5, 20, 1, 10], 2, async (ms, index) => {
+      peak = Math.max(peak, ++inFlight);
+      await delay(ms);
+      inFlight--;
+      return index * 10;
+    });
+    expect(results).toEqual([0, 10, 20, 30, 40]);
+    expect(peak).toBe(2);
+  });
+
+  test("stops scheduling once cancelled", async () => {
+    let cancelled = false;
+    const seen = [];
+    await mapConcurrent([1, 2, 3, 4, 5], 2, async (item) => {
+      seen.push(item);
+      if (item === 2) cancelled = true;
+      await delay(1);
+    }, () => cancelled);
+    expect(seen).toEqual([1, 2]);
+  });
+});
+
+describe("POST /omr/batch streaming", () => {
+  test("NDJSON sends one result line per sheet and a closing summary", async () => {
+    const res = await batch("application/x-ndjson");
+    expect(res.status).toBe(200);
+    expect(res.headers["content-type"]).toMatch("application/x-ndjson");
+
+    const lines = res.body.trim().split("\n").map((line) => JSON.parse(line));
+    const results = lines.filter((line) => line.type === "result");
+    expect(results.map((r) => r.index).sort()).toEqual([0, 1, 2]);
+    // The fast sheet is written before the slow ones that were uploaded ahead of it
+    expect(results[0].filename).toBe("b.jpg");
+
+    const b = results.find((r) => r.filename === "b.jpg");
+    expect(b.score).toEqual({ correct: 0, wrong: 1, empty: 0, total: 1, percentage: 0 });
+    expect(b.answers.map((a) => a.status)).toEqual(["wrong", "ungraded"]);
+
+    const done = lines[lines.length - 1];
+    expect(done).toMatchObject({ type: "done", total: 3, successful: 3, failed: 0 });
+    expect(done.itemAnalysis.summary).toEqual({ students: 3, items: 1 });
+    // Sheets are scored in JS; the worker grades the batch once for the item analysis
+    expect(omrService.gradeResponses).toHaveBeenCalledTimes(1);
+    expect(omrService.gradeResponses.mock.calls[0][0]).toHaveLength(3);
+  });
+
+  test("SSE sends the same records as events", async () => {
+    omrService.processImage.mockImplementationOnce(async () => { throw new Error("unreadable"); });
+    const res = await batch("text/event-stream", ["a", "b"]);
+    expect(res.headers["content-type"]).toMatch("text/event-stream");
+
+    const events = res.body.trim().split("\n\n").map((block) => {
+      const [event, data] = block.split("\n");
+      return { event: event.replace("event: ", ""), data: JSON.parse(data.replace("data: ", "")) };
+    });
+    expect(events.map((e) => e.event)).toEqual(["result", "result", "done"]);
+    expect(events.find((e) => e.data.success === false).data).toMatchObject({ type: "result", error: "unreadable" });
+    expect(events[2].data).toMatchObject({ type: "done", total: 2, successful: 1, failed: 1 });
+  });
+
+  test("uploads are read from disk and removed after the response", async () => {
+    await batch("application/x-ndjson", ["a", "b"]);
+    const paths = omrService.processImage.mock.calls.map(([input]) => input);
+    expect(paths.every((p) => typeof p === "string")).toBe(true);
+    await delay(20);
+    expect(paths.filter((p) => fs.existsSync(p))).toEqual([]);
+  });
+
+  test("a PDF sent as application/octet-stream is paged through, not read as one image", async () => {
+    omrService.processDocument.mockImplementation(async (input, { onPage }) => {
+      await onPage({ ...sheet("A"), page: 1 });
+      await onPage({ ...sheet("B"), page: 2 });
+    });
+    const res = await request(app).post("/omr/batch")
+      .attach("images", Buffer.from("%PDF-1.4\n"), { filename: "stack", contentType: "application/octet-stream" })
+      .attach("images", Buffer.from("a"), { filename: "a.bin", contentType: "application/octet-stream" });
+    expect(res.status).toBe(200);
+    expect(res.body.data.results.map((r) => r.filename)).toEqual(["stack#1", "stack#2", "a.bin"]);
+    const [input, options] = omrService.processDocument.mock.calls[0];
+    expect(options.extension).toBe(".pdf");
+    expect(input.endsWith(".pdf")).toBe(true);
+    expect(omrService.processImage).toHaveBeenCalledTimes(1);
+  });
+
+  test("without a streaming Accept the batch is one JSON response in upload order", async () => {
+    const res = await request(app).post("/omr/batch")
+      .attach("images", Buffer.from("a"), { filename: "a.jpg", contentType: "image/jpeg" })
+      .attach("images", Buffer.from("b"), { filename: "b.jpg", contentType: "image/jpeg" });
+    expect(res.status).toBe(200);
+    expect(res.body.data.results.map((r) => r.filename)).toEqual(["a.jpg", "b.jpg"]);
+    expect(res.body.data.itemAnalysis).toBeNull();
+  });
+});
@@ -0,0 +1,146 @@
+const { EventEmitter } = require("events");
+
+jest.mock("child_process", () => ({ spawn: jest.fn() }));
+
+const { spawn } = require("child_process");
+const OMRWorkerPool = require("../src/services/omrWorkerPool");
+
+function fakeProcess() {
+  const proc = new EventEmitter();
+  proc.stdout = new EventEmitter();
+  proc.stderr = new EventEmitter();
+  proc.stdin = Object.assign(new EventEmitter(), { write: jest.fn() });
+  proc.kill = jest.fn((signal) => proc.emit("exit", null, signal || "SIGTERM"));
+  return proc;
+}
+
+function frame(body) {
+  const data = Buffer.isBuffer(body) ? body : Buffer.from(JSON.stringify(body), "utf8");
+  const header = Buffer.alloc(4);
+  header.writeUInt32BE(data.length, 0);
+  return Buffer.concat([header, data]);
+}
+
+let procs;
+let pool;
+
+beforeEach(() => {
+  jest.useFakeTimers();
+  jest.spyOn(console, "log").mockImplementation(() => {});
+  jest.spyOn(console, "warn").mockImplementation(() => {});
+  jest.spyOn(console, "error").mockImplementation(() => {});
+  procs = [];
+  spawn.mockReset();
+  spawn.mockImplementation(() => {
+    const proc = fakeProcess();
+    procs.push(proc);
+    return proc;
+  });
+  pool = new OMRWorkerPool("worker.py", { size: 1, requestTimeoutMs: 1000, restartDelayMs: 100, maxRestartDelayMs: 1000, maxCrashes: 3 });
+});
+
+afterEach(() => {
+  pool.shutdown();
+  jest.useRealTimers();
+  jest.restoreAllMocks();
+});
+
+describe("frame decoding", () => {
+  test("reassembles frames split across chunks and several frames in one chunk", async () => {
+    const first = pool.request({ op: "process" });
+    const bytes = frame({ id: 1, ok: true, result: { n: 1 } });
+    procs[0].stdout.emit("data", bytes.subarray(0, 2));
+    procs[0].stdout.emit("data", bytes.subarray(2, 9));
+    procs[0].stdout.emit("data", bytes.subarray(9));
+    await expect(first).resolves.toMatchObject({ id: 1, result: { n: 1 } });
+
+    const second = pool.request({ op: "process" });
+    const third = pool.request({ op: "process" });
+    procs[0].stdout.emit("data", Buffer.concat([frame({ id: 2, ok: true }), frame({ id: 3, ok: true }).subarray(0, 6)]));
+    await expect(second).resolves.toMatchObject({ id: 2 });
+    procs[0].stdout.emit("data", frame({ id: 3, ok: true }).subarray(6));
+    await expect(third).resolves.toMatchObject({ id: 3 });
+  });
+
+  test("attaches binary frames to the JSON header that announced them", async () => {
+    const pending = pool.request({ op: "process" });
+    const png = Buffer.from([0x89, 0x50, 0x4e, 0x47, 0, 0, 0, 0]);
+    procs[0].stdout.emit("data", Buffer.concat([frame({ id: 1, ok: true, blobs: 2 }), frame(png)]));
+    procs[0].stdout.emit("data", frame(Buffer.from("second")));
+    const response = await pending;
+    expect(response.blobData).toHaveLength(2);
+    expect(response.blobData[0].equals(png)).toBe(true);
+    expect(response.blobData[1].toString()).toBe("second");
+  });
+
+  test("hands `more` frames to onPartial and re-arms the timeout", async () => {
+    const pages = [];
+    const pending = pool.request({ op: "document" }, { onPartial: (result) => pages.push(result.page) });
+    jest.advanceTimersByTime(800);
+    procs[0].stdout.emit("data", frame({ id: 1, ok: true, more: true, result: { page: 1 } }));
+    jest.advanceTimersByTime(800);
+    procs[0].stdout.emit("data", frame({ id: 1, ok: true, more: true, result: { page: 2 } }));
+    procs[0].stdout.emit("data", frame({ id: 1, ok: true, result: { pages: 2 } }));
+    await expect(pending).resolves.toMatchObject({ result: { pages: 2 } });
+    expect(pages).toEqual([1, 2]);
+    expect(procs[0].kill).not.toHaveBeenCalled();
+  });
+});
+
+describe("failures", () => {
+  test("rejects a request that times out and restarts the worker", async () => {
+    const pending = pool.request({ op: "process" });
+    jest.advanceTimersByTime(1000);
+    expect(procs[0].kill).toHaveBeenCalledWith("SIGKILL");
+    await expect(pending).rejects.toThrow("Python worker exited");
+    jest.advanceTimersByTime(100);
+    expect(spawn).toHaveBeenCalledTimes(2);
+  });
+
+  test("rejects the running request when the worker exits", async () => {
+    const pending = pool.request({ op: "process" });
+    procs[0].emit("exit", 1, null);
+    await expect(pending).rejects.toThrow("code=1");
+  });
+
+  test("backs off between crashes and gives up after maxCrashes", async () => {
+    pool.start();
+    procs[0].emit("exit", 1, null);
+    jest.advanceTimersByTime(99);
+    expect(spawn).toHaveBeenCalledTimes(1);
+    jest.advanceTimersByTime(1);
+    expect(spawn).toHaveBeenCalledTimes(2);
+
+    procs[1].emit("exit", 1, null);
+    jest.advanceTimersByTime(199);
+    expect(spawn).toHaveBeenCalledTimes(2);
+    jest.advanceTimersByTime(1);
+    expect(spawn).toHaveBeenCalledTimes(3);
+
+    procs[2].emit("exit", 1, null);
+    jest.advanceTimersByTime(400);
+    const running = pool.request({ op: "process" });
+    const queued = pool.request({ op: "process" });
+    procs[3].emit("exit", 1, null);
+    await expect(running).rejects.toThrow("Python worker exited");
+    await expect(queued).rejects.toThrow("crashed 4 times in a row");
+    expect(pool.enabled).toBe(false);
+    jest.advanceTimersByTime(10000);
+    expect(spawn).toHaveBeenCalledTimes(4);
+    await expect(pool.request({ op: "process" })).rejects.toThrow("disabled");
+  });
+
+  test("an answer resets the crash backoff", async () => {
+    pool.start();
+    procs[0].emit("exit", 1, null);
+    jest.advanceTimersByTime(100);
+    procs[1].emit("exit", 1, null);
+    jest.advanceTimersByTime(200);
+    const pending = pool.request({ op: "process" });
+    procs[2].stdout.emit("data", frame({ id: 1, ok: true }));
+    await pending;
+    procs[2].emit("exit", 1, null);
+    jest.advanceTimersByTime(100);
+    expect(spawn).toHaveBeenCalledTimes(4);
+  });
+});